@@ -0,0 +1,379 @@
+from src.algorithms.neighbourhood import HillClimbing
+from src.evaluators import TimeEvaluator, TimeWindowCache, DistanceCache, base_evaluator, move_pieces
+from src.locations import Store
+from src.progress import Incumbent, SweepFinished, PhaseTiming, Statistics, sink_or_default
+import math
+import random
+import time
+
+
+class ALNS(HillClimbing):
+    """"
+    Adaptive Large Neighbourhood Search (Ropke and Pisinger, 2006) for the pick up and delivery problem with and without
+    time windows. Every iteration removes a number of requests from the current route with a destroy operator and puts
+    them back with a repair operator. The operators are picked by roulette wheel with weights that adapt to how often
+    they produce new best, improving or accepted routes. New routes are accepted by simulated annealing.
+
+    A request is a pick up and delivery pair. In a relaxed route (problem 2) every store copy forms a request with its
+    job. When a store is visited once for all its jobs (problem 1) the store and all its jobs are removed and inserted
+    as one unit, so the precedence of the jobs is kept.
+
+    Insertions and removals are scored by the incremental caches of the evaluators, so a candidate insertion costs O(1)
+    plus the touched nodes instead of a full evaluation.
+    """
+    destroy_operators = ['random_removal', 'worst_removal', 'shaw_removal']
+    repair_operators = ['greedy_insertion', 'regret_insertion']
+
+    def __init__(self, jobs, stores, deliverers, distances_matrix, evaluator, codec, driver_ends_at_start=True,
+                 route_initialization_method="random", evaluation_cache=None, progress=None):
+        """"
+        Initializes an ALNS object, see HillClimbing for the parameters
+        """
+        HillClimbing.__init__(self, jobs, stores, deliverers, distances_matrix, evaluator, codec,
+                              driver_ends_at_start=driver_ends_at_start,
+                              route_initialization_method=route_initialization_method,
+                              evaluation_cache=evaluation_cache, progress=progress)
+
+    def solve(self, nr_iterations=1000, time_limit=None, min_removal=1, max_removal=None, regret_k=3,
+              start_temperature=0.05, end_temperature=0.001, reaction_factor=0.1, segment_size=50,
+              pickup_candidates=6, seed=1):
+        """"
+        Runs the ALNS starting from self.solution, see generate_initial_solution.
+
+        :param: nr_iterations: int maximum number of destroy and repair iterations
+        :param: time_limit: float optional maximum number of CPU seconds
+        :param: min_removal: int minimum number of requests removed per iteration
+        :param: max_removal: int maximum number of requests removed per iteration, defaults to 40% of the requests
+        :param: regret_k: int the k of the regret-k insertion
+        :param: start_temperature: float a route this fraction worse than the initial one is accepted with
+        probability 0.5 at the start
+        :param: end_temperature: float the same fraction at the last iteration, the temperature cools geometrically
+        :param: reaction_factor: float how fast the operator weights follow their recent performance
+        :param: segment_size: int number of iterations between weight updates
+        :param: pickup_candidates: int number of best pick up positions for which delivery positions are tried
+        :return: best_score, best_route, iteration the best route was found
+        """
+        rand = random.Random(seed)
+        self.pickup_candidates = pickup_candidates
+        current_route = self.solution.copy()
+        current_score = current_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        best_route = current_route
+        best_score = current_score
+        iteration_found_best_sol = None
+
+        nr_units = len(self._units(current_route))
+        if max_removal is None:
+            max_removal = max(min_removal, int(0.4 * nr_units))
+        max_removal = min(max_removal, nr_units)
+
+        # the temperature works on the relative difference with the current route, so that it suits both the
+        # kilometers of problem 1 and the squared seconds of problem 2. A route start_temperature worse than the
+        # current one is accepted with probability 0.5 at the start.
+        temperature = -start_temperature / math.log(0.5)
+        end = -end_temperature / math.log(0.5)
+        cooling = (end / temperature) ** (1.0 / max(nr_iterations, 1)) if temperature > 0 else 1.0
+
+        destroy_weights = AdaptiveWeights(ALNS.destroy_operators, reaction_factor)
+        repair_weights = AdaptiveWeights(ALNS.repair_operators, reaction_factor)
+        visited = set()
+        start = time.process_time()
+        self.statistics = HillClimbing._empty_statistics()
+        progress = sink_or_default(self.progress)
+        started = time.perf_counter()
+
+        for i in range(nr_iterations):
+            if time_limit is not None and time.process_time() - start > time_limit:
+                break
+            destroy = destroy_weights.select(rand)
+            repair = repair_weights.select(rand)
+            q = rand.randint(min_removal, max_removal)
+
+            partial_route, removed = self._destroy(destroy, current_route, q, rand)
+            new_route = self._repair(repair, partial_route, removed, rand, regret_k)
+            # the cache scores the route in O(n), only a new best route is evaluated in full
+            new_score = self._cache(new_route).score
+            self.statistics['candidates'] += 1
+
+            reward = 0
+            route_hash = new_route.route_hash()
+            if HillClimbing.may_improve(new_score, best_score):
+                new_score = new_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                self.statistics['evaluated'] += 1
+            if new_score < best_score:
+                best_route = new_route
+                best_score = new_score
+                iteration_found_best_sol = i
+                reward = AdaptiveWeights.new_best
+                if progress.enabled:
+                    progress.emit(Incumbent('alns', i, best_score))
+            if new_score < current_score:
+                if reward == 0 and route_hash not in visited:
+                    reward = AdaptiveWeights.improved
+                current_route = new_route
+                current_score = new_score
+            elif temperature > 0 and rand.random() < \
+                    math.exp(-(new_score - current_score) / max(abs(current_score), 1e-9) / temperature):
+                if route_hash not in visited:
+                    reward = AdaptiveWeights.accepted
+                current_route = new_route
+                current_score = new_score
+            visited.add(route_hash)
+
+            destroy_weights.reward(destroy, reward)
+            repair_weights.reward(repair, reward)
+            if (i + 1) % segment_size == 0:
+                destroy_weights.update()
+                repair_weights.update()
+            temperature *= cooling
+
+        if progress.enabled:
+            progress.emit(SweepFinished('alns', nr_iterations, best_score, self.statistics['candidates'],
+                                        self.statistics['evaluated']))
+            progress.emit(PhaseTiming('alns', 'solve', time.perf_counter() - started))
+            progress.emit(Statistics('alns', 'operator weights', dict(destroy_weights.weights,
+                                                                      **repair_weights.weights)))
+        return best_score, best_route, iteration_found_best_sol
+
+    def _units(self, route):
+        """"
+        Returns the requests of the route as lists of nodes, the pick up first
+        """
+        relaxed = False
+        for node in route.tour:
+            if isinstance(node, Store) and node.get_job() is not None:
+                relaxed = True
+                break
+
+        units = []
+        covered = set()
+        if relaxed:
+            for store, job in route.request_pairs():
+                units.append([store, job])
+        else:
+            groups = {}
+            for store, job in route.request_pairs():
+                if id(store) not in groups:
+                    groups[id(store)] = [store]
+                    units.append(groups[id(store)])
+                groups[id(store)].append(job)
+        for unit in units:
+            for node in unit:
+                covered.add(id(node))
+        for node in route.tour:
+            if id(node) not in covered:
+                units.append([node])
+        return units
+
+    def _cache(self, route):
+        if base_evaluator(self.evaluator) is TimeEvaluator:
+            return TimeWindowCache(route)
+        return DistanceCache(route, self.driver_ends_at_start)
+
+    def _destroy(self, operator, route, q, rand):
+        """"
+        Removes q requests from a copy of route. Returns the partial route and the removed requests.
+        """
+        units = self._units(route)
+        if operator == 'random_removal':
+            removed = rand.sample(units, q)
+        elif operator == 'worst_removal':
+            removed = self._worst_removal(route, units, q, rand)
+        elif operator == 'shaw_removal':
+            removed = self._shaw_removal(route, units, q, rand)
+        else:
+            raise TypeError('Unknown destroy operator ' + str(operator))
+
+        removed_ids = set()
+        for unit in removed:
+            for node in unit:
+                removed_ids.add(id(node))
+        partial_route = route.copy()
+        partial_route.tour = [node for node in route.tour if id(node) not in removed_ids]
+        return partial_route, removed
+
+    def _worst_removal(self, route, units, q, rand, randomness=3):
+        """"
+        Removes the requests that save the most when taken out, with some randomness
+        """
+        cache = self._cache(route)
+        n = len(route.tour)
+        savings = []
+        for unit in units:
+            positions = [cache.index_of(node) for node in unit]
+            saving = cache.score - cache.pieces_score(move_pieces(n, positions, []))
+            savings.append((saving, unit))
+        savings.sort(key=lambda item: -item[0])
+
+        removed = []
+        while len(removed) < q:
+            index = int(len(savings) * rand.random() ** randomness)
+            removed.append(savings.pop(index)[1])
+        return removed
+
+    def _shaw_removal(self, route, units, q, rand, randomness=6):
+        """"
+        Removes requests that are related to each other: close pick ups, close deliveries and similar time windows
+        """
+        dist_matrix = route.distances_matrix
+        time_scale = 1.0
+        starts = [HillClimbing.get_time_start(unit[-1]) if len(unit) > 1 else 0 for unit in units]
+        if len(starts) > 0 and max(starts) > min(starts):
+            time_scale = float(max(starts) - min(starts))
+
+        def relatedness(a, b):
+            value = dist_matrix.get_distance(a[0], b[0]) + dist_matrix.get_distance(a[-1], b[-1])
+            if len(a) > 1 and len(b) > 1:
+                value += abs(HillClimbing.get_time_start(a[-1]) - HillClimbing.get_time_start(b[-1])) / time_scale
+            return value
+
+        remaining = list(units)
+        removed = [remaining.pop(rand.randrange(len(remaining)))]
+        while len(removed) < q:
+            reference = rand.choice(removed)
+            remaining.sort(key=lambda unit: relatedness(reference, unit))
+            index = int(len(remaining) * rand.random() ** randomness)
+            removed.append(remaining.pop(index))
+        return removed
+
+    def _repair(self, operator, route, removed, rand, regret_k):
+        """"
+        Inserts the removed requests back into route. Returns the repaired route.
+        """
+        removed = list(removed)
+        rand.shuffle(removed)
+        if operator == 'greedy_insertion':
+            k = 1
+        elif operator == 'regret_insertion':
+            k = regret_k
+        else:
+            raise TypeError('Unknown repair operator ' + str(operator))
+
+        while len(removed) > 0:
+            cache = self._cache(route)
+            best_unit = None
+            best_plan = None
+            best_key = None
+            for unit in removed:
+                plans = self._insertion_plans(cache, unit, k)
+                cost = plans[0][0] - cache.score
+                if k > 1:
+                    # the regret: how much is lost by not inserting this request at its best position now
+                    regret = 0
+                    for h in range(1, k):
+                        if h < len(plans):
+                            regret += plans[h][0] - plans[0][0]
+                        else:
+                            regret = float('inf')
+                    key = (-regret, cost)
+                else:
+                    key = (cost,)
+                if best_key is None or key < best_key:
+                    best_key = key
+                    best_unit = unit
+                    best_plan = plans[0][1]
+
+            route.tour = ALNS._insert(route.tour, best_plan)
+            removed.remove(best_unit)
+        return route
+
+    def _insertion_plans(self, cache, unit, k):
+        """"
+        Returns the best insertion plans of a request as a list of (score, inserts) sorted on score. The pick up is
+        tried at every position, the deliveries only after the best pickup_candidates pick up positions. A request
+        with more than one delivery places them one by one after the pick up.
+        """
+        n = len(cache.route.tour)
+        store = unit[0]
+        jobs = unit[1:]
+        pickups = []
+        for p in range(n + 1):
+            pickups.append((cache.pieces_score(move_pieces(n, [], [(p, store)])), p))
+        pickups.sort(key=lambda item: item[0])
+
+        plans = []
+        for pickup_score, p in pickups[:self.pickup_candidates]:
+            if len(jobs) == 0:
+                plans.append((pickup_score, [(p, store)]))
+            elif len(jobs) == 1:
+                for j in range(p, n + 1):
+                    inserts = [(p, store), (j, jobs[0])]
+                    plans.append((cache.pieces_score(move_pieces(n, [], inserts)), inserts))
+            else:
+                inserts = [(p, store)]
+                score = pickup_score
+                for job in jobs:
+                    best = None
+                    for j in range(p, n + 1):
+                        candidate = ALNS._add_insert(inserts, j, job)
+                        candidate_score = cache.pieces_score(move_pieces(n, [], candidate))
+                        if best is None or candidate_score < best[0]:
+                            best = (candidate_score, candidate)
+                    score, inserts = best
+                plans.append((score, inserts))
+
+        plans.sort(key=lambda item: item[0])
+        return plans[:max(k, 1)]
+
+    @staticmethod
+    def _add_insert(inserts, index, node):
+        """"
+        Returns a copy of inserts with (index, node) added after all inserts with an index <= index
+        """
+        position = len(inserts)
+        while position > 0 and inserts[position - 1][0] > index:
+            position -= 1
+        return inserts[:position] + [(index, node)] + inserts[position:]
+
+    @staticmethod
+    def _insert(tour, inserts):
+        new_tour = []
+        j = 0
+        for i in range(len(tour) + 1):
+            while j < len(inserts) and inserts[j][0] == i:
+                new_tour.append(inserts[j][1])
+                j += 1
+            if i < len(tour):
+                new_tour.append(tour[i])
+        return new_tour
+
+
+class AdaptiveWeights:
+    """"
+    Roulette wheel operator weights of the ALNS. During a segment every operator collects rewards, at the end of the
+    segment its weight moves towards the average reward by reaction_factor.
+    """
+    new_best = 33
+    improved = 9
+    accepted = 13
+
+    def __init__(self, operators, reaction_factor=0.1):
+        self.operators = list(operators)
+        self.reaction_factor = reaction_factor
+        self.weights = {}
+        self.scores = {}
+        self.uses = {}
+        for operator in self.operators:
+            self.weights[operator] = 1.0
+            self.scores[operator] = 0.0
+            self.uses[operator] = 0
+
+    def select(self, rand):
+        value = rand.random() * sum(self.weights.values())
+        for operator in self.operators:
+            value -= self.weights[operator]
+            if value <= 0:
+                return operator
+        return self.operators[-1]
+
+    def reward(self, operator, score):
+        self.scores[operator] += score
+        self.uses[operator] += 1
+
+    def update(self):
+        for operator in self.operators:
+            if self.uses[operator] > 0:
+                average = self.scores[operator] / self.uses[operator]
+                self.weights[operator] = max((1 - self.reaction_factor) * self.weights[operator] +
+                                             self.reaction_factor * average, 0.01)
+            self.scores[operator] = 0.0
+            self.uses[operator] = 0
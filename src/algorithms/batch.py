@@ -0,0 +1,29 @@
+from src.algorithms.neighbourhood import HillClimbing
+from src.evaluators import DistanceEvaluator
+from concurrent.futures import ThreadPoolExecutor
+
+
+def solve_all(contexts, solve, workers=1):
+    """"
+    Runs solve(context) for every domain.ProblemContext and returns the results in the order of the contexts. With
+    workers > 1 the problems are solved by a pool of threads in this process. The contexts share no mutable state, so
+    the solves do not interfere, but the threads share one interpreter: the pool overlaps waiting, e.g. for a routing
+    engine, and keeps one copy of the shared distances, it does not run the pure python search on more cores.
+    """
+    if workers <= 1:
+        return [solve(context) for context in contexts]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(solve, contexts))
+
+
+def hill_climbing(evaluator, route_initialization_method='random', nr_initial_solutions=200, seed=1, **parameters):
+    """"
+    Returns a solve function for solve_all that runs HillClimbing on a context, the parameters are passed to
+    HillClimbing.solve. The solve function returns the score, route and iteration of HillClimbing.solve.
+    """
+    def solve(context):
+        hc = HillClimbing(context.jobs, context.stores, context.deliverers, context.distances_matrix, evaluator,
+                          context.codec(DistanceEvaluator), route_initialization_method=route_initialization_method)
+        hc.generate_initial_solution(nr_iterations=nr_initial_solutions, use_seed=True, seed=seed)
+        return hc.solve(**parameters)
+    return solve
@@ -0,0 +1,296 @@
+from src.algorithms.dp import WindowOptimizer
+from src.algorithms.neighbourhood import HillClimbing
+from src.domain import Route, Codec, CompactRoute, ProblemIndex
+from src.evaluators import DistanceEvaluator, TimeEvaluator, TimeWindowCache, base_evaluator
+from src.locations import Deliverer, DistancesMatrix
+from src.progress import PhaseTiming, Statistics, sink_or_default
+import math
+import time
+
+
+class ClusterDecomposition:
+    """"
+    Decompose and stitch mode for very large single driver tours. The requests are partitioned into clusters of at most
+    cluster_size jobs by recursive coordinate bisection on their location and, for the time window problem, the start
+    of their delivery window. Each cluster is solved as a small problem by HillClimbing, in parallel worker processes.
+    The sub-tours are concatenated in cluster order and the seams are improved by the exact window optimization of
+    WindowOptimizer, only on the windows that cross a seam.
+
+    A unit is a store with all its jobs when the store is visited once (problem 1) and a store copy with its job in a
+    relaxed route (problem 2), so a cluster never splits what has to stay together.
+
+    A cluster is solved as if the driver starts at the end of the previous cluster (its centroid) for the distance
+    problem and at the estimated end time of the previous clusters for the time window problem. Clusters are ordered
+    by the start of their windows for the time window problem and by a nearest neighbour walk from the driver for the
+    distance problem.
+
+    Clustering is O(n log n), every cluster costs the same, so the solve time grows near linearly with the number of
+    units. Use a locations.LazyDistancesMatrix for large instances, the full tour only looks up a few pairs per node.
+    """
+    def __init__(self, jobs, stores, deliverers, distances_matrix, evaluator, cluster_size=40, workers=1,
+                 driver_ends_at_start=True, time_weight=1.0, progress=None):
+        """"
+        :param: cluster_size: int maximum number of jobs of a cluster, a store group is never split
+        :param: workers: int number of worker processes, the clusters are solved in this process when 1
+        :param: time_weight: float weight of the delivery window start against the location in the clustering of the
+        time window problem, in km per km driven in the time difference
+        :param: progress: progress.ProgressSink optional sink of the progress events of the decomposition, the solvers
+        of the clusters use the default sink of their process
+        """
+        self.jobs = jobs
+        self.stores = stores
+        self.deliverers = deliverers
+        self.distances_matrix = distances_matrix
+        self.evaluator = evaluator
+        self.cluster_size = cluster_size
+        self.workers = workers
+        self.driver_ends_at_start = driver_ends_at_start
+        self.time_weight = time_weight
+        self.progress = progress
+        self.statistics = {'clusters': 0, 'cluster_seconds': 0.0, 'seam_seconds': 0.0, 'seam_improvements': 0}
+
+    def solve(self, with_time_windows=False, tabu=True, tabu_size=5, nr_iterations=10, allow_infeasibilites=True,
+              seed=1, nr_initial_solutions=200, window_size=8, max_sweeps=2, passes=2):
+        """"
+        Returns the score and the route. The parameters of the sub-problems are passed to HillClimbing.solve.
+
+        :param: nr_initial_solutions: int number of random routes per cluster of which the best is the start solution
+        :param: window_size: int size of the windows that are optimized around the seams
+        :param: passes: int the first pass estimates where and when each cluster starts, every next pass solves the
+        clusters again, starting from their sub-tour, where and when the previous sub-tour of the stitched route ends
+        """
+        deliverer = self.deliverers[0]
+        units = self._units(with_time_windows)
+        clusters = self._cluster(units, with_time_windows)
+        clusters = self._order(clusters, with_time_windows)
+        self.statistics['clusters'] = len(clusters)
+
+        tasks = []
+        previous = deliverer
+        clock = deliverer.get_shift_start()
+        for c in range(len(clusters)):
+            jobs = [job for unit in clusters[c] for job in unit['jobs']]
+            stores = []
+            for unit in clusters[c]:
+                if all(store is not unit['store'] for store in stores):
+                    stores.append(unit['store'])
+            tasks.append({
+                'jobs': jobs, 'stores': stores,
+                'deliverer': self._start_deliverer(deliverer, previous, jobs, clock, with_time_windows),
+                'evaluator': base_evaluator(self.evaluator),
+                'provider': getattr(self.distances_matrix, 'provider', None),
+                'initialization': 'relaxed_random' if with_time_windows else 'random',
+                'nr_initial_solutions': nr_initial_solutions, 'initial_tour': None,
+                'parameters': {'with_time_windows': with_time_windows, 'tabu': tabu, 'tabu_size': tabu_size,
+                               'nr_iterations': nr_iterations, 'allow_infeasibilites': allow_infeasibilites,
+                               'seed': 1000 + seed + c}
+            })
+            previous = ClusterDecomposition._centroid_deliverer(deliverer, clusters[c])
+            clock = tasks[-1]['deliverer'].get_shift_start() + self._duration(deliverer, clusters[c])
+
+        start = time.time()
+        sub_tours = self._solve_clusters(tasks)
+        route, seams = self._stitch(tasks, sub_tours, with_time_windows)
+        score = route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        for p in range(1, passes):
+            starts = self._seam_deliverers(route, seams, with_time_windows)
+            for c in range(1, len(tasks)):
+                tasks[c]['deliverer'] = starts[c - 1]
+                tasks[c]['initial_tour'] = sub_tours[c]
+            candidate_sub_tours = self._solve_clusters(tasks)
+            candidate, seams = self._stitch(tasks, candidate_sub_tours, with_time_windows)
+            candidate_score = candidate.evaluate(end_with_start_loc=self.driver_ends_at_start)
+            if candidate_score >= score:
+                break
+            route, score, sub_tours = candidate, candidate_score, candidate_sub_tours
+        self.statistics['cluster_seconds'] = time.time() - start
+
+        start = time.time()
+        optimizer = WindowOptimizer(window_size=window_size, driver_ends_at_start=self.driver_ends_at_start)
+        starts = [s for seam in seams for s in range(seam - window_size + 1, seam)]
+        score, route = optimizer.optimize(route, max_sweeps=max_sweeps, starts=starts)
+        self.statistics['seam_seconds'] = time.time() - start
+        self.statistics['seam_improvements'] = optimizer.statistics['improvements']
+        progress = sink_or_default(self.progress)
+        if progress.enabled:
+            progress.emit(PhaseTiming('decomposition', 'clusters', self.statistics['cluster_seconds']))
+            progress.emit(PhaseTiming('decomposition', 'seams', self.statistics['seam_seconds']))
+            progress.emit(Statistics('decomposition', 'decomposition', self.statistics))
+        return score, route
+
+    def _solve_clusters(self, tasks):
+        if self.workers > 1 and len(tasks) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(self.workers, len(tasks))) as pool:
+                return pool.map(_solve_cluster, tasks)
+        return [_solve_cluster(task) for task in tasks]
+
+    def _seam_deliverers(self, route, seams, with_time_windows):
+        """"
+        Returns per seam the driver of the next sub-problem: at the node before the seam for the distance problem and
+        at the time it leaves that node for the time window problem, see _start_deliverer
+        """
+        deliverer = self.deliverers[0]
+        deliverers = []
+        if with_time_windows:
+            cache = TimeWindowCache(route)
+            for seam in seams:
+                deliverers.append(Deliverer(deliverer.id, deliverer.label, cache.departure[seam - 1],
+                                            deliverer.get_shift_end(), deliverer.location, None, deliverer.capacity,
+                                            None, None, None, None, None))
+        else:
+            for seam in seams:
+                deliverers.append(Deliverer(deliverer.id, deliverer.label, deliverer.get_shift_start(),
+                                            deliverer.get_shift_end(), route.tour[seam - 1].location, None,
+                                            deliverer.capacity, None, None, None, None, None))
+        return deliverers
+
+    def _units(self, with_time_windows):
+        """"
+        Returns the units as dicts of store, jobs and their (x, y, t) position in km
+        """
+        index = ProblemIndex.of(self.jobs, self.stores)
+        if with_time_windows:
+            groups = [(request.pick_up, [request.drop_off]) for request in index.requests]
+        else:
+            groups = list(index.groups().values())
+        latitude = sum(store.get_latitude() for store, jobs in groups) / max(1, len(groups))
+        scale = math.cos(math.radians(latitude)) * 111.32
+        # km driven per second of difference between the delivery windows
+        km_per_second = TimeEvaluator.speed / 1000 * self.time_weight if with_time_windows else 0.0
+        units = []
+        for store, jobs in groups:
+            nodes = [store] + jobs
+            x = sum(node.get_longitude() for node in nodes) / len(nodes) * scale
+            y = sum(node.get_latitude() for node in nodes) / len(nodes) * 110.57
+            t = min(job.get_time_start() for job in jobs) * km_per_second
+            units.append({'store': store, 'jobs': jobs, 'position': (x, y, t)})
+        return units
+
+    def _cluster(self, units, with_time_windows):
+        """"
+        Recursive coordinate bisection: a cluster with more than cluster_size jobs is split at the median of the
+        dimension with the largest spread
+        """
+        dimensions = 3 if with_time_windows else 2
+        clusters = []
+        stack = [units]
+        while stack:
+            cluster = stack.pop()
+            if len(cluster) == 1 or sum(len(unit['jobs']) for unit in cluster) <= self.cluster_size:
+                clusters.append(cluster)
+                continue
+            spreads = []
+            for d in range(dimensions):
+                values = [unit['position'][d] for unit in cluster]
+                spreads.append(max(values) - min(values))
+            d = spreads.index(max(spreads))
+            cluster = sorted(cluster, key=lambda unit: unit['position'][d])
+            half = len(cluster) // 2
+            stack.append(cluster[half:])
+            stack.append(cluster[:half])
+        return clusters
+
+    def _order(self, clusters, with_time_windows):
+        def centroid(cluster):
+            return tuple(sum(unit['position'][d] for unit in cluster) / len(cluster) for d in range(3))
+
+        if with_time_windows:
+            return sorted(clusters, key=lambda cluster: centroid(cluster)[2])
+        deliverer = self.deliverers[0]
+        scale = math.cos(math.radians(deliverer.get_latitude())) * 111.32
+        position = (deliverer.get_longitude() * scale, deliverer.get_latitude() * 110.57)
+        remaining = list(clusters)
+        ordered = []
+        while remaining:
+            nearest = min(remaining, key=lambda cluster: (centroid(cluster)[0] - position[0]) ** 2 +
+                                                         (centroid(cluster)[1] - position[1]) ** 2)
+            remaining.remove(nearest)
+            ordered.append(nearest)
+            position = centroid(nearest)[:2]
+        return ordered
+
+    def _start_deliverer(self, deliverer, previous, jobs, clock, with_time_windows):
+        """"
+        The driver of a sub-problem of the distance problem starts where the previous cluster ends. The TimeEvaluator
+        times the travel to a job from the location of the driver, so for the time window problem the driver keeps its
+        location and starts when the previous clusters are estimated to be done, or when the earliest delivery of the
+        cluster can be reached if that is later.
+        """
+        if not with_time_windows:
+            return Deliverer(deliverer.id, deliverer.label, deliverer.get_shift_start(), deliverer.get_shift_end(),
+                             previous.location, None, deliverer.capacity, None, None, None, None, None)
+        earliest = min(jobs, key=lambda job: job.get_time_start())
+        travel = self.distances_matrix.get_distance(deliverer, earliest) * 1000 / TimeEvaluator.speed
+        start_shift = max(clock, earliest.get_time_start() - travel)
+        return Deliverer(deliverer.id, deliverer.label, start_shift, deliverer.get_shift_end(), deliverer.location,
+                         None, deliverer.capacity, None, None, None, None, None)
+
+    def _duration(self, deliverer, cluster):
+        """"
+        Estimated time to serve a cluster under the TimeEvaluator: the service and the travel from the driver for every
+        job and the travel from a job to the next store
+        """
+        duration = 0
+        for unit in cluster:
+            for job in unit['jobs']:
+                duration += TimeEvaluator.time_spent_at_customer + \
+                    (self.distances_matrix.get_distance(deliverer, job) +
+                     self.distances_matrix.get_distance(unit['store'], job)) * 1000 / TimeEvaluator.speed
+        return duration
+
+    @staticmethod
+    def _centroid_deliverer(deliverer, cluster):
+        nodes = [node for unit in cluster for node in [unit['store']] + unit['jobs']]
+        location = [sum(node.get_latitude() for node in nodes) / len(nodes),
+                    sum(node.get_longitude() for node in nodes) / len(nodes)]
+        return Deliverer(deliverer.id, deliverer.label, deliverer.get_shift_start(), deliverer.get_shift_end(),
+                         location, None, deliverer.capacity, None, None, None, None, None)
+
+    def _stitch(self, tasks, sub_tours, with_time_windows):
+        """"
+        Concatenates the sub-tours, given as CompactRoute of the jobs and stores of their task, on the nodes of this
+        problem. Returns the route and the positions where a sub-tour starts.
+        """
+        stores = self.stores
+        copies = {}
+        if with_time_windows:
+            # a store copy per job, as in a relaxed random route
+            stores = []
+            for request in ProblemIndex.of(self.jobs, self.stores).requests:
+                store = request.pick_up.copy()
+                store.set_job(request.drop_off)
+                stores.append(store)
+                copies[request.drop_off.id] = store
+        tour = []
+        seams = []
+        for task, sub_tour in zip(tasks, sub_tours):
+            if tour:
+                seams.append(len(tour))
+            tour.extend(ProblemIndex(task['jobs'], task['stores']).decode(sub_tour.codes, copies))
+        route = Route(self.jobs, stores, [self.deliverers[0]], self.distances_matrix, self.evaluator)
+        route.tour = tour
+        return route, seams
+
+
+def _solve_cluster(task):
+    """"
+    Solves a cluster with HillClimbing in a worker process. Returns the tour as a CompactRoute, its codes refer to the
+    jobs and stores of the task, as the nodes of the worker are copies of the nodes of the parent process. The solver
+    gets the seed of the task with its parameters, so the result does not depend on the number of workers.
+    """
+    jobs = task['jobs']
+    stores = task['stores']
+    deliverers = [task['deliverer']]
+    distances_matrix = DistancesMatrix(jobs + stores + deliverers, task['provider'])
+    codec = Codec(jobs, stores, deliverers, distances_matrix, DistanceEvaluator)
+    hc = HillClimbing(jobs, stores, deliverers, distances_matrix, task['evaluator'], codec, driver_ends_at_start=False,
+                      route_initialization_method=task['initialization'])
+    if task['initial_tour'] is None:
+        hc.generate_initial_solution(nr_iterations=task['nr_initial_solutions'])
+    else:
+        # warm start from the sub-tour of the previous pass
+        hc.generate_initial_solution(nr_iterations=1)
+        hc.solution.tour = task['initial_tour'].route(hc.solution).tour
+    score, route, iteration = hc.solve(**task['parameters'])
+    return CompactRoute.of(route, moves=False)
@@ -0,0 +1,340 @@
+from src.evaluators import DistanceEvaluator, LoadProfile, TimeEvaluator, TimeWindowCache, base_evaluator
+from src.locations import Job, Store
+
+
+class WindowOptimizer:
+    """"
+    Post optimization of a route by exact dynamic programming over windows. A window of window_size consecutive nodes
+    slides over the route and each window is reordered optimally with a bitmask dynamic program (Held-Karp) that keeps
+    the node before and after the window fixed. Sweeps are repeated until a sweep finds no improvement.
+
+    For the DistanceEvaluator the program is exact: states are (visited nodes, last node) and the cost of a step follows
+    the evaluator rules, including the precedence penalty of a job that is visited before its store in the window.
+    States that are already as expensive as the current order of the window are pruned.
+
+    The load after a node only depends on the nodes visited up to it, so the load of a state follows from its visited
+    nodes. When the driver has a capacity and an order of the window may load the driver above both the capacity and
+    the largest load outside the window, every state also keeps the largest load of its path and pays the capacity
+    penalty of the evaluator for every unit this peak rises above that limit.
+
+    For the TimeEvaluator the cost of a step depends on the arrival time, so every state keeps up to max_labels
+    (score, time) labels. Labels whose score already exceeds the current score of the window and the rest of the route
+    are pruned, the rest of the route is scored in O(1) with the TimeWindowCache.
+
+    Solved windows are memoized on their predecessor, node set and successor, so unchanged windows are not solved again
+    in later sweeps or later calls. A route with at most window_size nodes is solved outright.
+
+    The subset tables themselves are not shared between overlapping windows. A table holds the best paths from the
+    fixed predecessor of its window. The window one position further has the first node of the window as its
+    predecessor and a different successor, so none of its states are in the table. The pruning against the upper
+    bound also leaves the tables incomplete.
+    """
+    def __init__(self, window_size=10, max_labels=8, driver_ends_at_start=True):
+        self.window_size = window_size
+        self.max_labels = max_labels
+        self.driver_ends_at_start = driver_ends_at_start
+        self.memo = {}
+        self.statistics = {'windows': 0, 'memo_hits': 0, 'improvements': 0}
+        self._cache = None
+        self._loads = None
+
+    def optimize(self, route, max_sweeps=5, starts=None):
+        """"
+        Returns the score of the optimized route and the route. The given route is not changed.
+
+        :param: starts: list of int optional start positions of the windows to solve, e.g. only the windows around the
+        seams of a stitched route, all windows when not given
+        """
+        route = route.copy()
+        score = route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        w = min(self.window_size, len(route.tour))
+        if starts is None:
+            starts = range(0, len(route.tour) - w + 1)
+        else:
+            starts = sorted(set(s for s in starts if 0 <= s <= len(route.tour) - w))
+        for sweep in range(max_sweeps):
+            improved = False
+            for s in starts:
+                order = self._solve_window(route, s, w)
+                if order is None:
+                    continue
+                candidate = route.copy()
+                candidate.tour = route.tour[:s] + order + route.tour[s + w:]
+                candidate_score = candidate.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                if candidate_score < score - 1e-9 * max(1.0, abs(score)):
+                    route = candidate
+                    score = candidate_score
+                    improved = True
+                    self.statistics['improvements'] += 1
+            if not improved:
+                break
+        return score, route
+
+    def _solve_window(self, route, s, w):
+        """"
+        Returns the best order of the nodes in tour[s:s + w], or None if the current order is already the best
+        """
+        evaluator = base_evaluator(route.evaluator)
+        tour = route.tour
+        self.statistics['windows'] += 1
+        if evaluator is TimeEvaluator:
+            # the route of optimize is replaced, not changed, by an improvement, so its cache can be reused until then
+            if self._cache is None or self._cache.route is not route:
+                self._cache = TimeWindowCache(route)
+            cache = self._cache
+            start_time = cache.departure[s - 1] if s > 0 else route.deliverer().get_shift_start()
+            loads = WindowOptimizer._window_loads(cache.loads, s, w)
+            key = ('time', start_time, tuple(id(node) for node in tour[s:s + w]),
+                   tuple(id(node) for node in tour[s + w:]), None if loads is None else loads[:2])
+            if key not in self.memo:
+                self.memo[key] = self._time_window(cache, s, w, start_time, loads)
+            else:
+                self.statistics['memo_hits'] += 1
+        elif evaluator is DistanceEvaluator:
+            n = len(tour)
+            if self._loads is None or self._loads.route is not route:
+                self._loads = LoadProfile(route)
+            loads = WindowOptimizer._window_loads(self._loads, s, w)
+            key = ('distance', id(tour[s - 1]) if s > 0 else None, frozenset(id(node) for node in tour[s:s + w]),
+                   id(tour[s + w]) if s + w < n else None, s == 0, min(n - s - w, 2),
+                   None if loads is None else loads[:2])
+            if key not in self.memo:
+                self.memo[key] = self._distance_window(route, s, w, loads)
+            else:
+                self.statistics['memo_hits'] += 1
+        else:
+            raise TypeError('No window optimization for evaluator ' + str(evaluator))
+
+        order = self.memo[key]
+        if order is None:
+            return None
+        window_ids = [id(node) for node in tour[s:s + w]]
+        if [id(node) for node in order] == window_ids or sorted(map(id, order)) != sorted(window_ids):
+            return None
+        return list(order)
+
+    def _distance_window(self, route, s, w, loads):
+        tour = route.tour
+        n = len(tour)
+        window = tour[s:s + w]
+        dist_matrix = route.distances_matrix
+        deliverer = route.deliverer()
+        penalty = DistanceEvaluator.presedence_order_penalty
+        predecessor = tour[s - 1] if s > 0 else None
+        successor = tour[s + w] if s + w < n else None
+        store_bit = WindowOptimizer._store_bits(window)
+
+        def cost(position, previous, node, mask):
+            if position == 0:
+                value = dist_matrix.get_distance(deliverer, node)
+                # the evaluator charges a job at the first position, a job whose store is after the window is charged
+                # wherever it is, that part is constant
+                if isinstance(node, Job) and store_bit.get(node.store['id']) is not None:
+                    value += penalty
+                return value
+            if self.driver_ends_at_start and position == n - 1:
+                return dist_matrix.get_distance(deliverer, node)
+            value = dist_matrix.get_distance(previous, node)
+            # a store outside the window is before or after the job whatever the order, that part is constant
+            if isinstance(node, Job):
+                bit = store_bit.get(node.store['id'])
+                if bit is not None and not mask & bit:
+                    value += penalty
+            return value
+
+        def closing(last):
+            if successor is None:
+                return 0
+            return cost(s + w, window[last], successor, (1 << w) - 1)
+
+        limit = 0 if loads is None else loads[1]
+
+        def peak(previous_peak, mask):
+            return previous_peak if loads is None else max(previous_peak, loads[2][mask])
+
+        # the current order is the upper bound
+        upper_bound = 0
+        mask = 0
+        previous = predecessor
+        current_peak = limit
+        for v in range(w):
+            upper_bound += cost(s + v, previous, window[v], mask)
+            mask |= 1 << v
+            current_peak = peak(current_peak, mask)
+            previous = window[v]
+        upper_bound += closing(w - 1) + DistanceEvaluator.capacity_penalty * (current_peak - limit)
+        epsilon = 1e-9 * max(1.0, abs(upper_bound))
+
+        # a state is (visited nodes, last node, largest load of the path)
+        layer = {}
+        for v in range(w):
+            first_peak = peak(limit, 1 << v)
+            c = cost(s, predecessor, window[v], 0) + DistanceEvaluator.capacity_penalty * (first_peak - limit)
+            if c < upper_bound - epsilon:
+                layer[(1 << v, v, first_peak)] = c
+        parents = {}
+        for k in range(1, w):
+            next_layer = {}
+            for (mask, last, last_peak), c in layer.items():
+                for v in range(w):
+                    if mask & (1 << v):
+                        continue
+                    new_peak = peak(last_peak, mask | (1 << v))
+                    new_cost = c + cost(s + k, window[last], window[v], mask) + \
+                        DistanceEvaluator.capacity_penalty * (new_peak - last_peak)
+                    if new_cost >= upper_bound - epsilon:
+                        continue
+                    state = (mask | (1 << v), v, new_peak)
+                    if state not in next_layer or new_cost < next_layer[state]:
+                        next_layer[state] = new_cost
+                        parents[state] = (mask, last, last_peak)
+            layer = next_layer
+
+        best = None
+        for state, c in layer.items():
+            total = c + closing(state[1])
+            if total < upper_bound - epsilon and (best is None or total < best[0]):
+                best = (total, state)
+        if best is None:
+            return None
+
+        order = []
+        state = best[1]
+        while state is not None:
+            order.append(window[state[1]])
+            state = parents.get(state)
+        order.reverse()
+        return order
+
+    def _time_window(self, cache, s, w, start_time, loads):
+        route = cache.route
+        tour = route.tour
+        n = len(tour)
+        window = tour[s:s + w]
+        store_bit = WindowOptimizer._store_bits(window)
+        successor_index = s + w
+
+        def violates(node, position, mask):
+            if not isinstance(node, Job):
+                return False
+            store = cache.store_of.get(id(node))
+            if store is None:
+                return False
+            bit = store_bit.get(id(store))
+            if bit is not None:
+                return not mask & bit
+            return cache.position[id(store)] > position
+
+        def step(label, v, position, previous, mask):
+            node = window[v]
+            time, deviation = cache._visit(node, previous, position, n - 1, violates(node, position, mask), label[1])
+            return label[0] + deviation ** 2, time
+
+        def future(last, time):
+            if successor_index >= n:
+                return 0
+            successor = tour[successor_index]
+            time, deviation = cache._visit(successor, window[last], successor_index, n - 1,
+                                           violates(successor, successor_index, (1 << w) - 1), time)
+            delta = time - cache.departure[successor_index]
+            r = successor_index + 1
+            return deviation ** 2 + cache.prefix_square[n] - cache.prefix_square[r] + \
+                2 * delta * (cache.prefix_deviation[n] - cache.prefix_deviation[r]) + (n - r) * delta ** 2
+
+        def peak(previous_peak, mask):
+            return previous_peak if loads is None else max(previous_peak, loads[2][mask])
+
+        # the score of the window and the rest of the route. The labels pay the excess load above the limit only, the
+        # excess up to the limit is the same for every order of the window.
+        if loads is None:
+            limit = 0
+            upper_bound = cache.score - cache.prefix_square[s] - TimeEvaluator.capacity_penalty * cache.loads.excess
+        else:
+            limit = loads[1]
+            upper_bound = cache.score - cache.prefix_square[s] - \
+                TimeEvaluator.capacity_penalty * (limit - cache.loads.capacity)
+        epsilon = 1e-9 * max(1.0, abs(upper_bound))
+        predecessor = tour[s - 1] if s > 0 else route.deliverer()
+
+        # a label is (score, time, parent label, node index, largest load of the path)
+        layer = {}
+        for v in range(w):
+            score, time = step((0, start_time), v, s, predecessor, 0)
+            first_peak = peak(limit, 1 << v)
+            score += TimeEvaluator.capacity_penalty * (first_peak - limit)
+            if score < upper_bound - epsilon:
+                layer[(1 << v, v)] = [(score, time, None, v, first_peak)]
+        for k in range(1, w):
+            next_layer = {}
+            for (mask, last), labels in layer.items():
+                for v in range(w):
+                    if mask & (1 << v):
+                        continue
+                    for label in labels:
+                        score, time = step(label, v, s + k, window[last], mask)
+                        new_peak = peak(label[4], mask | (1 << v))
+                        score += TimeEvaluator.capacity_penalty * (new_peak - label[4])
+                        if score >= upper_bound - epsilon:
+                            continue
+                        next_layer.setdefault((mask | (1 << v), v), []).append((score, time, label, v, new_peak))
+            for state, labels in next_layer.items():
+                labels.sort(key=lambda item: item[0])
+                del labels[self.max_labels:]
+            layer = next_layer
+
+        best = None
+        for (mask, last), labels in layer.items():
+            for label in labels:
+                total = label[0] + future(last, label[1])
+                if total < upper_bound - epsilon and (best is None or total < best[0]):
+                    best = (total, label)
+        if best is None:
+            return None
+
+        order = []
+        label = best[1]
+        while label is not None:
+            order.append(window[label[3]])
+            label = label[2]
+        order.reverse()
+        return order
+
+    @staticmethod
+    def _window_loads(profile, s, w):
+        """"
+        Returns (load before the window, limit, the load after the nodes of every bit mask of the window) for the
+        capacity penalty, see LoadProfile. Up to the limit, the capacity of the driver or the largest load outside the
+        window, an order of the window adds no excess load. None when no order of the window can exceed the limit.
+        """
+        if profile.capacity is None:
+            return None
+        n = len(profile.load)
+        before = profile.load_before(s)
+        changes = [profile.change[id(node)] for node in profile.route.tour[s:s + w]]
+        # the load after the last node of the window is the same for every order
+        limit = max(profile.capacity, profile.range_max(s + w - 1, n))
+        if s > 0:
+            limit = max(limit, profile.range_max(0, s))
+        if before + sum(change for change in changes if change > 0) <= limit:
+            return None
+        mask_load = [before] * (1 << w)
+        for mask in range(1, 1 << w):
+            lowest = mask & -mask
+            mask_load[mask] = mask_load[mask ^ lowest] + changes[lowest.bit_length() - 1]
+        return before, limit, mask_load
+
+    @staticmethod
+    def _store_bits(window):
+        """"
+        Maps the stores in the window to their bit. Stores visited once are mapped by store id, store copies of a
+        relaxed route by object.
+        """
+        bits = {}
+        for v in range(len(window)):
+            node = window[v]
+            if isinstance(node, Store):
+                if node.get_job() is not None:
+                    bits[id(node)] = 1 << v
+                else:
+                    bits[node.id] = 1 << v
+        return bits
@@ -0,0 +1,246 @@
+from src.checkpoint import write_atomically
+from src.domain import Route
+from src.evaluators import base_evaluator
+import hashlib
+import logging
+import os
+import pickle
+import random
+
+
+class EliteArchive:
+    """"
+    A bounded pool of good and diverse routes, kept over restarts and runs, from which new searches are seeded by
+    path relinking or crossover of two elite routes instead of from a random route.
+
+    Routes are deduplicated by Route.route_hash. The distance between two routes is the broken pairs distance: the
+    fraction of the successions (a, b) of one tour that are not in the other, 0 for equal tours and 1 for tours that
+    share no edge. A route closer than min_distance to an elite route competes with that route only, so the pool does
+    not fill up with variants of the same route. Otherwise a route enters a full pool by replacing the worst route.
+
+    The elite routes are kept as tuples of Route.node_key, the same node keys of the checkpoints, so the pool can be
+    pickled, saved, sent to worker processes (see state and merge) and built back into routes of any template route of
+    the same problem. A saved archive is keyed by its problem, see problem_key, the routes of an archive of another
+    problem are not loaded.
+    """
+    def __init__(self, size=10, min_distance=0.1, driver_ends_at_start=True, seed=0):
+        """"
+        :param: size: int maximum number of elite routes
+        :param: min_distance: float broken pairs distance below which two routes count as the same region
+        :param: seed: int seed of the selection of the parents
+        """
+        self.size = size
+        self.min_distance = min_distance
+        self.driver_ends_at_start = driver_ends_at_start
+        self.rand = random.Random(seed)
+        # dicts with the score, hash, node keys and edges of a route
+        self.entries = []
+        # the problem_key of the routes, known from the first route that is added or loaded
+        self.key = None
+        self.statistics = {'added': 0, 'duplicates': 0, 'too_close': 0, 'rejected': 0, 'relinked': 0, 'crossed': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, route, score=None):
+        """"
+        Offers a route to the archive, returns True if it was added
+        """
+        if score is None:
+            score = route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        if self.key is None:
+            self.key = EliteArchive.problem_key(route)
+        return self._add(score, route.route_hash(), tuple(Route.node_key(node) for node in route.tour))
+
+    def _add(self, score, route_hash, keys):
+        for entry in self.entries:
+            if entry['hash'] == route_hash:
+                self.statistics['duplicates'] += 1
+                return False
+        edges = EliteArchive._edges(keys)
+        closest = None
+        closest_distance = float('inf')
+        for entry in self.entries:
+            distance = EliteArchive._distance(edges, entry['edges'], len(keys))
+            if distance < closest_distance:
+                closest = entry
+                closest_distance = distance
+        entry = {'score': score, 'hash': route_hash, 'keys': keys, 'edges': edges}
+        if closest is not None and closest_distance < self.min_distance:
+            if score >= closest['score']:
+                self.statistics['too_close'] += 1
+                return False
+            self.entries.remove(closest)
+        elif len(self.entries) >= self.size:
+            worst = max(self.entries, key=lambda item: item['score'])
+            if score >= worst['score']:
+                self.statistics['rejected'] += 1
+                return False
+            self.entries.remove(worst)
+        self.entries.append(entry)
+        self.entries.sort(key=lambda item: item['score'])
+        self.statistics['added'] += 1
+        return True
+
+    def best(self, template):
+        """"
+        Returns the score and the route of the best elite route, as a route of the template, or None
+        """
+        if not self.entries:
+            return None
+        return self.entries[0]['score'], self.route(self.entries[0]['keys'], template)
+
+    def routes(self, template):
+        """"
+        Returns the (score, route) of all elite routes, the best first
+        """
+        return [(entry['score'], self.route(entry['keys'], template)) for entry in self.entries]
+
+    def route(self, keys, template):
+        """"
+        Builds a route of the template route with the tour of the node keys
+        """
+        nodes = {Route.node_key(node): node for node in template.tour}
+        route = template.copy()
+        route.tour = [nodes[node_key] for node_key in keys]
+        return route
+
+    def seed(self, template, relink_probability=0.5, rand=None):
+        """"
+        Returns a route to start a search from: the best intermediate route of a path relinking or the child of a
+        crossover of two elite routes, or the only elite route, or None when the archive is empty. The first parent is
+        picked by a binary tournament on the score, the second uniformly from the others.
+
+        :param: rand: random.Random optional, the random state of the archive when not given. A run that has to give
+        the same start solution again, e.g. after a resume, passes its own.
+        """
+        rand = self.rand if rand is None else rand
+        if not self.entries:
+            return None
+        if len(self.entries) == 1:
+            return self.route(self.entries[0]['keys'], template)
+        first = min(rand.sample(self.entries, 2), key=lambda item: item['score'])
+        second = rand.choice([entry for entry in self.entries if entry is not first])
+        if rand.random() < relink_probability:
+            return self.relink(first['keys'], second['keys'], template)[1]
+        return self.crossover(first['keys'], second['keys'], template, rand)[1]
+
+    def relink(self, source, guide, template):
+        """"
+        Walks from the source tour to the guide tour, every step swaps the node of the guide into the first position
+        where both differ. Returns the score and the route of the best intermediate tour, repaired for precedence,
+        see Route.fix_infeasibilities. Both tours are node key tuples, the intermediate tours are evaluated in full,
+        so O(n^2) for n nodes.
+        """
+        self.statistics['relinked'] += 1
+        current = list(source)
+        guide = list(guide)
+        positions = {current[i]: i for i in range(len(current))}
+        nodes = {Route.node_key(node): node for node in template.tour}
+        route = template.copy()
+        best_score = float('inf')
+        best_route = None
+        for i in range(len(current)):
+            if current[i] == guide[i]:
+                continue
+            j = positions[guide[i]]
+            positions[current[i]] = j
+            positions[guide[i]] = i
+            current[i], current[j] = current[j], current[i]
+            if current == guide:
+                break
+            route.tour = [nodes[node_key] for node_key in current]
+            route.fix_infeasibilities()
+            score = route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+            if score < best_score:
+                best_score = score
+                best_route = route.copy()
+        if best_route is None:
+            best_route = self.route(source, template)
+            best_score = best_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        return best_score, best_route
+
+    def crossover(self, first, second, template, rand=None):
+        """"
+        Order crossover (OX) of two node key tuples: a random slice of the first tour keeps its positions, the other
+        positions get the remaining nodes in the order of the second tour. Returns the score and the route of the
+        child, repaired for precedence.
+        """
+        rand = self.rand if rand is None else rand
+        self.statistics['crossed'] += 1
+        n = len(first)
+        i = rand.randint(0, n - 1)
+        j = rand.randint(i, n - 1)
+        kept = set(first[i:j + 1])
+        rest = [node_key for node_key in second if node_key not in kept]
+        child = rest[:i] + list(first[i:j + 1]) + rest[i:]
+        route = self.route(child, template)
+        route.fix_infeasibilities()
+        return route.evaluate(end_with_start_loc=self.driver_ends_at_start), route
+
+    def state(self):
+        """"
+        Returns the elite routes as plain values, to save them or to send them to another process
+        """
+        return [(entry['score'], entry['keys']) for entry in self.entries]
+
+    def merge(self, state, template):
+        """"
+        Offers the routes of the state of another archive, e.g. of a worker process or an earlier run. Returns the
+        number of routes added. A route with a node that is not in the template is skipped.
+        """
+        nodes = {Route.node_key(node) for node in template.tour}
+        added = 0
+        for score, keys in state:
+            if len(keys) != len(nodes) or any(node_key not in nodes for node_key in keys):
+                self.statistics['rejected'] += 1
+                continue
+            if self._add(score, self.route(keys, template).route_hash(), tuple(keys)):
+                added += 1
+        return added
+
+    def save(self, file_name):
+        """"
+        Writes the state atomically, see checkpoint.write_atomically
+        """
+        saved = {'key': self.key, 'routes': self.state()}
+        write_atomically(file_name, lambda outfile: pickle.dump(saved, outfile, protocol=pickle.HIGHEST_PROTOCOL),
+                         prefix='.elite_')
+
+    def load(self, file_name, template):
+        """"
+        Merges the state saved in a file, returns the number of routes added. A file of another problem than the
+        template is ignored.
+        """
+        key = EliteArchive.problem_key(template)
+        if self.key is None:
+            self.key = key
+        if not os.path.exists(file_name):
+            return 0
+        with open(file_name, 'rb') as infile:
+            saved = pickle.load(infile)
+        if not isinstance(saved, dict) or saved.get('key') != key:
+            logging.warning('Ignoring elite routes of another problem in %s', file_name)
+            return 0
+        return self.merge(saved['routes'], template)
+
+    @staticmethod
+    def problem_key(route):
+        """"
+        Returns a digest of the problem of a route: the driver, the evaluator and the node keys and locations of its
+        nodes. Scores of elite routes are only comparable within one problem.
+        """
+        nodes = sorted(repr((Route.node_key(node), node.location)) for node in route.tour)
+        return hashlib.blake2b(repr((route.deliverer().id, route.deliverer().location,
+                                     base_evaluator(route.evaluator).__name__, nodes)).encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    @staticmethod
+    def _edges(keys):
+        return set(zip(keys, keys[1:]))
+
+    @staticmethod
+    def _distance(edges, other_edges, n):
+        if n < 2:
+            return 0.0
+        return 1.0 - len(edges & other_edges) / float(n - 1)
@@ -1,29 +1,45 @@
 from src.domain import Route
-from src.evaluators import DistanceEvaluator
+from src.evaluators import DistanceEvaluator, TimeEvaluator, TimeWindowCache, DistanceCache, CachedEvaluator, \
+    base_evaluator
+import heapq
 import random
 from collections import deque
 from src.locations import Store, Job
+from src.progress import Incumbent, SweepFinished, PhaseTiming, Statistics, Note, sink_or_default
 import time
 
 
 class HillClimbing:
+    operators = ['swap', 'two_opt', 'relocate_pair', 'or_opt']
+
     def __init__(self, jobs, stores, deliverers, distances_matrix, evaluator, codec, driver_ends_at_start=True,
-                 route_initialization_method="random"):
+                 route_initialization_method="random", evaluation_cache=None, checkpoint=None, progress=None):
         """"
         Initialzies a hill climbing object
 
         :param: driver_ends_at_start: boolean Driver returns the starting position to close loop
         :param: route_initialization_method: String options: 'random', 'relaxed_random', 'GRASP', 'greedy'
+        :param: evaluation_cache: evaluators.EvaluationCache optional cache shared by all evaluations of this solver
+        :param: checkpoint: checkpoint.Checkpoint optional, the progress of solve is saved after every iteration and
+        a run with the same parameters and initial solution continues from the saved iteration
+        :param: progress: progress.ProgressSink optional sink of the progress events, progress.default_sink() when not
+        given
         """
         self.jobs = jobs
         self.stores = stores
         self.deliverers = deliverers
         self.distances_matrix = distances_matrix
+        self.evaluation_cache = evaluation_cache
+        if evaluation_cache is not None:
+            evaluator = CachedEvaluator(evaluator, evaluation_cache)
         self.evaluator = evaluator
         self.solution = None
         self.codec = codec
         self.driver_ends_at_start = driver_ends_at_start
         self.route_initialization_method = route_initialization_method
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.statistics = HillClimbing._empty_statistics()
 
     def generate_initial_solution(self, nr_iterations=2000, use_seed=False, seed=1):
         """"
@@ -52,34 +68,66 @@ class HillClimbing:
         self.solution = best_route
         return best_score, best_route
 
-    def _solve_with_time_windows(self, tabu=False, tabu_size=5, nr_iterations=5, allow_infeasibilites=False):
-        if tabu:
-            tabu_list = deque(maxlen=tabu_size)
-        seed = 1000
+    def _solve_with_time_windows(self, tabu=False, tabu_size=5, nr_iterations=5, allow_infeasibilites=False, seed=1000,
+                                 swap_probability=0.5, time_horizon=None, dont_look_bits=False):
+        tabu_list = deque(maxlen=tabu_size) if tabu else None
         init_route = self.solution.copy()
         rand = random.Random(seed)
         iteration_found_best_sol = None
         best_score = init_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
         best_route = init_route
-
-
-        for i in range(nr_iterations):
-
-            pairs = init_route.generate_location_pairs(seed)
+        self.statistics = HillClimbing._empty_statistics()
+        progress = sink_or_default(self.progress)
+        started = time.perf_counter()
+        key = self._progress_key(('time_windows', tabu, tabu_size, nr_iterations, allow_infeasibilites, seed,
+                                  swap_probability, time_horizon, dont_look_bits))
+        # only the pairs of which the second location starts its time window first are tried, they are generated
+        # once from the locations sorted by the start of their time window
+        candidates = init_route.generate_time_window_pairs(time_horizon)
+        dont_look = DontLookBits(candidates) if dont_look_bits else None
+        start_iteration, saved = self._load_progress(key, init_route, rand, tabu_list, dont_look=dont_look)
+        if saved is not None:
+            seed, best_route, best_score, iteration_found_best_sol = saved
+        # the cache scores candidate moves without copying and re-evaluating the whole route. Only moves that look
+        # like an improvement are applied to a copy and evaluated in full.
+        cache = None
+        if base_evaluator(self.evaluator) is TimeEvaluator:
+            cache = TimeWindowCache(best_route)
+
+        for i in range(start_iteration, nr_iterations):
+
+            if dont_look is not None:
+                if not dont_look.active:
+                    break
+                pairs = dont_look.sweep()
+            else:
+                pairs = list(candidates)
             rand.shuffle(pairs)
             seed += 1
             nr_iterations_no_changes = 0
             for pair in pairs:
                 loc1 = pair[0]
                 loc2 = pair[1]
+                swap = rand.random() >= 1 - swap_probability
+                # a pair is not tried again until its locations change, so with don't look bits both moves are tried
+                moves = (swap, not swap) if dont_look is not None else (swap,)
+                for swap in moves:
+                    self.statistics['candidates'] += 1
+                    if cache is not None:
+                        index1 = cache.index_of(loc1)
+                        index2 = cache.index_of(loc2)
+                        if swap:
+                            estimate = cache.swap_score(index1, index2)
+                        else:
+                            estimate = cache.two_opt_score(index1, index2)
+                        if not HillClimbing.may_improve(estimate, best_score):
+                            self.statistics['pruned'] += 1
+                            continue
 
-                time_start_loc_1 = HillClimbing.get_time_start(loc1)
-                time_start_loc_2 = HillClimbing.get_time_start(loc2)
-
-                if time_start_loc_2 < time_start_loc_1:
+                    self.statistics['evaluated'] += 1
                     temp_route = best_route.copy()
                     # temp_route.two_opt_move(pair[0], pair[1])
-                    if random.random() >= 0.5:
+                    if swap:
                         temp_route.swap_destinations_time_window(pair[0], pair[1])
                     else:
                         temp_route.two_opt_move_time_window(pair[0], pair[1])
@@ -90,22 +138,261 @@ class HillClimbing:
                             if temp_score not in tabu_list: #make solution tabu
                             # for item in pair: #make move tabu
                             #     if item not in tabu_list:
+                                    if dont_look is not None:
+                                        dont_look.changed(best_route.tour, temp_route.tour)
                                     best_route = temp_route
                                     best_score = temp_score
                                     tabu_list.append(temp_score)
                                     # tabu_list.extend(pair)
                                     iteration_found_best_sol = i
+                                    if cache is not None:
+                                        cache.update(best_route)
+                                    if progress.enabled:
+                                        progress.emit(Incumbent('hill_climbing', i, best_score))
 
                         else:
+                            if dont_look is not None:
+                                dont_look.changed(best_route.tour, temp_route.tour)
                             best_route = temp_route
                             best_score = temp_score
-
-            print('best score', best_score)
+                            if cache is not None:
+                                cache.update(best_route)
+                            if progress.enabled:
+                                progress.emit(Incumbent('hill_climbing', i, best_score))
+
+            if progress.enabled:
+                progress.emit(self._sweep_finished(i, best_score))
+            self._save_progress(key, i + 1, seed, best_route, best_score, iteration_found_best_sol, rand, tabu_list,
+                                dont_look=dont_look)
         # print(best_score, iteration_found_best_sol, best_route )
+        self._print_statistics(progress, started)
+
+        return best_score, best_route, iteration_found_best_sol
 
+    def _solve_adaptive(self, with_time_windows=False, tabu=False, tabu_size=5, nr_iterations=5,
+                        allow_infeasibilites=False, seed=1000, operator_weights=None):
+        """"
+        Runs the local search with all operators: swap, 2-opt, pick up and delivery pair relocation and or-opt. The
+        operator for every candidate is chosen by an OperatorSelector that favours the operators with the most
+        recent success per unit of time. Every move is scored by the incremental cache of the evaluator first, only
+        moves that look like an improvement are applied to a copy and evaluated in full. Without allow_infeasibilites
+        a move that breaks the precedence is scored after the repair, see move_score.
+        """
+        tabu_list = deque(maxlen=tabu_size) if tabu else None
+        init_route = self.solution.copy()
+        rand = random.Random(seed)
+        iteration_found_best_sol = None
+        best_score = init_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        best_route = init_route
+        selector = OperatorSelector(HillClimbing.operators, rand, prior=operator_weights)
+        self.statistics = HillClimbing._empty_statistics()
+        progress = sink_or_default(self.progress)
+        started = time.perf_counter()
+        key = self._progress_key(('adaptive', with_time_windows, tabu, tabu_size, nr_iterations, allow_infeasibilites,
+                                  seed, operator_weights))
+        start_iteration, saved = self._load_progress(key, init_route, rand, tabu_list, selector)
+        if saved is not None:
+            seed, best_route, best_score, iteration_found_best_sol = saved
+        cache = route_cache(best_route, self.driver_ends_at_start)
+        requests = HillClimbing._requests(init_route)
+        groups = self._repair_groups(init_route, with_time_windows, allow_infeasibilites)
+
+        for i in range(start_iteration, nr_iterations):
+            pairs = init_route.generate_location_pairs(seed)
+            rand.shuffle(pairs)
+            seed += 1
+            for pair in pairs:
+                operator = selector.select()
+                start = time.perf_counter()
+                improved = False
+                move = HillClimbing._make_move(operator, pair, cache, requests, rand)
+                self.statistics['candidates'] += 1
+                if move is not None and HillClimbing.may_improve(move_score(cache, move, groups), best_score):
+                    self.statistics['evaluated'] += 1
+                    temp_route = best_route.copy()
+                    temp_route.apply_move(move)
+                    temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                    if not with_time_windows and not allow_infeasibilites and temp_score > 1000:
+                        temp_route.fix_infeasibilities(self.codec)
+                        temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                    if temp_score < best_score:
+                        tabu_key = temp_score if with_time_windows else pair
+                        if not tabu or tabu_key not in tabu_list:
+                            best_route = temp_route
+                            best_score = temp_score
+                            iteration_found_best_sol = i
+                            improved = True
+                            cache.update(best_route)
+                            if tabu:
+                                tabu_list.append(tabu_key)
+                            if progress.enabled:
+                                progress.emit(Incumbent('hill_climbing', i, best_score))
+                else:
+                    self.statistics['pruned'] += 1
+                selector.update(operator, improved, time.perf_counter() - start)
+
+            if progress.enabled:
+                progress.emit(self._sweep_finished(i, best_score))
+            self._save_progress(key, i + 1, seed, best_route, best_score, iteration_found_best_sol, rand, tabu_list,
+                                selector)
+        self._print_statistics(progress, started)
+        if progress.enabled:
+            progress.emit(Statistics('hill_climbing', 'operator weights', selector.probabilities()))
         return best_score, best_route, iteration_found_best_sol
 
-    def solve(self, with_time_windows=False, tabu=False, tabu_size=5, nr_iterations=5, allow_infeasibilites=False):
+    def _solve_best_improvement(self, with_time_windows=False, tabu=False, tabu_size=5, nr_iterations=5,
+                                allow_infeasibilites=False, seed=1000, adaptive_operators=False, workers=1,
+                                time_horizon=None):
+        """"
+        Best improvement local search: every iteration scores all candidate moves of a sweep against the same snapshot
+        of the incumbent and applies the best move that is not tabu. For every pair of locations a swap and a 2-opt move
+        are candidates, with adaptive_operators also a pair relocation and an or-opt move. The moves are scored by the
+        incremental cache of the evaluator in chunks, in parallel when workers > 1, see ParallelSweep. The best
+        candidates are evaluated in full in order until one improves, so the result does not depend on the number of
+        workers. When none of them is accepted the number of candidates doubles, until one is or the estimates can no
+        longer improve.
+
+        Moves on tabu pairs are left out before scoring. Without allow_infeasibilites a move that breaks the precedence
+        is ranked by its score after the repair, see move_score.
+        """
+        tabu_list = deque(maxlen=tabu_size) if tabu else None
+        init_route = self.solution.copy()
+        rand = random.Random(seed)
+        iteration_found_best_sol = None
+        best_score = init_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+        best_route = init_route
+        self.statistics = HillClimbing._empty_statistics()
+        progress = sink_or_default(self.progress)
+        started = time.perf_counter()
+        key = self._progress_key(('best_improvement', with_time_windows, tabu, tabu_size, nr_iterations,
+                                  allow_infeasibilites, seed, adaptive_operators, time_horizon))
+        start_iteration, saved = self._load_progress(key, init_route, rand, tabu_list)
+        if saved is not None:
+            seed, best_route, best_score, iteration_found_best_sol = saved
+        operators = HillClimbing.operators if adaptive_operators else ['swap', 'two_opt']
+        requests = HillClimbing._requests(init_route)
+        # as in _solve_with_time_windows, only locations whose time windows are out of order are moved
+        candidates = init_route.generate_time_window_pairs(time_horizon) if with_time_windows else None
+        groups = self._repair_groups(init_route, with_time_windows, allow_infeasibilites)
+
+        with ParallelSweep(init_route, self.driver_ends_at_start, workers=workers, groups=groups) as sweep:
+            for i in range(start_iteration, nr_iterations):
+                pairs = init_route.generate_location_pairs(seed) if candidates is None else list(candidates)
+                rand.shuffle(pairs)
+                seed += 1
+                cache = sweep.snapshot(best_route)
+                moves = []
+                move_pairs = []
+                for pair in pairs:
+                    # the tabu key of a distance move is its pair, a tabu pair is no candidate
+                    if tabu and not with_time_windows and pair in tabu_list:
+                        continue
+                    for operator in operators:
+                        move = HillClimbing._make_move(operator, pair, cache, requests, rand)
+                        if move is not None:
+                            moves.append(move)
+                            move_pairs.append(pair)
+                self.statistics['candidates'] += len(moves)
+
+                nr_candidates = sweep.nr_candidates
+                nr_tried = 0
+                done = False
+                while not done:
+                    ranked = sweep.best_moves(moves, nr_candidates)
+                    # every move is ranked, or the next ones can not improve
+                    done = len(ranked) < nr_candidates
+                    for estimate, m in ranked[nr_tried:]:
+                        if not HillClimbing.may_improve(estimate, best_score):
+                            done = True
+                            break
+                        self.statistics['evaluated'] += 1
+                        temp_route = best_route.copy()
+                        temp_route.apply_move(moves[m])
+                        temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                        if not with_time_windows and not allow_infeasibilites and temp_score > 1000:
+                            temp_route.fix_infeasibilities(self.codec)
+                            temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                        tabu_key = temp_score if with_time_windows else move_pairs[m]
+                        if temp_score < best_score and (not tabu or tabu_key not in tabu_list):
+                            best_route = temp_route
+                            best_score = temp_score
+                            iteration_found_best_sol = i
+                            if tabu:
+                                tabu_list.append(tabu_key)
+                            if progress.enabled:
+                                progress.emit(Incumbent('hill_climbing', i, best_score))
+                            done = True
+                            break
+                    nr_tried = len(ranked)
+                    nr_candidates *= 2
+                self.statistics['pruned'] = self.statistics['candidates'] - self.statistics['evaluated']
+
+                if progress.enabled:
+                    progress.emit(self._sweep_finished(i, best_score))
+                self._save_progress(key, i + 1, seed, best_route, best_score, iteration_found_best_sol, rand,
+                                    tabu_list)
+        self._print_statistics(progress, started)
+        return best_score, best_route, iteration_found_best_sol
+
+    def _repair_groups(self, route, with_time_windows, allow_infeasibilites):
+        """"
+        Returns the store groups that a move that breaks the precedence is repaired with, see Route.repair_tour, or None
+        when moves are not repaired
+        """
+        if with_time_windows or allow_infeasibilites or base_evaluator(self.evaluator) is not DistanceEvaluator:
+            return None
+        if self.codec is not None:
+            return self.codec.groups()
+        return route.store_groups()
+
+    @staticmethod
+    def _requests(route):
+        """"
+        Returns the requests (store, job) of the route by the id of their store and of their job
+        """
+        requests = {}
+        for pair in route.request_pairs():
+            requests.setdefault(id(pair[0]), []).append(pair)
+            requests[id(pair[1])] = [pair]
+        return requests
+
+    @staticmethod
+    def _make_move(operator, pair, cache, requests, rand):
+        """"
+        Turns a pair of locations into a move for the given operator, see evaluators.RouteCache. Returns None if the
+        operator has no move for this pair.
+        """
+        index1 = cache.index_of(pair[0])
+        index2 = cache.index_of(pair[1])
+        if index1 is None or index2 is None:
+            return None
+        if operator == 'swap':
+            return 'swap', min(index1, index2), max(index1, index2)
+        if operator == 'two_opt':
+            return 'two_opt', min(index1, index2), max(index1, index2)
+        if operator == 'relocate_pair':
+            # the request of the first location is put around the second location
+            if id(pair[0]) not in requests:
+                return None
+            store, job = rand.choice(requests[id(pair[0])])
+            if pair[1] is store or pair[1] is job:
+                return None
+            store_index = cache.index_of(store)
+            job_index = cache.index_of(job)
+            target = index2 - (store_index < index2) - (job_index < index2)
+            return 'relocate_pair', store_index, job_index, target, target + 1
+        if operator == 'or_opt':
+            # a segment of up to three locations starting at the first location is put before the second location
+            length = min(rand.randint(1, 3), len(cache.route.tour) - index1)
+            if index1 <= index2 < index1 + length:
+                return None
+            target = index2 if index2 < index1 else index2 - length
+            return 'or_opt', index1, length, target, rand.random() < 0.5
+        raise TypeError('Unknown operator ' + str(operator))
+
+    def solve(self, with_time_windows=False, tabu=False, tabu_size=5, nr_iterations=5, allow_infeasibilites=False,
+              adaptive_operators=False, seed=1000, swap_probability=0.5, operator_weights=None,
+              best_improvement=False, workers=1, time_horizon=None, dont_look_bits=False):
         """"
         Runs the Hill Climbing algorithm. The local search in this algorithm uses both a 2-opt move and a regular swap to change
         positions of two locations in the route. A random value form a uniform distirbution is used to pick the move.
@@ -115,57 +402,256 @@ class HillClimbing:
         :param: tabu: boolean run with or without tabu list
         :param: tabu_size: int the tabu list size
         :param: allow_infeasibilites: boolean allowing infeasibilities will help the algorith to escape local optima but there is chance it will return infeasible solutions
+        :param: adaptive_operators: boolean also use pair relocation and or-opt moves, picked by adaptive operator selection
+        :param: seed: int seed of the order in which the location pairs are tried
+        :param: swap_probability: float probability of trying a swap instead of a 2-opt move
+        :param: operator_weights: dict optional prior weight per operator for the adaptive operator selection
+        :param: best_improvement: boolean apply the best move of every sweep instead of every improving move
+        :param: workers: int number of processes that score the moves of a best improvement sweep
+        :param: time_horizon: float optional, with time windows only pairs of locations whose time windows start at most
+        this many seconds apart are tried
+        :param: dont_look_bits: boolean after the first sweep only try the pairs of locations next to the changes of the
+        accepted moves, see DontLookBits. Stops early when nothing changed in a sweep. Not for the adaptive and best
+        improvement modes.
 
         """
+        if best_improvement:
+            return self._solve_best_improvement(with_time_windows=with_time_windows, tabu=tabu, tabu_size=tabu_size,
+                                                nr_iterations=nr_iterations,
+                                                allow_infeasibilites=allow_infeasibilites, seed=seed,
+                                                adaptive_operators=adaptive_operators, workers=workers,
+                                                time_horizon=time_horizon)
+        if adaptive_operators:
+            return self._solve_adaptive(with_time_windows=with_time_windows, tabu=tabu, tabu_size=tabu_size,
+                                        nr_iterations=nr_iterations, allow_infeasibilites=allow_infeasibilites,
+                                        seed=seed, operator_weights=operator_weights)
         if with_time_windows:
-            return self._solve_with_time_windows(tabu=tabu, nr_iterations=nr_iterations, allow_infeasibilites=allow_infeasibilites )
+            return self._solve_with_time_windows(tabu=tabu, tabu_size=tabu_size, nr_iterations=nr_iterations,
+                                                 allow_infeasibilites=allow_infeasibilites, seed=seed,
+                                                 swap_probability=swap_probability, time_horizon=time_horizon,
+                                                 dont_look_bits=dont_look_bits)
         else:
-            if tabu:
-                tabu_list = deque(maxlen=tabu_size)
-            seed = 1000
+            tabu_list = deque(maxlen=tabu_size) if tabu else None
             init_route = self.solution.copy()
             rand = random.Random(seed)
             iteration_found_best_sol = None
             best_score = init_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
             best_route = init_route
+            self.statistics = HillClimbing._empty_statistics()
+            progress = sink_or_default(self.progress)
+            started = time.perf_counter()
+            key = self._progress_key(('distance', tabu, tabu_size, nr_iterations, allow_infeasibilites, seed,
+                                      swap_probability, dont_look_bits))
+            # the pairs are generated with the seed the run started with, also when it resumes from a checkpoint
+            dont_look = DontLookBits(init_route.generate_location_pairs(seed)) if dont_look_bits else None
+            start_iteration, saved = self._load_progress(key, init_route, rand, tabu_list, dont_look=dont_look)
+            if saved is not None:
+                seed, best_route, best_score, iteration_found_best_sol = saved
+            # moves are screened with the exact distance and violation change of the touched positions. A move whose
+            # score can not beat the incumbent is pruned without copying the route. When infeasible candidates are
+            # repaired the repaired score is unknown, so only moves that stay feasible can be pruned.
+            cache = None
+            groups = None
+            if base_evaluator(self.evaluator) is DistanceEvaluator:
+                cache = DistanceCache(best_route, self.driver_ends_at_start)
+                if self.codec is not None:
+                    groups = self.codec.groups()
+                else:
+                    groups = best_route.store_groups()
 
             nr_iterations_no_changes = 0
-            for i in range(nr_iterations):
-                pairs = init_route.generate_location_pairs(seed)
+            for i in range(start_iteration, nr_iterations):
+                if dont_look is not None:
+                    if not dont_look.active:
+                        break
+                    pairs = dont_look.sweep()
+                else:
+                    pairs = init_route.generate_location_pairs(seed)
                 rand.shuffle(pairs)
                 seed += 1
 
                 for pair in pairs:
-                    temp_route = best_route.copy()
-                    # temp_route.two_opt_move(pair[1], pair[0])
-                    if random.random() >= 0.5:
-                        temp_route.two_opt_move(pair[1], pair[0])
-                    else:
-                        temp_route.swap_destinations(pair[0], pair[1])
-                    temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
-                    if not allow_infeasibilites and temp_score > 1000:
-                        temp_route.fix_infeasibilities(self.codec, find_all_occurences=False)
-                        temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
-                    if temp_score < best_score:
-                        if tabu:
-                            # if temp_score not in tabu_list:
-                            for item in pair:
-                                if item not in tabu_list:
-                                    best_route = temp_route
-                                    best_score = temp_score
-                                    # tabu_list.append(temp_score)
-                                    tabu_list.extend(pair)
-                                    iteration_found_best_sol = i
-                                    nr_iterations_no_changes = 0
-                                else:
-                                    nr_iterations_no_changes +=1
+                    two_opt = rand.random() >= swap_probability
+                    moves = (two_opt, not two_opt) if dont_look is not None else (two_opt,)
+                    for two_opt in moves:
+                        self.statistics['candidates'] += 1
+                        if cache is not None and self._prune(cache, pair, two_opt, best_score, allow_infeasibilites,
+                                                             groups):
+                            self.statistics['pruned'] += 1
+                            continue
+
+                        self.statistics['evaluated'] += 1
+                        temp_route = best_route.copy()
+                        # temp_route.two_opt_move(pair[1], pair[0])
+                        if two_opt:
+                            temp_route.two_opt_move(pair[1], pair[0])
                         else:
-                            best_route = temp_route
-                            best_score = temp_score
-
-                print('best score', best_score)
+                            temp_route.swap_destinations(pair[0], pair[1])
+                        temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                        if not allow_infeasibilites and temp_score > 1000:
+                            temp_route.fix_infeasibilities(self.codec, find_all_occurences=False)
+                            temp_score = temp_route.evaluate(end_with_start_loc=self.driver_ends_at_start)
+                        if temp_score < best_score:
+                            if tabu:
+                                # if temp_score not in tabu_list:
+                                for item in pair:
+                                    if item not in tabu_list:
+                                        if dont_look is not None:
+                                            dont_look.changed(best_route.tour, temp_route.tour)
+                                        best_route = temp_route
+                                        best_score = temp_score
+                                        # tabu_list.append(temp_score)
+                                        tabu_list.extend(pair)
+                                        iteration_found_best_sol = i
+                                        nr_iterations_no_changes = 0
+                                        if progress.enabled:
+                                            progress.emit(Incumbent('hill_climbing', i, best_score))
+                                    else:
+                                        nr_iterations_no_changes +=1
+                            else:
+                                if dont_look is not None:
+                                    dont_look.changed(best_route.tour, temp_route.tour)
+                                best_route = temp_route
+                                best_score = temp_score
+                                if progress.enabled:
+                                    progress.emit(Incumbent('hill_climbing', i, best_score))
+
+                            if cache is not None and cache.route is not best_route:
+                                cache.update(best_route)
+
+                if progress.enabled:
+                    progress.emit(self._sweep_finished(i, best_score))
+                self._save_progress(key, i + 1, seed, best_route, best_score, iteration_found_best_sol, rand,
+                                    tabu_list, dont_look=dont_look)
+            self._print_statistics(progress, started)
             return best_score, best_route, iteration_found_best_sol
 
+    @staticmethod
+    def _prune(cache, pair, two_opt, best_score, allow_infeasibilites, groups):
+        """"
+        Returns True when the move on pair can not improve on best_score, based on the lower bound from the cache.
+        A candidate that will be repaired is repaired on a plain list and scored in O(n) instead.
+        """
+        index1 = cache.index_of(pair[0])
+        index2 = cache.index_of(pair[1])
+        if index1 is None or index2 is None:
+            return False
+        if two_opt:
+            bound, violations = cache.two_opt_score(index1, index2)
+        else:
+            bound, violations = cache.swap_score(index1, index2)
+        if not allow_infeasibilites and bound > DistanceEvaluator.presedence_order_penalty:
+            if two_opt:
+                tour = Route.two_opt_by_index(cache.route.tour, index1, index2)
+            else:
+                tour = list(cache.route.tour)
+                tour[index1], tour[index2] = tour[index2], tour[index1]
+            bound = cache.score_tour(Route.repair_tour(tour, groups))
+        return not HillClimbing.may_improve(bound, best_score)
+
+    def _progress_key(self, parameters):
+        """"
+        Identifies a run of solve by its parameters, the evaluator and the initial solution, see checkpoint.Checkpoint
+        """
+        if self.checkpoint is None:
+            return None
+        return repr((base_evaluator(self.evaluator).__name__, self.driver_ends_at_start) + parameters) + \
+            self.solution.content_name()
+
+    def _save_progress(self, key, iteration, seed, best_route, best_score, iteration_found_best_sol, rand, tabu_list,
+                       selector=None, dont_look=None):
+        """"
+        Saves the state of solve at the end of an iteration: the incumbent, the tabu list, the random states, the
+        counters and the active locations of the don't look bits. Nodes are saved by their Route.node_key.
+        """
+        if self.checkpoint is None:
+            return
+        state = {
+            'iteration': iteration,
+            'seed': seed,
+            'tour': [Route.node_key(node) for node in best_route.tour],
+            'best_score': best_score,
+            'iteration_found_best_sol': iteration_found_best_sol,
+            'tabu': None if tabu_list is None else [HillClimbing._tabu_state(item) for item in tabu_list],
+            'random': random.getstate(),
+            'rand': rand.getstate(),
+            'statistics': dict(self.statistics),
+            'selector': None if selector is None else (dict(selector.success), dict(selector.duration)),
+            'dont_look': None if dont_look is None else [Route.node_key(node) for node in dont_look.active]
+        }
+        self.checkpoint.set('solver', state, key=key)
+
+    def _load_progress(self, key, init_route, rand, tabu_list, selector=None, dont_look=None):
+        """"
+        Restores the saved progress of this run into the random states, the tabu list, the selector, the don't look bits
+        and the statistics. Returns the iteration to continue from and (seed, best route, best score, iteration found
+        best solution), or 0 and None when there is no progress of this run.
+        """
+        state = self.checkpoint.get('solver', key) if self.checkpoint is not None else None
+        if state is None:
+            return 0, None
+        # the saved tour refers to the nodes of the initial solution, store copies of a relaxed route included
+        nodes = {Route.node_key(node): node for node in init_route.tour}
+        best_route = init_route.copy()
+        best_route.tour = [nodes[node_key] for node_key in state['tour']]
+        if tabu_list is not None:
+            tabu_list.extend(HillClimbing._tabu_item(item, nodes) for item in state['tabu'])
+        random.setstate(state['random'])
+        rand.setstate(state['rand'])
+        self.statistics = dict(state['statistics'])
+        if selector is not None:
+            selector.success, selector.duration = dict(state['selector'][0]), dict(state['selector'][1])
+        if dont_look is not None:
+            dont_look.restore(nodes[node_key] for node_key in state['dont_look'])
+        progress = sink_or_default(self.progress)
+        if progress.enabled:
+            progress.emit(Note('hill_climbing', 'resuming from iteration ' + str(state['iteration'])))
+        return state['iteration'], (state['seed'], best_route, state['best_score'], state['iteration_found_best_sol'])
+
+    @staticmethod
+    def _tabu_state(item):
+        if isinstance(item, tuple):
+            return ('pair',) + tuple(Route.node_key(node) for node in item)
+        if isinstance(item, (Job, Store)):
+            return 'node', Route.node_key(item)
+        return 'score', item
+
+    @staticmethod
+    def _tabu_item(state, nodes):
+        if state[0] == 'pair':
+            return tuple(nodes[node_key] for node_key in state[1:])
+        if state[0] == 'node':
+            return nodes[state[1]]
+        return state[1]
+
+    @staticmethod
+    def _empty_statistics():
+        return {'candidates': 0, 'pruned': 0, 'evaluated': 0}
+
+    def _sweep_finished(self, iteration, best_score):
+        return SweepFinished('hill_climbing', iteration, best_score, self.statistics['candidates'],
+                             self.statistics['evaluated'])
+
+    def _print_statistics(self, progress, started):
+        if not progress.enabled:
+            return
+        progress.emit(PhaseTiming('hill_climbing', 'solve', time.perf_counter() - started))
+        candidates = self.statistics['candidates']
+        if candidates > 0:
+            values = dict(self.statistics)
+            values['pruned_ratio'] = round(self.statistics['pruned'] / candidates, 3)
+            progress.emit(Statistics('hill_climbing', 'moves', values))
+        if self.evaluation_cache is not None:
+            progress.emit(Statistics('hill_climbing', 'evaluation cache', self.evaluation_cache.statistics()))
+
+    @staticmethod
+    def may_improve(estimate, best_score):
+        """"
+        Returns whether an incrementally computed score could beat best_score. The estimate and the full evaluation
+        can differ in the last digits, so ties are left to the full evaluation.
+        """
+        return estimate < best_score + 1e-9 * max(1.0, abs(best_score))
+
     @staticmethod
     def get_time_start(obj):
         if isinstance(obj, Store):
@@ -177,11 +663,269 @@ class HillClimbing:
         return time_start
 
 
+class OperatorSelector:
+    def __init__(self, operators, rand, decay=0.9, min_probability=0.05, prior=None):
+        """"
+        Adaptive operator selection. The weight of an operator is its recent success per unit of time: an
+        exponentially smoothed success rate divided by an exponentially smoothed time per call. Operators are picked by
+        roulette wheel, each operator keeps at least min_probability so that it can recover.
+
+        :param: operators: list of operator names
+        :param: rand: random.Random
+        :param: decay: float weight of the history in the smoothed values
+        :param: prior: dict optional fixed weight per operator that multiplies the adaptive weight
+        """
+        self.operators = list(operators)
+        self.rand = rand
+        self.decay = decay
+        self.min_probability = min_probability
+        self.prior = prior or {}
+        self.success = {}
+        self.duration = {}
+        for operator in self.operators:
+            self.success[operator] = 1.0
+            self.duration[operator] = None
+
+    def weight(self, operator):
+        if self.duration[operator] is None:
+            return None
+        return self.success[operator] / max(self.duration[operator], 1e-9)
+
+    def probabilities(self):
+        weights = [self.weight(operator) for operator in self.operators]
+        known = [w for w in weights if w is not None]
+        # operators that have not been tried yet get the best weight so far
+        default = max(known) if len(known) > 0 else 1.0
+        weights = [(default if w is None else w) * self.prior.get(operator, 1.0)
+                   for w, operator in zip(weights, self.operators)]
+        total = sum(weights)
+        floor = self.min_probability
+        share = 1 - floor * len(self.operators)
+        probabilities = {}
+        for operator, w in zip(self.operators, weights):
+            if total > 0:
+                probabilities[operator] = floor + share * w / total
+            else:
+                probabilities[operator] = 1 / len(self.operators)
+        return probabilities
+
+    def select(self):
+        probabilities = self.probabilities()
+        value = self.rand.random()
+        for operator in self.operators:
+            value -= probabilities[operator]
+            if value <= 0:
+                return operator
+        return self.operators[-1]
+
+    def update(self, operator, improved, duration):
+        self.success[operator] = self.decay * self.success[operator] + (1 - self.decay) * (1.0 if improved else 0.0)
+        if self.duration[operator] is None:
+            self.duration[operator] = duration
+        else:
+            self.duration[operator] = self.decay * self.duration[operator] + (1 - self.decay) * duration
+
+
+class DontLookBits:
+    """"
+    Don't look bits (Bentley, 1992) with a queue of active locations for the first improvement sweeps of HillClimbing.
+    A location is active until a sweep has tried all its pairs; it becomes active again only when one of the locations
+    next to it in the tour changes by an accepted move. A sweep tries the pairs of the active locations only, so once
+    the route settles a sweep costs the changes of the previous sweep times the pairs per location instead of all
+    pairs. The bit of a location is cleared by any change next to it, also in the opposite direction, as the time
+    window objective depends on the direction of the edges.
+    """
+    def __init__(self, pairs):
+        """"
+        :param: pairs: list of (location, location), the candidate pairs, they are kept and returned by the sweeps
+        """
+        self.pairs_of = {}
+        self.active = []
+        self._queued = set()
+        for pair in pairs:
+            for node in pair:
+                if id(node) not in self.pairs_of:
+                    self.pairs_of[id(node)] = []
+                    self._activate(node)
+                self.pairs_of[id(node)].append(pair)
+
+    def _activate(self, node):
+        if id(node) not in self._queued:
+            self._queued.add(id(node))
+            self.active.append(node)
+
+    def restore(self, active):
+        """"
+        Makes exactly the given locations active, in their order, e.g. the active locations of a checkpoint
+        :param: active: iterable of locations
+        """
+        self.active = []
+        self._queued = set()
+        for node in active:
+            self._activate(node)
+
+    def sweep(self):
+        """"
+        Returns the pairs of the active locations, each pair once, and sets the bits of these locations
+        """
+        pairs = []
+        seen = set()
+        for node in self.active:
+            for pair in self.pairs_of.get(id(node), ()):
+                if id(pair) not in seen:
+                    seen.add(id(pair))
+                    pairs.append(pair)
+        self.active = []
+        self._queued = set()
+        return pairs
+
+    def changed(self, old_tour, new_tour):
+        """"
+        Activates the locations of the new tour of which the location itself, the one before or the one after differs
+        from the old tour. O(n)
+        """
+        n = len(new_tour)
+        for p in range(n):
+            if new_tour[p] is not old_tour[p]:
+                for q in range(max(p - 1, 0), min(p + 2, n)):
+                    self._activate(new_tour[q])
+
+
+class ParallelSweep:
+    """"
+    Scores the candidate moves of a best improvement sweep, see HillClimbing._solve_best_improvement. The moves of a
+    sweep all refer to one snapshot of the incumbent. With workers > 1 the snapshot is written as node codes to an
+    array in shared memory, which the worker processes only read: every worker rebuilds the route and its cache once
+    per snapshot and scores chunks of the moves. Each chunk returns its nr_candidates best moves and these are merged,
+    so only a few scores travel back. The moves are scored by move_score.
+
+    The problem itself (the nodes, the distances) is handed to the workers once, when the pool starts. Use the sweep
+    as a context manager or call close to stop the workers.
+    """
+    def __init__(self, route, driver_ends_at_start=True, workers=1, nr_candidates=8, chunks_per_worker=4,
+                 groups=None):
+        """"
+        :param: route: Route whose nodes all the snapshots consist of, e.g. the initial solution
+        :param: nr_candidates: int number of best moves that best_moves returns by default
+        :param: groups: dict optional store groups of the nodes of route, a move that breaks the precedence is scored
+        after the repair with them, see move_score
+        """
+        self.driver_ends_at_start = driver_ends_at_start
+        self.workers = workers
+        self.nr_candidates = nr_candidates
+        self.chunks_per_worker = chunks_per_worker
+        self.groups = groups
+        self.codes = {id(node): i for i, node in enumerate(route.tour)}
+        self.version = 0
+        self.cache = None
+        self.pool = None
+        if workers > 1:
+            # a single process run does not pay for importing multiprocessing
+            import multiprocessing
+            template = route.copy()
+            template.evaluator = base_evaluator(route.evaluator)
+            self.shared_tour = multiprocessing.RawArray('i', len(route.tour))
+            # the template and the groups travel together, so the groups refer to the nodes of the template
+            self.pool = multiprocessing.Pool(workers, initializer=_init_sweep_worker,
+                                             initargs=(template, driver_ends_at_start, self.shared_tour, groups))
+
+    def snapshot(self, route):
+        """"
+        Makes route the snapshot the next moves refer to and returns its cache
+        """
+        if self.cache is None or self.cache.route is not route:
+            self.cache = route_cache(route, self.driver_ends_at_start)
+            self.version += 1
+            if self.pool is not None:
+                self.shared_tour[:] = [self.codes[id(node)] for node in route.tour]
+        return self.cache
+
+    def best_moves(self, moves, nr_candidates=None):
+        """"
+        Returns the nr_candidates best (score, index in moves) of the snapshot, best first. The best k of a larger
+        nr_candidates are the same as for k.
+        """
+        if nr_candidates is None:
+            nr_candidates = self.nr_candidates
+        if self.pool is None or len(moves) < 2 * self.workers:
+            return _best_moves(self.cache, moves, 0, nr_candidates, self.groups)
+        chunk_size = -(-len(moves) // (self.workers * self.chunks_per_worker))
+        tasks = [(self.version, offset, moves[offset:offset + chunk_size], nr_candidates)
+                 for offset in range(0, len(moves), chunk_size)]
+        return heapq.nsmallest(nr_candidates, [item for chunk in self.pool.map(_score_chunk, tasks)
+                                               for item in chunk])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def route_cache(route, driver_ends_at_start=True):
+    """"
+    Returns the incremental cache of the evaluator of the route, see evaluators.RouteCache
+    """
+    if base_evaluator(route.evaluator) is TimeEvaluator:
+        return TimeWindowCache(route)
+    return DistanceCache(route, driver_ends_at_start)
+
+
+def move_score(cache, move, groups=None):
+    """"
+    Returns the score of a move by the cache. With the store groups a move that breaks the precedence is scored after
+    Route.repair_tour, the repair HillClimbing applies to it without allow_infeasibilites, in O(n) by
+    DistanceCache.score_tour. Other moves are O(1) to O(segment).
+    """
+    score = cache.move_score(move)
+    if groups is not None and score > DistanceEvaluator.presedence_order_penalty:
+        route = cache.route.copy()
+        route.apply_move(move)
+        score = cache.score_tour(Route.repair_tour(route.tour, groups))
+    return score
+
+
+def _best_moves(cache, moves, offset, nr_candidates, groups):
+    return heapq.nsmallest(nr_candidates, ((move_score(cache, moves[j], groups), offset + j)
+                                           for j in range(len(moves))))
+
+
+# the state of a worker process of a ParallelSweep
+_sweep_worker = {}
+
+
+def _init_sweep_worker(template, driver_ends_at_start, shared_tour, groups):
+    _sweep_worker.clear()
+    _sweep_worker.update({'template': template, 'nodes': list(template.tour), 'shared_tour': shared_tour,
+                          'driver_ends_at_start': driver_ends_at_start, 'groups': groups, 'version': None,
+                          'cache': None})
+
+
+def _score_chunk(task):
+    version, offset, moves, nr_candidates = task
+    worker = _sweep_worker
+    if worker['version'] != version:
+        route = worker['template'].copy()
+        route.tour = [worker['nodes'][code] for code in worker['shared_tour']]
+        worker['cache'] = route_cache(route, worker['driver_ends_at_start'])
+        worker['version'] = version
+    return _best_moves(worker['cache'], moves, offset, nr_candidates, worker['groups'])
+
+
 class GridSearch:
     def __init__(self, range_iterations_start, range_iterations_end, range_tabu_list_start, range_tabu_list_end,
-                 tabu, hc, allow_infeasibilities, step_size=10, with_time_windows=False):
+                 tabu, hc, allow_infeasibilities, step_size=10, with_time_windows=False, progress=None, archive=None):
         """"
         Creates a GridSearch object. Ths object enables finds the best parameters to run the hill climbing algorithm with
+
+        :param: progress: progress.ProgressSink optional sink of the progress events
+        :param: archive: elite.EliteArchive optional, the route of every cell is offered to it
         """
         self.range_iterations_start = range_iterations_start
         self.range_iterations_end = range_iterations_end
@@ -192,22 +936,29 @@ class GridSearch:
         self.allow_infeasibilites = allow_infeasibilities
         self.hc = hc
         self.with_time_windows = with_time_windows
+        self.progress = progress
+        self.archive = archive
 
     def run(self):
         """"
         Runs the algorithm with the initialized parameters
         """
+        progress = sink_or_default(self.progress)
         best_score = float('inf')
         best_route = None
         best_nr_iterations = None
         best_tabu_list_size = None
         for i in range(self.range_iterations_start, self.range_iterations_end, 10):
             for j in range(self.range_tabu_list_start, self.range_tabu_list_end):
-                print('testing for nr_iterations', i, ' and tabu list size', j)
+                if progress.enabled:
+                    progress.emit(Note('grid_search', 'testing for nr_iterations ' + str(i) + ' and tabu list size ' +
+                                       str(j)))
                 self.hc.generate_initial_solution(use_seed=True)
                 score, route, iteration = self.hc.solve(tabu=self.tabu, with_time_windows=self.with_time_windows,
                                                         nr_iterations=i, tabu_size=j,
                                                         allow_infeasibilites=self.allow_infeasibilites)
+                if self.archive is not None:
+                    self.archive.add(route, score)
 
                 if score < best_score:
                     best_score = score
@@ -215,7 +966,10 @@ class GridSearch:
                     best_nr_iterations = i
                     best_tabu_list_size = j
 
-        print('best results with sore', best_score, best_nr_iterations, best_tabu_list_size )
+        if progress.enabled:
+            progress.emit(Statistics('grid_search', 'best results', {'score': best_score,
+                                                                     'nr_iterations': best_nr_iterations,
+                                                                     'tabu_size': best_tabu_list_size}))
         return best_score, best_route, best_tabu_list_size
 
 
@@ -0,0 +1,243 @@
+from src.algorithms.neighbourhood import HillClimbing
+from src.domain import Route
+from src.progress import PhaseTiming, Statistics, Note, sink_or_default
+import math
+import random
+import time
+
+
+class SuccessiveHalving:
+    """"
+    Budget aware hyperparameter search for the hill climbing algorithm, replaces the exhaustive GridSearch.
+
+    A number of configurations is sampled from the search space and every configuration is run on all instances and
+    seeds with a small number of iterations. The configurations are ranked per (instance, seed) and the best 1 / eta
+    by mean rank survive to the next rung, where the number of iterations is multiplied by eta. This repeats until one
+    configuration is left or the maximum number of iterations is reached. Ranks are used instead of scores, so instances
+    with very different score scales weigh the same.
+
+    The search space maps a parameter of HillClimbing.solve to a list (pick one), a tuple (low, high) (uniform, an int
+    when both bounds are ints) or a dict of those (sampled per key, e.g. the operator_weights).
+
+    Every run starts from the same initial solution per (instance, seed) and passes a seed to the solver, so a
+    configuration that is run again with the same budget gives the same score. With an elite archive, the initial
+    solutions of the first instance are seeded from its elite routes, see elite.EliteArchive.seed, so the restarts of a
+    long run build on the best routes of the earlier ones. With a checkpoint, the configurations
+    of the current rung and the finished runs are saved after every run, see checkpoint.Checkpoint.
+    """
+    default_search_space = {
+        'tabu_size': (2, 9),
+        'swap_probability': (0.2, 0.8),
+        'adaptive_operators': [False, True],
+        'operator_weights': {operator: (0.5, 2.0) for operator in HillClimbing.operators}
+    }
+
+    def __init__(self, solvers, search_space=None, nr_configurations=16, min_iterations=5, max_iterations=40, eta=2,
+                 seeds=(1, 2, 3), with_time_windows=False, tabu=True, allow_infeasibilities=True, seed=0,
+                 checkpoint=None, progress=None, archive=None, relink_probability=0.5):
+        """"
+        Creates a SuccessiveHalving object
+
+        :param: solvers: list of HillClimbing objects, one per instance to tune on
+        :param: search_space: dict parameter name to list, tuple or dict, see the class docstring
+        :param: nr_configurations: int number of sampled configurations in the first rung
+        :param: min_iterations: int nr_iterations of a run in the first rung
+        :param: max_iterations: int maximum nr_iterations of a run
+        :param: eta: int factor by which the configurations are reduced and the budget is increased every rung
+        :param: seeds: list of int seeds of the initial solutions, every configuration is run once per seed
+        :param: seed: int seed of the sampling of the configurations
+        :param: checkpoint: checkpoint.Checkpoint optional, also given to the solvers
+        :param: progress: progress.ProgressSink optional sink of the progress events of the tuner
+        :param: archive: elite.EliteArchive optional elite routes of the problem of the first solver
+        :param: relink_probability: float probability that a seeded initial solution is a path relinking and not a
+        crossover of two elite routes
+        """
+        if eta < 2:
+            raise ValueError('eta should be at least 2')
+        self.solvers = solvers
+        self.search_space = SuccessiveHalving.default_search_space if search_space is None else search_space
+        self.nr_configurations = nr_configurations
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.eta = eta
+        self.seeds = list(seeds)
+        self.with_time_windows = with_time_windows
+        self.tabu = tabu
+        self.allow_infeasibilites = allow_infeasibilities
+        self.seed = seed
+        self.rand = random.Random(seed)
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self.archive = archive
+        self.relink_probability = relink_probability
+        if checkpoint is not None:
+            for solver in solvers:
+                solver.checkpoint = checkpoint
+        self.initial_solutions = {}
+        self.statistics = {'runs': 0, 'iterations': 0, 'seconds': 0.0, 'rungs': 0}
+        # (configuration index, instance, seed) -> (score, route) of the finished runs of the current rung
+        self._finished = {}
+
+    def run(self):
+        """"
+        Runs the search. Returns the best score and route of the best configuration on the first instance and the best
+        configuration.
+        """
+        key = repr((self.search_space, self.nr_configurations, self.min_iterations, self.max_iterations, self.eta,
+                    self.seeds, self.with_time_windows, self.tabu, self.allow_infeasibilites, self.seed))
+        progress = sink_or_default(self.progress)
+        saved = self.checkpoint.get('tuner', key) if self.checkpoint is not None else None
+        if saved is not None:
+            configurations = saved['configurations']
+            nr_iterations = saved['nr_iterations']
+            self.statistics = dict(saved['statistics'])
+            self._finished = {}
+            for (c, instance, seed), (score, tour) in saved['finished'].items():
+                self._finished[(c, instance, seed)] = (score, self._restore_route(instance, seed, tour))
+            if progress.enabled:
+                progress.emit(Note('tuner', 'resuming rung with ' + str(len(configurations)) + ' configurations, ' +
+                                   str(len(self._finished)) + ' runs done'))
+        else:
+            configurations = [self.sample() for _ in range(self.nr_configurations)]
+            nr_iterations = self.min_iterations
+            self.statistics['rungs'] += 1
+        while True:
+            if progress.enabled:
+                progress.emit(Note('tuner', 'rung with ' + str(len(configurations)) +
+                                   ' configurations and nr_iterations ' + str(nr_iterations)))
+            rung_started = time.perf_counter()
+            results = []
+            for c in range(len(configurations)):
+                results.append(self._evaluate(c, configurations[c], nr_iterations, key, configurations))
+            if progress.enabled:
+                progress.emit(PhaseTiming('tuner', 'rung ' + str(self.statistics['rungs']),
+                                          time.perf_counter() - rung_started))
+            mean_ranks = SuccessiveHalving._mean_ranks(results)
+            order = sorted(range(len(configurations)), key=lambda c: mean_ranks[c])
+            if len(configurations) == 1 or nr_iterations >= self.max_iterations:
+                break
+            keep = max(1, int(math.ceil(len(configurations) / float(self.eta))))
+            configurations = [configurations[c] for c in order[:keep]]
+            nr_iterations = min(nr_iterations * self.eta, self.max_iterations)
+            self.statistics['rungs'] += 1
+            self._finished = {}
+            self._save_progress(key, configurations, nr_iterations, force=True)
+
+        best = order[0]
+        best_score, best_route = min(((score, route) for (instance, seed), (score, route) in results[best].items()
+                                      if instance == 0), key=lambda item: item[0])
+        self._print_statistics(progress, configurations[best], best_score)
+        return best_score, best_route, configurations[best]
+
+    def sample(self, space=None):
+        """"
+        Samples a configuration from the search space
+        """
+        space = self.search_space if space is None else space
+        configuration = {}
+        for name, values in space.items():
+            if isinstance(values, dict):
+                configuration[name] = self.sample(values)
+            elif isinstance(values, list):
+                configuration[name] = self.rand.choice(values)
+            elif isinstance(values, tuple):
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    configuration[name] = self.rand.randint(low, high - 1)
+                else:
+                    configuration[name] = self.rand.uniform(low, high)
+            else:
+                raise TypeError('Search space of ' + str(name) + ' should be a list, tuple or dict')
+        return configuration
+
+    def _evaluate(self, c, configuration, nr_iterations, key, configurations):
+        """"
+        Runs configuration c on all instances and seeds, returns (instance, seed) -> (score, route). Runs that are
+        finished before a resume are not run again.
+        """
+        results = {}
+        for instance in range(len(self.solvers)):
+            solver = self.solvers[instance]
+            for seed in self.seeds:
+                if (c, instance, seed) in self._finished:
+                    results[(instance, seed)] = self._finished[(c, instance, seed)]
+                    continue
+                solver.solution = self._initial_solution(instance, seed)
+                start = time.time()
+                score, route, iteration = solver.solve(with_time_windows=self.with_time_windows, tabu=self.tabu,
+                                                       nr_iterations=nr_iterations,
+                                                       allow_infeasibilites=self.allow_infeasibilites,
+                                                       seed=1000 + seed, **configuration)
+                self.statistics['seconds'] += time.time() - start
+                self.statistics['runs'] += 1
+                self.statistics['iterations'] += nr_iterations
+                results[(instance, seed)] = (score, route)
+                self._finished[(c, instance, seed)] = (score, route)
+                self._save_progress(key, configurations, nr_iterations)
+        return results
+
+    def _save_progress(self, key, configurations, nr_iterations, force=False):
+        if self.checkpoint is None:
+            return
+        finished = {}
+        for run, (score, route) in self._finished.items():
+            finished[run] = (score, [Route.node_key(node) for node in route.tour])
+        state = {'configurations': configurations, 'nr_iterations': nr_iterations, 'finished': finished,
+                 'statistics': dict(self.statistics)}
+        self.checkpoint.set('tuner', state, key=key, force=force)
+
+    def _restore_route(self, instance, seed, tour):
+        """"
+        Rebuilds a route of a finished run on the nodes of its initial solution
+        """
+        initial_solution = self._initial_solution(instance, seed)
+        nodes = {Route.node_key(node): node for node in initial_solution.tour}
+        route = initial_solution.copy()
+        route.tour = [nodes[node_key] for node_key in tour]
+        return route
+
+    def _initial_solution(self, instance, seed):
+        """"
+        The initial solution is generated once per (instance, seed) and shared by all configurations. For the first
+        instance it is seeded from the elite archive, with a random state of the seed, so a resumed run gets the same.
+        """
+        key = (instance, seed)
+        if key not in self.initial_solutions:
+            solver = self.solvers[instance]
+            solver.generate_initial_solution(use_seed=True, seed=seed)
+            if self.archive is not None and instance == 0:
+                seeded = self.archive.seed(solver.solution, self.relink_probability, rand=random.Random(seed))
+                if seeded is not None:
+                    solver.solution = seeded
+            self.initial_solutions[key] = solver.solution
+        return self.initial_solutions[key]
+
+    @staticmethod
+    def _mean_ranks(results):
+        """"
+        Ranks the configurations per (instance, seed), ties share their mean rank
+        """
+        mean_ranks = [0.0] * len(results)
+        for key in results[0]:
+            scores = [result[key][0] for result in results]
+            order = sorted(range(len(scores)), key=lambda c: scores[c])
+            i = 0
+            while i < len(order):
+                j = i
+                while j + 1 < len(order) and scores[order[j + 1]] == scores[order[i]]:
+                    j += 1
+                for k in range(i, j + 1):
+                    mean_ranks[order[k]] += (i + j) / 2.0 / len(results[0])
+                i = j + 1
+        return mean_ranks
+
+    def _print_statistics(self, progress, configuration, score):
+        if not progress.enabled:
+            return
+        full_grid_runs = self.nr_configurations * len(self.seeds) * len(self.solvers)
+        progress.emit(Statistics('tuner', 'best results', {'score': score, 'configuration': configuration}))
+        cost = dict(self.statistics)
+        cost['seconds'] = round(cost['seconds'], 2)
+        # the iterations of all configurations at the maximum budget, what a full grid search would cost
+        cost['full_grid_iterations'] = full_grid_runs * self.max_iterations
+        progress.emit(Statistics('tuner', 'tuning cost', cost))
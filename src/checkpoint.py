@@ -0,0 +1,104 @@
+import logging
+import os
+import pickle
+import time
+
+
+class Checkpoint:
+    """"
+    Periodic checkpoint of a long run, so that it can be resumed after the process dies. Each layer of the run keeps its
+    own section in the checkpoint: the loop in tsp.main, the tuner and the solver. A section is stored with a key that
+    identifies the run it belongs to (parameters, seed, initial solution), the progress of another run is never resumed.
+
+    The checkpoint is written atomically: it is pickled to a temporary file in the same directory, flushed to disk and
+    renamed over the previous checkpoint, so a crash during a write leaves the previous checkpoint intact. Writes are
+    throttled to one per interval seconds unless forced.
+
+    The state should only hold plain values (numbers, strings, lists, dicts, random states and node keys of routes, see
+    Route.node_key), not the problem objects themselves.
+    """
+    def __init__(self, file_name, interval=30.0):
+        self.file_name = file_name
+        self.interval = interval
+        self.state = {}
+        self.statistics = {'saves': 0, 'seconds': 0.0}
+        self._last_save = None
+
+    def load(self):
+        """"
+        Loads the checkpoint from disk, returns False if there is none
+        """
+        if not os.path.exists(self.file_name):
+            return False
+        try:
+            with open(self.file_name, 'rb') as infile:
+                self.state = pickle.load(infile)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logging.warning('Can not resume from checkpoint %s: %s', self.file_name, e)
+            self.state = {}
+            return False
+        return True
+
+    def get(self, section, key=None):
+        """"
+        Returns the state of a section or None if there is none or it belongs to another run
+        """
+        entry = self.state.get(section)
+        if entry is None or entry['key'] != key:
+            return None
+        return entry['state']
+
+    def set(self, section, state, key=None, force=False):
+        """"
+        Sets the state of a section and writes the checkpoint if the last write is older than interval seconds
+        """
+        self.state[section] = {'key': key, 'state': state}
+        if force or self._last_save is None or time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def clear(self, section):
+        self.state.pop(section, None)
+
+    def save(self):
+        start = time.time()
+        write_atomically(self.file_name, lambda outfile: pickle.dump(self.state, outfile,
+                                                                     protocol=pickle.HIGHEST_PROTOCOL),
+                         prefix='.checkpoint_')
+        self._last_save = time.time()
+        self.statistics['saves'] += 1
+        self.statistics['seconds'] += self._last_save - start
+
+    def remove(self):
+        """"
+        Removes the checkpoint when the run is finished
+        """
+        self.state = {}
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+
+def write_atomically(file_name, write, prefix='.tmp_'):
+    """"
+    Writes a file atomically: write(outfile) writes to a temporary file in the same directory, which is flushed to disk
+    and renamed over file_name. A crash during the write leaves the previous file intact. Used by the checkpoints, the
+    elite archives and the matrix cache.
+
+    :param: write: function of a binary file object
+    :param: prefix: str prefix of the name of the temporary file
+    """
+    directory = os.path.dirname(os.path.abspath(file_name))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # imported on the first write, see the startup benchmark in regression
+    import tempfile
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix=prefix)
+    try:
+        with os.fdopen(handle, 'wb') as outfile:
+            write(outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temporary, file_name)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
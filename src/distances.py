@@ -0,0 +1,420 @@
+from src.locations import Job, Store, Deliverer
+from array import array
+from math import radians, cos, sin, asin, sqrt
+import os
+import struct
+
+
+# magic, number of locations and whether durations follow the distances
+_MATRIX_HEADER = struct.Struct('<4sIB')
+_MAGIC = b'TSPD'
+_BLOCK_SIZE = 1 << 20
+
+
+def location_key(location):
+    """"
+    Returns the key of a location in a matrix file: 'job:<id>', 'store:<id>' or 'driver:<id>'. The store copies of a
+    relaxed route share the key of their store.
+    """
+    if isinstance(location, Job):
+        return 'job:' + str(location.id)
+    if isinstance(location, Store):
+        return 'store:' + str(location.id)
+    if isinstance(location, Deliverer):
+        return 'driver:' + str(location.id)
+    raise TypeError('Unknown location type ' + str(type(location)))
+
+
+class DistanceProvider:
+    """"
+    Computes the distances (km) and optionally the travel times (seconds) between locations for a DistancesMatrix.
+    Providers compute a whole matrix at once, see distances, or single pairs for a locations.LazyDistancesMatrix, see
+    distance.
+
+    A provider without durations leaves the travel time to travel_time, which drives the distance at the given speed.
+    A time dependent provider makes the travel time depend on the departure time. symmetric is None when it is not
+    known up front.
+
+    The fingerprint identifies the distances a provider computes, it is part of the key of the MatrixCache.
+    """
+    symmetric = True
+    time_dependent = False
+    has_durations = False
+
+    def fingerprint(self):
+        raise NotImplementedError('Implement the fingerprint of the distance provider')
+
+    def distances(self, locations):
+        """"
+        Returns the distances between all locations as a list of rows
+        """
+        return [[self.distance(loc1, loc2) for loc2 in locations] for loc1 in locations]
+
+    def durations(self, locations):
+        """"
+        Returns the travel times between all locations as a list of rows or None if the provider has none
+        """
+        return None
+
+    def distances_between(self, sources, targets):
+        """"
+        Returns the distances from every source to every target as a list of rows, one per source
+        """
+        return [[self.distance(loc1, loc2) for loc2 in targets] for loc1 in sources]
+
+    def durations_between(self, sources, targets):
+        """"
+        Returns the travel times from every source to every target, or None if the provider has none
+        """
+        if not self.has_durations:
+            return None
+        return [[self.duration(loc1, loc2) for loc2 in targets] for loc1 in sources]
+
+    def distance(self, loc1, loc2):
+        raise NotImplementedError('Implement the distance of the distance provider')
+
+    def duration(self, loc1, loc2):
+        return None
+
+    def travel_time(self, distance, departure, speed):
+        """"
+        Returns the seconds it takes to drive distance km at speed m/s
+        """
+        return distance * 1000 / speed
+
+
+class HaversineProvider(DistanceProvider):
+    """"
+    The great circle distance between the locations. A whole matrix is computed with numpy when it is installed,
+    otherwise with the sines and cosines of every location computed once.
+    """
+    radius = 6371  # Radius of earth in kilometers. Use 3956 for miles
+
+    def fingerprint(self):
+        return 'haversine:' + str(HaversineProvider.radius)
+
+    def distances(self, locations):
+        return self.distances_between(locations, locations)
+
+    def distances_between(self, sources, targets):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            source_latitudes = numpy.radians(numpy.array([location.get_latitude() for location in sources],
+                                                         dtype=float))
+            source_longitudes = numpy.radians(numpy.array([location.get_longitude() for location in sources],
+                                                          dtype=float))
+            latitudes = numpy.radians(numpy.array([location.get_latitude() for location in targets], dtype=float))
+            longitudes = numpy.radians(numpy.array([location.get_longitude() for location in targets], dtype=float))
+            dlat = latitudes[numpy.newaxis, :] - source_latitudes[:, numpy.newaxis]
+            dlon = longitudes[numpy.newaxis, :] - source_longitudes[:, numpy.newaxis]
+            a = numpy.sin(dlat / 2) ** 2 + numpy.outer(numpy.cos(source_latitudes), numpy.cos(latitudes)) * \
+                numpy.sin(dlon / 2) ** 2
+            return (2 * numpy.arcsin(numpy.sqrt(a)) * HaversineProvider.radius).tolist()
+
+        latitudes = [radians(location.get_latitude()) for location in targets]
+        longitudes = [radians(location.get_longitude()) for location in targets]
+        cosines = [cos(latitude) for latitude in latitudes]
+        rows = []
+        for source in sources:
+            lat1, lon1 = radians(source.get_latitude()), radians(source.get_longitude())
+            cos1 = cos(lat1)
+            row = []
+            for j in range(len(targets)):
+                a = sin((latitudes[j] - lat1) / 2) ** 2 + cos1 * cosines[j] * sin((longitudes[j] - lon1) / 2) ** 2
+                row.append(2 * asin(sqrt(a)) * HaversineProvider.radius)
+            rows.append(row)
+        return rows
+
+    def distance(self, loc1, loc2):
+        return HaversineProvider.haversine(loc1.get_longitude(), loc1.get_latitude(), loc2.get_longitude(),
+                                           loc2.get_latitude())
+
+    @staticmethod
+    def haversine(lon1, lat1, lon2, lat2):
+        """
+        Calculate the great circle distance between two points on the earth (specified in decimal degrees)
+        """
+        lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        return 2 * asin(sqrt(a)) * HaversineProvider.radius
+
+
+class MatrixFileProvider(DistanceProvider):
+    """"
+    Distances, and optionally travel times, from precomputed matrices in local files, e.g. exported from a routing
+    engine. A matrix is a csv file with a header row of location keys (see location_key) and a row per location that
+    starts with its key, or a .npy file with the keys as a json list in <file>.keys.json. Reading .npy files needs
+    numpy.
+
+    The files are read the first time a distance is needed. The fingerprint is a hash of the file contents, so a
+    MatrixCache never returns the distances of an older version of a file. Whether the distances are symmetric is
+    checked on the matrix of the DistancesMatrix.
+    """
+    symmetric = None
+
+    def __init__(self, distance_file, duration_file=None):
+        """"
+        :param: distance_file: str matrix of distances in km
+        :param: duration_file: str optional matrix of travel times in seconds
+        """
+        self.distance_file = distance_file
+        self.duration_file = duration_file
+        self._matrices = None
+        self._fingerprint = None
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            import hashlib
+            digest = hashlib.blake2b(digest_size=16)
+            for file_name in (self.distance_file, self.duration_file):
+                if file_name is None:
+                    continue
+                digest.update(os.path.basename(file_name).encode('utf-8'))
+                with open(file_name, 'rb') as infile:
+                    for block in iter(lambda: infile.read(_BLOCK_SIZE), b''):
+                        digest.update(block)
+            self._fingerprint = 'matrix:' + digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def has_durations(self):
+        return self.duration_file is not None
+
+    def distances(self, locations):
+        return self._rows('distances', locations)
+
+    def durations(self, locations):
+        if self.duration_file is None:
+            return None
+        return self._rows('durations', locations)
+
+    def distance(self, loc1, loc2):
+        return self._value('distances', loc1, loc2)
+
+    def duration(self, loc1, loc2):
+        if self.duration_file is None:
+            return None
+        return self._value('durations', loc1, loc2)
+
+    def distances_between(self, sources, targets):
+        return self._block('distances', sources, targets)
+
+    def durations_between(self, sources, targets):
+        if self.duration_file is None:
+            return None
+        return self._block('durations', sources, targets)
+
+    def _rows(self, name, locations):
+        return self._block(name, locations, locations)
+
+    def _block(self, name, sources, targets):
+        keys, rows = self._load()[name]
+        columns = [self._index(keys, location) for location in targets]
+        return [[rows[i][j] for j in columns] for i in (self._index(keys, location) for location in sources)]
+
+    def _value(self, name, loc1, loc2):
+        keys, rows = self._load()[name]
+        return rows[self._index(keys, loc1)][self._index(keys, loc2)]
+
+    def _index(self, keys, location):
+        key = location_key(location)
+        if key not in keys:
+            raise ValueError('No distances for ' + key + ' in ' + self.distance_file)
+        return keys[key]
+
+    def _load(self):
+        if self._matrices is None:
+            self._matrices = {'distances': MatrixFileProvider.read(self.distance_file)}
+            if self.duration_file is not None:
+                self._matrices['durations'] = MatrixFileProvider.read(self.duration_file)
+        return self._matrices
+
+    @staticmethod
+    def read(file_name):
+        """"
+        Reads a matrix file, returns the keys by row index and the rows
+        """
+        if file_name.endswith('.npy'):
+            import json
+            import numpy
+            rows = numpy.load(file_name).tolist()
+            with open(file_name + '.keys.json', encoding='utf-8') as infile:
+                keys = json.load(infile)
+        else:
+            import csv
+            with open(file_name, newline='', encoding='utf-8') as infile:
+                reader = csv.reader(infile)
+                keys = next(reader)[1:]
+                rows = []
+                for record in reader:
+                    if record[0] != keys[len(rows)]:
+                        raise ValueError('Row ' + record[0] + ' of ' + file_name + ' should be ' + keys[len(rows)])
+                    rows.append([float(value) for value in record[1:]])
+        if len(rows) != len(keys) or any(len(row) != len(keys) for row in rows):
+            raise ValueError('Matrix in ' + file_name + ' is not square')
+        return {key: i for i, key in enumerate(keys)}, rows
+
+    @staticmethod
+    def write(file_name, locations, rows):
+        """"
+        Writes a matrix as csv, e.g. to check the format or to edit a few distances by hand
+        """
+        import csv
+        with open(file_name, 'w', newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile)
+            keys = [location_key(location) for location in locations]
+            writer.writerow([''] + keys)
+            for key, row in zip(keys, rows):
+                writer.writerow([key] + list(row))
+
+    def __getstate__(self):
+        # worker processes read the files again instead of receiving the matrices
+        state = dict(self.__dict__)
+        state['_matrices'] = None
+        return state
+
+
+class SpeedProfileProvider(DistanceProvider):
+    """"
+    Time dependent travel times: the distances of another provider driven at a speed per hour of the day. A trip that
+    crosses the end of an hour continues at the speed of the next hour, so a later departure never arrives earlier.
+    The hours are local time, utc_offset hours ahead of the unix time stamps of the problem.
+
+    Route caches can not shift the arrival times of an unchanged stretch of a route when travel times depend on the
+    departure time, see evaluators.TimeWindowCache.
+    """
+    time_dependent = True
+
+    def __init__(self, speeds, provider=None, utc_offset=0):
+        """"
+        :param: speeds: list of 24 speeds in m/s, one per hour of the day
+        :param: provider: DistanceProvider of the distances, HaversineProvider when not given
+        :param: utc_offset: float hours between local time and UTC, e.g. 8 for Singapore
+        """
+        if len(speeds) != 24 or min(speeds) <= 0:
+            raise ValueError('A speed profile needs 24 positive speeds')
+        self.speeds = list(speeds)
+        self.provider = provider if provider is not None else HaversineProvider()
+        self.utc_offset = utc_offset
+        self.symmetric = self.provider.symmetric
+        # km driven in a whole day
+        self.day_distance = sum(self.speeds) * 3.6
+
+    def fingerprint(self):
+        # the speeds do not change the distances
+        return self.provider.fingerprint()
+
+    def distances(self, locations):
+        return self.provider.distances(locations)
+
+    def distances_between(self, sources, targets):
+        return self.provider.distances_between(sources, targets)
+
+    def distance(self, loc1, loc2):
+        return self.provider.distance(loc1, loc2)
+
+    def travel_time(self, distance, departure, speed):
+        time = departure + self.utc_offset * 3600
+        remaining = distance
+        days = int(remaining // self.day_distance)
+        time += days * 86400
+        remaining -= days * self.day_distance
+        while remaining > 0:
+            hour_speed = self.speeds[int(time // 3600) % 24]
+            hour_end = (time // 3600 + 1) * 3600
+            reach = hour_speed * (hour_end - time) / 1000
+            if remaining <= reach:
+                time += remaining * 1000 / hour_speed
+                break
+            remaining -= reach
+            time = hour_end
+        return time - self.utc_offset * 3600 - departure
+
+
+class MatrixCache:
+    """"
+    Content addressed store of distance matrices on disk. A matrix is stored under a hash of the fingerprint of its
+    provider and the keys and coordinates of its locations, so a solve on the same locations with the same provider
+    reads the matrix from disk instead of computing it, and a change to the locations or the matrix files gives a new
+    entry. Matrices are also kept in memory for the DistancesMatrix objects of one process.
+
+    An entry is a small header and the distances, and the durations if the provider has them, as doubles. Entries are
+    written atomically, like a checkpoint.Checkpoint, so processes can share the directory.
+    """
+    def __init__(self, directory, memory_size=8):
+        self.directory = directory
+        self.memory_size = memory_size
+        self.memory = {}
+        self.statistics = {'hits': 0, 'memory_hits': 0, 'misses': 0}
+
+    def key(self, provider, locations):
+        import hashlib
+        digest = hashlib.blake2b(provider.fingerprint().encode('utf-8'), digest_size=16)
+        for location in locations:
+            digest.update(('%s,%r,%r;' % (location_key(location), location.get_latitude(),
+                                          location.get_longitude())).encode('utf-8'))
+        return digest.hexdigest()
+
+    def matrices(self, provider, locations):
+        """"
+        Returns the distances and the durations (or None) of the locations as flat arrays of doubles, row by row
+        """
+        key = self.key(provider, locations)
+        if key in self.memory:
+            self.statistics['memory_hits'] += 1
+            return self.memory[key]
+        matrices = self._read(key, len(locations))
+        if matrices is None:
+            self.statistics['misses'] += 1
+            distances = array('d', (value for row in provider.distances(locations) for value in row))
+            rows = provider.durations(locations)
+            durations = array('d', (value for row in rows for value in row)) if rows is not None else None
+            matrices = (distances, durations)
+            self._write(key, len(locations), matrices)
+        else:
+            self.statistics['hits'] += 1
+        if len(self.memory) >= self.memory_size:
+            self.memory.pop(next(iter(self.memory)))
+        self.memory[key] = matrices
+        return matrices
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, key + '.matrix')
+
+    def _read(self, key, n):
+        file_name = self._file_name(key)
+        if not os.path.exists(file_name):
+            return None
+        try:
+            with open(file_name, 'rb') as infile:
+                magic, size, has_durations = _MATRIX_HEADER.unpack(infile.read(_MATRIX_HEADER.size))
+                if magic != _MAGIC or size != n:
+                    raise ValueError('not a matrix of ' + str(n) + ' locations')
+                distances = array('d')
+                distances.frombytes(infile.read(8 * n * n))
+                durations = None
+                if has_durations:
+                    durations = array('d')
+                    durations.frombytes(infile.read(8 * n * n))
+                if len(distances) != n * n or (durations is not None and len(durations) != n * n):
+                    raise ValueError('truncated matrix')
+        except (OSError, struct.error, ValueError) as e:
+            import logging
+            logging.warning('Ignoring cached matrix %s: %s', file_name, e)
+            return None
+        return distances, durations
+
+    def _write(self, key, n, matrices):
+        from src.checkpoint import write_atomically
+        distances, durations = matrices
+
+        def write(outfile):
+            outfile.write(_MATRIX_HEADER.pack(_MAGIC, n, durations is not None))
+            outfile.write(distances.tobytes())
+            if durations is not None:
+                outfile.write(durations.tobytes())
+
+        write_atomically(self._file_name(key), write, prefix='.matrix_')
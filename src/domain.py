@@ -1,61 +1,70 @@
+import bisect
 import random
-import logging
-from src.locations import Job, Store
-from collections import Counter
+from src.locations import Job, Store, DistancesMatrix
+from src.evaluators import DistanceEvaluator, DistanceCache, base_evaluator
+from array import array
+from collections import Counter, OrderedDict
+from types import MappingProxyType
 import os
-import json
+import struct
+import threading
+
+
+_MASK = (1 << 128) - 1
+_node_keys = {}
+# the last few problem indexes by (jobs list, stores list), so routes of the same problem share one
+_problem_indexes = OrderedDict()
+_problem_indexes_lock = threading.Lock()
+_MAX_PROBLEM_INDEXES = 16
+# base hash, flags, number of codes and number of moves of a CompactRoute
+_COMPACT_HEADER = struct.Struct('<16sBII')
+_HAS_CODES = 1
+_HAS_MOVES = 2
+_HAS_BASE = 4
 
 
 class Route:
     """"
     The route class represents a route that is to be traversed by the deliverer
     """
-    id_to_obj_map = {}
-
-    def __init__(self, jobs, stores, deliverers, distances, evaluator):
+    def __init__(self, jobs, stores, deliverers, distances, evaluator, index=None):
         """
 
         :param jobs: list - all locations of customers needs to visit
         :papram: stores: list - all locations of stores that need to be viit in this route
         :param distances: locations.DistanceMatrix
         :param deliverer: list list of deliverers - in this case length of this list should be 1
+        :param index: ProblemIndex optional index of jobs and stores, looked up with ProblemIndex.of when not given
         """
         self.locations = {
             'jobs': jobs,
             'stores': stores,
             'deliverers': deliverers
         }
+        self.index = index if index is not None else ProblemIndex.of(jobs, stores)
         self.requests = self._generate_requests()
         self.distances_matrix = distances
+        self._hash = None
+        self._moves = None
+        self._moves_base = None
         self.tour = [] #self._generate_random_route(self.locations)
         self.evaluator = evaluator
 
+    @property
+    def tour(self):
+        return self._tour
+
+    @tour.setter
+    def tour(self, tour):
+        self._tour = tour
+        self._hash = None
+        self._moves = None
+
     def _generate_requests(self):
         """"
         A request is a pick up and delivery match. This is generated for convenience in problem 2.
         """
-        requests = []
-        for job in self.jobs():
-            pick_up_location = job.store['id']
-            for store in self.stores():
-                if pick_up_location == store.id:
-                    requests.append(Request(store, job))
-                    break
-        return requests
-
-    @staticmethod
-    def _generate_map(jobs, stores, deliverers):
-        """"
-        Generates a dict of ids and the corresponding object
-        """
-        for job in jobs:
-            Route.id_to_obj_map[job.id] = job
-
-        for store in stores:
-            Route.id_to_obj_map[store.id] = store
-
-        for driver in deliverers:
-            Route.id_to_obj_map[driver.id] = driver
+        return self.index.requests
 
     def _generate_random_route(self, seed):
         rand = random.Random(seed)
@@ -79,6 +88,7 @@ class Route:
             tour.extend([store, job])
 
         self.locations['stores'] = stores
+        self.index = ProblemIndex.of(self.jobs(), stores)
         rand.shuffle(tour)
         return tour
 
@@ -125,7 +135,7 @@ class Route:
         new_tour.extend(reversed(tour[i:k + 1]))
         new_tour.extend(tour[k + 1:])
         assert len(new_tour) == len(tour)
-        self.tour = new_tour
+        self._moved(new_tour, ('two_opt', i, k), self._reversed_hash(i, k))
 
     @staticmethod
     def two_opt_by_index(list_, index1, index2):
@@ -168,7 +178,9 @@ class Route:
         index1 = self.find_index_of_job(loc1)
         index2 = self.find_index_of_job(loc2)
 
+        self._swap_hash(index1, index2)
         self.tour[index1], self.tour[index2] = self.tour[index2], self.tour[index1]
+        self._record(('swap', index1, index2))
 
     def swap_destinations_time_window(self, loc1, loc2):
         """"
@@ -197,7 +209,9 @@ class Route:
             string += loc1 + " " + loc2
             raise TypeError(string)
 
+        self._swap_hash(index1, index2)
         self.tour[index1], self.tour[index2] = self.tour[index2], self.tour[index1]
+        self._record(('swap', index1, index2))
 
     def two_opt_move_time_window(self, loc1, loc2):
         """"
@@ -221,7 +235,71 @@ class Route:
             string += loc1 + " " + loc2
             raise TypeError(string)
 
-        self.tour = Route.two_opt_by_index(self.tour, index1, index2)
+        self._moved(Route.two_opt_by_index(self.tour, index1, index2), ('two_opt', index1, index2),
+                    self._reversed_hash(index1, index2))
+
+    def relocate_pair(self, store_index, job_index, new_store_index, new_job_index):
+        """"
+        Moves a pick up and its delivery together. Both are taken out of the tour and inserted again before
+        new_store_index and new_job_index of the remaining tour, new_store_index <= new_job_index.
+        """
+        store = self.tour[store_index]
+        job = self.tour[job_index]
+        tour = [node for i, node in enumerate(self.tour) if i != store_index and i != job_index]
+        tour.insert(new_job_index, job)
+        tour.insert(new_store_index, store)
+        self._moved(tour, ('relocate_pair', store_index, job_index, new_store_index, new_job_index))
+
+    def or_opt_move(self, start, length, new_index, reverse=False):
+        """"
+        Moves the segment of length nodes at start, optionally reversed, before new_index of the remaining tour
+        """
+        segment = self.tour[start:start + length]
+        if reverse:
+            segment.reverse()
+        tour = self.tour[:start] + self.tour[start + length:]
+        self._moved(tour[:new_index] + segment + tour[new_index:], ('or_opt', start, length, new_index, reverse))
+
+    def apply_move(self, move):
+        """"
+        Applies a move tuple as scored by evaluators.RouteCache.move_score, or a ('repair',) of a move log, see
+        record_moves
+        """
+        if move[0] == 'swap':
+            self._swap_hash(move[1], move[2])
+            self.tour[move[1]], self.tour[move[2]] = self.tour[move[2]], self.tour[move[1]]
+            self._record(move)
+        elif move[0] == 'two_opt':
+            self._moved(Route.two_opt_by_index(self.tour, move[1], move[2]), move,
+                        self._reversed_hash(move[1], move[2]))
+        elif move[0] == 'relocate_pair':
+            self.relocate_pair(move[1], move[2], move[3], move[4])
+        elif move[0] == 'or_opt':
+            self.or_opt_move(move[1], move[2], move[3], move[4])
+        elif move[0] == 'repair':
+            self.fix_infeasibilities()
+        else:
+            raise TypeError('Unknown move ' + str(move[0]))
+
+    def request_pairs(self):
+        """"
+        Returns the (pick up, delivery) pairs of the nodes in the tour. In a relaxed tour every store copy is paired
+        with its own job, otherwise a job is paired with the store it is picked up at.
+        """
+        pairs = []
+        stores = {}
+        for node in self.tour:
+            if isinstance(node, Store):
+                if node.get_job() is not None:
+                    pairs.append((node, node.get_job()))
+                else:
+                    stores[node.id] = node
+        if len(pairs) > 0:
+            return pairs
+        for node in self.tour:
+            if isinstance(node, Job) and node.store['id'] in stores:
+                pairs.append((stores[node.store['id']], node))
+        return pairs
 
     def find_index_of_store(self, obj):
         index = 0
@@ -251,11 +329,19 @@ class Route:
         for i in range(len(all_locations)):
             for j in range(i+1, len(all_locations)):
                 if all_locations[i] is all_locations[j]:
+                    import logging
                     logging.warning('adding', all_locations[i], all_locations[j] )
                 pairs.append( (all_locations[i], all_locations[j]) )
 
         return pairs
 
+    def generate_time_window_pairs(self, time_horizon=None):
+        """"
+        Returns the pairs of locations of which the second starts its time window before the first, see
+        TimeWindowIndex.pairs
+        """
+        return TimeWindowIndex(self.get_all_locations()).pairs(time_horizon)
+
     def get_all_locations(self, incl_deleverer=False):
         all_locations = []
         for k, locations in self.locations.items():
@@ -267,18 +353,215 @@ class Route:
 
         return all_locations
 
-    def fix_infeasibilities(self, codec, find_all_occurences=False):
-        encoded = codec.encode_route(self)
-        decoded_route = codec.decode_route(encoded, find_all_occurences=find_all_occurences )
-        self.tour = decoded_route.tour
+    def fix_infeasibilities(self, codec=None, find_all_occurences=False):
+        """"
+        Repairs the precedence of the tour in place and in a single pass, see Route.repair_tour. The result is the same
+        tour a Codec encode/decode round trip produces, without building new routes.
+
+        :param: codec: domain.Codec optional, the store groups are taken from it when given
+        :param: find_all_occurences: boolean also reorder the jobs of each store among their positions when that
+        shortens the route
+        """
+        if codec is not None:
+            groups = codec.groups()
+        else:
+            groups = self.store_groups()
+        before = list(self.tour) if self._moves is not None else None
+        Route.repair_tour(self.tour, groups)
+        self._hash = None
+        if before is not None and before != self.tour:
+            self._record(('repair',))
+
+        if find_all_occurences and base_evaluator(self.evaluator) is DistanceEvaluator:
+            self._reorder_store_jobs()
+
+    @staticmethod
+    def repair_tour(tour, groups):
+        """"
+        Reorders a tour in place so that no job is visited before its store. For a tour that visits each store once,
+        the first position of every store group (the store and its jobs) gets the store and the remaining positions
+        get the jobs in group order. For a relaxed tour, where every store copy belongs to a single job, a job that
+        comes before its store copy swaps places with it. O(n)
+
+        :param: tour: list the tour to repair
+        :param: groups: dict store id -> (store, list of jobs), see Route.store_groups
+        """
+        positions = {}
+        relaxed = False
+        for i in range(len(tour)):
+            node = tour[i]
+            if isinstance(node, Store):
+                if node.get_job() is not None:
+                    relaxed = True
+                    positions[id(node.get_job())] = i
+                else:
+                    positions.setdefault(node.id, []).append(i)
+            else:
+                positions.setdefault(node.store['id'], []).append(i)
+
+        if relaxed:
+            for i in range(len(tour)):
+                node = tour[i]
+                if isinstance(node, Job) and id(node) in positions:
+                    store_index = positions[id(node)]
+                    if store_index > i:
+                        tour[i], tour[store_index] = tour[store_index], tour[i]
+                        positions[id(node)] = i
+            return tour
+
+        for store_id, indices in positions.items():
+            store, jobs = groups[store_id]
+            tour[indices[0]] = store
+            for j in range(1, len(indices)):
+                tour[indices[j]] = jobs[j - 1]
+        return tour
+
+    def _reorder_store_jobs(self):
+        """"
+        Swaps jobs of the same store with each other as long as that shortens the route. Both jobs stay behind their
+        store, so the route stays feasible. Each swap is scored in O(1) by a DistanceCache.
+        """
+        cache = DistanceCache(self)
+        improved = True
+        while improved:
+            improved = False
+            for jobs in cache.jobs_of_store.values():
+                for a in range(len(jobs)):
+                    for b in range(a + 1, len(jobs)):
+                        index1 = cache.index_of(jobs[a])
+                        index2 = cache.index_of(jobs[b])
+                        score, violations = cache.swap_score(index1, index2)
+                        if score < cache.score - 1e-9:
+                            self._swap_hash(index1, index2)
+                            self.tour[index1], self.tour[index2] = self.tour[index2], self.tour[index1]
+                            self._record(('swap', index1, index2))
+                            cache.update()
+                            improved = True
+
+    def store_groups(self):
+        """"
+        Returns a dict of store id -> (store, list of jobs of that store)
+        """
+        return self.index.groups(include_empty=True)
 
     def copy(self):
         route = Route(self.jobs(), self.stores(), [self.deliverer()], self.distances_matrix,
-                      self.evaluator)
+                      self.evaluator, index=self.index)
         route.tour = []
         route.tour.extend(self.tour)
+        route._hash = self._hash
+        route._moves = self._moves
+        route._moves_base = self._moves_base
         return route
 
+    def record_moves(self):
+        """"
+        Makes the current tour the base of a move log: the moves applied from now on, to this route and to its copies,
+        are recorded until a new tour is assigned, see recorded_moves and CompactRoute. The log is shared between a
+        route and its copies, recording a move is O(1).
+        """
+        self._moves = ()
+        self._moves_base = self.route_hash()
+
+    def recorded_moves(self):
+        """"
+        Returns the moves since record_moves as a list of apply_move tuples, None when no moves are recorded
+        """
+        if self._moves is None:
+            return None
+        moves = []
+        log = self._moves
+        while log:
+            log, move = log
+            moves.append(move)
+        moves.reverse()
+        return moves
+
+    def _record(self, move):
+        if self._moves is not None:
+            self._moves = (self._moves, move)
+
+    def _moved(self, tour, move, route_hash=None):
+        """"
+        Assigns the tour that a move made of the current tour, keeps the hash and the move log
+        """
+        moves = self._moves
+        self.tour = tour
+        self._hash = route_hash
+        if moves is not None:
+            self._moves = (moves, move)
+
+    def __getstate__(self):
+        # the move log is a linked list of (log, move) tuples, too deeply nested for pickle
+        state = dict(self.__dict__)
+        state['_moves'] = self.recorded_moves()
+        return state
+
+    def __setstate__(self, state):
+        moves = state.pop('_moves')
+        self.__dict__.update(state)
+        self._moves = None
+        if moves is not None:
+            self._moves = ()
+            for move in moves:
+                self._record(move)
+
+    def route_hash(self):
+        """"
+        Returns a 128 bit Zobrist style hash of the tour: the xor of a value per (node, position). It is computed
+        once and then kept up to date by the swap and 2-opt moves, in O(1) and O(segment) respectively. Assigning a
+        new tour resets it.
+        """
+        if self._hash is None:
+            route_hash = 0
+            for i in range(len(self.tour)):
+                route_hash ^= Route._position_hash(self.tour[i], i)
+            self._hash = route_hash
+        return self._hash
+
+    def _swap_hash(self, index1, index2):
+        if self._hash is not None:
+            node1 = self.tour[index1]
+            node2 = self.tour[index2]
+            self._hash ^= Route._position_hash(node1, index1) ^ Route._position_hash(node2, index2) ^ \
+                Route._position_hash(node1, index2) ^ Route._position_hash(node2, index1)
+
+    def _reversed_hash(self, index1, index2):
+        """"
+        Returns the hash of the tour after reversing the nodes between both indices, or None if no hash is known
+        """
+        if self._hash is None:
+            return None
+        i = min(index1, index2)
+        k = max(index1, index2)
+        route_hash = self._hash
+        for p in range(i, k + 1):
+            node = self.tour[p]
+            route_hash ^= Route._position_hash(node, p) ^ Route._position_hash(node, i + k - p)
+        return route_hash
+
+    @staticmethod
+    def node_key(node):
+        """"
+        A key that identifies a node in a tour. Store copies of the relaxed route are told apart by their job.
+        """
+        if isinstance(node, Store):
+            job = node.get_job()
+            return 'store', node.id, job.id if job is not None else None
+        return 'job', node.id
+
+    @staticmethod
+    def _position_hash(node, position):
+        key = Route.node_key(node)
+        value = _node_keys.get(key)
+        if value is None:
+            import hashlib
+            digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+            value = int.from_bytes(digest, 'little')
+            _node_keys[key] = value
+        # mixes the position into the node value, multiplication by an odd constant is a bijection modulo 2^128
+        return ((value ^ (position * 0x9E3779B97F4A7C15F39CC0605CEDC835)) * 0xD6E8FEB86659FD93A5B5E8D1C0FFEE2B) & _MASK
+
     def evaluate(self, end_with_start_loc=True):
         """"
         Score the tour by self.evaluator
@@ -287,7 +570,7 @@ class Route:
 
     def __str__(self):
         stringbuilder = list()
-        stringbuilder.extend(self.__dict__['tour'])
+        stringbuilder.extend(self.tour)
         return "Route[" + ", ".join(str(x) for x in stringbuilder) + "]"
 
     def __repr__(self):
@@ -308,13 +591,6 @@ class Route:
     def deliverer(self):
         return self.locations['deliverers'][0]
 
-    @staticmethod
-    def get_node_by_id(id):
-        if len(Route.id_to_obj_map) == 0:
-            raise NotImplementedError('Please run Route._generate_map() first')
-        else:
-            return Route.id_to_obj_map[id]
-
     def id(self):
         id = 0
         for node in self.tour:
@@ -322,7 +598,73 @@ class Route:
 
         return id
 
+    def content_name(self):
+        """"
+        A stable name of the route: a hex digest of the driver and the tour, see route_hash. Unlike id, which sums the
+        node ids, different tours do not get the same name.
+        """
+        import hashlib
+        return hashlib.blake2b(repr((self.deliverer().id, self.route_hash())).encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def stops(self, time_window=False):
+        """"
+        Returns the stops of the route as dicts of label, lat, lon and fulfillment_id, from and back to the start
+        location of the deliverer. A store is a stop per job picked up there.
+        """
+        val = list()
+        val.append({
+            "label": "init_loc",
+            "lat": self.deliverer().get_latitude(),
+            "lon": self.deliverer().get_longitude(),
+            "fulfillment_id": "null"
+        })
+
+        for node in self.tour:
+            if isinstance(node, Job):
+                dic = {
+                    "label": node.label,
+                    "lat": node.get_latitude(),
+                    "lon": node.get_longitude(),
+                    "fulfillment_id": node.fulfillment_id
+                }
+                val.append(dic)
+            elif isinstance(node, Store):
+                if not time_window:
+                    fullfilment_ids = self.match_data(node)
+                    for f_id in fullfilment_ids[node.id]:
+                        dic = {
+                            "label": node.label,
+                            "lat": node.get_latitude(),
+                            "lon": node.get_longitude(),
+                            "fulfillment_id": f_id
+                        }
+                        val.append(dic)
+                else:
+                    job = node.get_job()
+                    dic = {
+                        "label": node.label,
+                        "lat": node.get_latitude(),
+                        "lon": node.get_longitude(),
+                        "fulfillment_id": job.fulfillment_id
+                    }
+                    val.append(dic)
+            else:
+                raise TypeError("Node is of unfamiliar type")
+
+        val.append({
+            "label": "end_loc",
+            "lat": self.deliverer().get_latitude(),
+            "lon": self.deliverer().get_longitude(),
+            "fulfillment_id": "null"
+        })
+        return val
+
     def dump(self, file_path = None, file_name=None, append_to=None, time_window=False):
+            """"
+            Writes the stops of the route to a pretty printed json file named after the content of the route, see
+            solutions.SolutionWriter to write many routes to one file
+            """
             if file_path is None:
                 file_path = os.getcwd()
                 file_path =  file_path.replace("\src", "")
@@ -330,75 +672,23 @@ class Route:
 
             if file_name is None:
                 if append_to is not None:
-                    file_name = file_path + str(self.id()) + "_" + str(append_to) + '.json'
+                    file_name = file_path + self.content_name() + "_" + str(append_to) + '.json'
                 else:
-                    file_name = file_path + str(self.id()) + '.json'
+                    file_name = file_path + self.content_name() + '.json'
 
             if not os.path.exists(file_path):
                 os.mkdir(file_path)
 
-
-            val = list()
-            val.append({
-                "label": "init_loc",
-                "lat": self.deliverer().get_latitude(),
-                "lon": self.deliverer().get_longitude(),
-                "fulfillment_id": "null"
-            })
-
-            for node in self.tour:
-                if isinstance(node, Job):
-                    dic = {
-                        "label": node.label,
-                        "lat": node.get_latitude(),
-                        "lon": node.get_longitude(),
-                        "fulfillment_id": node.fulfillment_id
-                    }
-                    val.append(dic)
-                elif isinstance(node, Store):
-                    if not time_window:
-                        fullfilment_ids = self.match_data(node)
-                        for f_id in fullfilment_ids[node.id]:
-                            dic = {
-                                "label": node.label,
-                                "lat": node.get_latitude(),
-                                "lon": node.get_longitude(),
-                                "fulfillment_id": f_id
-                            }
-                            val.append(dic)
-                    else:
-                        job = node.get_job()
-                        dic = {
-                            "label": node.label,
-                            "lat": node.get_latitude(),
-                            "lon": node.get_longitude(),
-                            "fulfillment_id": job.fulfillment_id
-                        }
-                        val.append(dic)
-                else:
-                    raise TypeError("Node is of unfamiliar type")
-
-            val.append({
-                "label": "end_loc",
-                "lat": self.deliverer().get_latitude(),
-                "lon": self.deliverer().get_longitude(),
-                "fulfillment_id": "null"
-            })
-
-            f = {"route": val}
+            import json
+            f = {"route": self.stops(time_window=time_window)}
             with open(file_name, 'w') as outfile:
                 json.dump(f,outfile, indent=4)
 
     def match_data(self, node):
         matched = {}
-        for store in self.stores():
-            if store.id == node.id:
-                for job in self.jobs():
-                    if node.id == job.store['id']:
-                        if store.id in matched:
-                            matched[store.id].append(job.id)
-                        else:
-                            matched[store.id] = [job.id]
+        jobs = self.index.jobs_of(node.id)
+        if node.id in self.index.store_by_id and len(jobs) > 0:
+            matched[node.id] = [job.id for job in jobs]
         return matched
 
 
@@ -412,6 +702,393 @@ class Request:
 
 
 
+class ProblemIndex:
+    """"
+    Index of the jobs and stores of a problem, built once in O(jobs + stores) by hashing the jobs on store['id']. It
+    replaces the nested loops over stores and jobs: it gives the jobs of a store, the store of a job, the requests and
+    the codes of the Codec. Use ProblemIndex.of to share the index between all routes of the same problem.
+
+    When several stores have the same id (the store copies of a relaxed route) the first one is the store of the id.
+    """
+    def __init__(self, jobs, stores):
+        self.jobs = jobs
+        self.stores = stores
+        self.store_by_id = {}
+        for store in stores:
+            self.store_by_id.setdefault(store.id, store)
+        self.jobs_by_store_id = {}
+        for job in jobs:
+            self.jobs_by_store_id.setdefault(job.store['id'], []).append(job)
+        self.requests = [Request(self.store_by_id[job.store['id']], job) for job in jobs
+                         if job.store['id'] in self.store_by_id]
+        self.job_codes = {job.id: i for i, job in enumerate(jobs)}
+        self.store_codes = {}
+        for i, store in enumerate(stores):
+            self.store_codes.setdefault(store.id, len(jobs) + i)
+
+    @staticmethod
+    def of(jobs, stores):
+        """"
+        Returns the index of these jobs and stores lists, the last few indexes are reused as long as the lists have
+        the same length
+        """
+        key = (id(jobs), id(stores), len(jobs), len(stores))
+        # routes of problems solved in other threads use the same few slots
+        with _problem_indexes_lock:
+            index = _problem_indexes.get(key)
+            if index is not None and index.jobs is jobs and index.stores is stores:
+                _problem_indexes.move_to_end(key)
+                return index
+        index = ProblemIndex(jobs, stores)
+        with _problem_indexes_lock:
+            _problem_indexes[key] = index
+            if len(_problem_indexes) > _MAX_PROBLEM_INDEXES:
+                _problem_indexes.popitem(last=False)
+        return index
+
+    def jobs_of(self, store_id):
+        return self.jobs_by_store_id.get(store_id, [])
+
+    def store_of(self, job):
+        return self.store_by_id.get(job.store['id'])
+
+    def groups(self, include_empty=False):
+        """"
+        Returns a dict of store id -> (store, list of jobs of that store), in the order of the stores
+        """
+        groups = {}
+        for store in self.stores:
+            if store.id not in groups:
+                jobs = self.jobs_of(store.id)
+                if include_empty or len(jobs) > 0:
+                    groups[store.id] = (store, jobs)
+        return groups
+
+    def codes(self):
+        """"
+        Returns the encoded (node -> code) and decoded (code -> {'store', 'jobs'}) maps of the Codec. Every store with
+        jobs gets a code from 1 in the order of the stores, its jobs get the same code.
+        """
+        encoded = {}
+        decoded = {}
+        i = 1
+        for store, jobs in self.groups().values():
+            decoded[i] = {'store': store, 'jobs': jobs}
+            encoded[store] = i
+            for job in jobs:
+                encoded[job] = i
+            i += 1
+        return encoded, decoded
+
+    def encode(self, tour):
+        """"
+        Returns the tour as an array of int32 codes, those of solutions.SolutionWriter: a job is its index in the jobs,
+        a store len(jobs) + its index in the stores and the store copy of a relaxed route -(index of its job + 1)
+        """
+        codes = array('i')
+        job_codes = self.job_codes
+        for node in tour:
+            if isinstance(node, Job):
+                codes.append(job_codes[node.id])
+            elif node.get_job() is not None:
+                codes.append(-(job_codes[node.get_job().id] + 1))
+            else:
+                codes.append(self.store_codes[node.id])
+        return codes
+
+    def decode(self, codes, copies=None):
+        """"
+        Returns the nodes of the codes of encode
+
+        :param: copies: dict job id -> the store copy of that job in a relaxed route, a copy that is not in it is made
+        """
+        copies = {} if copies is None else copies
+        nr_jobs = len(self.jobs)
+        tour = []
+        for code in codes:
+            if code >= nr_jobs:
+                tour.append(self.stores[code - nr_jobs])
+            elif code >= 0:
+                tour.append(self.jobs[code])
+            else:
+                job = self.jobs[-code - 1]
+                store = copies.get(job.id)
+                if store is None:
+                    store = self.store_of(job).copy()
+                    store.set_job(job)
+                    copies[job.id] = store
+                tour.append(store)
+        return tour
+
+
+class CompactRoute:
+    """"
+    A route as plain integers, to send it to another process, checkpoint it or return it from a service without the
+    object graph of its jobs, stores and dicts. It has the int32 codes of the tour, see ProblemIndex.encode, and
+    optionally the move log that leads from a base route to the tour, see Route.record_moves. A receiver that has the
+    base route only needs the moves, see without_codes, and two routes of the same base differ by a few moves.
+
+    The full Route, e.g. for Route.dump or Route.pretty_print, is only built when needed: route(template) decodes the
+    codes on the nodes of a route of the same problem, replay(base) applies the moves to the base route.
+    """
+    __slots__ = ('codes', 'moves', 'base_hash')
+    # a move is written as its kind and four int32 arguments
+    move_kinds = ('swap', 'two_opt', 'relocate_pair', 'or_opt', 'repair')
+
+    def __init__(self, codes=None, moves=None, base_hash=None):
+        """"
+        :param: codes: array of the int32 codes of the tour
+        :param: moves: list of Route.apply_move tuples from the base route to the tour
+        :param: base_hash: int Route.route_hash of the base route of the moves
+        """
+        if codes is None and moves is None:
+            raise ValueError('A compact route needs the codes or the moves of its tour')
+        self.codes = codes
+        self.moves = moves
+        self.base_hash = base_hash
+
+    @staticmethod
+    def of(route, moves=True):
+        """"
+        Returns the compact route of a route, with its move log when it records moves
+        """
+        recorded = route.recorded_moves() if moves else None
+        return CompactRoute(route.index.encode(route.tour), recorded,
+                            route._moves_base if recorded is not None else None)
+
+    def __len__(self):
+        return len(self.codes) if self.codes is not None else 0
+
+    def without_codes(self):
+        """"
+        Returns this route as its moves only, for a receiver that has the base route
+        """
+        if self.moves is None:
+            raise ValueError('The compact route has no moves')
+        return CompactRoute(None, self.moves, self.base_hash)
+
+    def route(self, template):
+        """"
+        Returns the route of the codes on the nodes of the template, a route of the same problem. The store copies of a
+        relaxed route are those of the template when it has them. Without codes the template is the base route of the
+        moves, see replay. Raises a ValueError for a tour that visits the stores once on a relaxed template, the index
+        of a relaxed route only has the store copies.
+        """
+        if self.codes is None:
+            return self.replay(template)
+        copies = {node.get_job().id: node for node in template.tour
+                  if isinstance(node, Store) and node.get_job() is not None}
+        relaxed_template = len(copies) > 0
+        if relaxed_template and len(self.codes) > 0 and max(self.codes) >= len(template.index.jobs):
+            raise ValueError('A tour that visits the stores once can not be decoded on a relaxed route')
+        # decode adds the store copies it makes to copies
+        tour = template.index.decode(self.codes, copies)
+        relaxed_tour = len(copies) > 0
+        if relaxed_tour and not relaxed_template:
+            # a relaxed tour on a template without store copies, the route gets the store copies of the tour
+            route = Route(template.jobs(), [node for node in tour if isinstance(node, Store)],
+                          [template.deliverer()], template.distances_matrix, template.evaluator)
+        else:
+            route = template.copy()
+        route.tour = tour
+        return route
+
+    def replay(self, base):
+        """"
+        Returns a copy of the base route with the moves applied, the copy records the moves again. Raises a ValueError
+        when base is not the base route of the moves.
+        """
+        if self.moves is None:
+            raise ValueError('The compact route has no moves')
+        if self.base_hash is not None and base.route_hash() != self.base_hash:
+            raise ValueError('The route is not the base route of the moves')
+        route = base.copy()
+        route.record_moves()
+        for move in self.moves:
+            route.apply_move(move)
+        return route
+
+    def diff(self, other):
+        """"
+        Returns the (position, code, code of other) where the tours of two compact routes differ, a code is None past
+        the end of the shorter tour
+        """
+        if self.codes is None or other.codes is None:
+            raise ValueError('Compact routes without codes are compared by their moves')
+        differences = []
+        for i in range(max(len(self.codes), len(other.codes))):
+            code = self.codes[i] if i < len(self.codes) else None
+            other_code = other.codes[i] if i < len(other.codes) else None
+            if code != other_code:
+                differences.append((i, code, other_code))
+        return differences
+
+    def tobytes(self):
+        """"
+        Returns the compact route as bytes: a header with the base hash, the flags and the numbers of codes and moves,
+        then the codes and five int32 per move
+        """
+        flags = (_HAS_CODES if self.codes is not None else 0) | (_HAS_MOVES if self.moves is not None else 0) | \
+            (_HAS_BASE if self.base_hash is not None else 0)
+        base = (self.base_hash or 0).to_bytes(16, 'little')
+        codes = self.codes if self.codes is not None else array('i')
+        moves = array('i')
+        for move in self.moves or ():
+            moves.append(CompactRoute.move_kinds.index(move[0]))
+            arguments = [int(argument) for argument in move[1:]]
+            moves.extend(arguments + [0] * (4 - len(arguments)))
+        return _COMPACT_HEADER.pack(base, flags, len(codes), len(self.moves or ())) + codes.tobytes() + \
+            moves.tobytes()
+
+    @staticmethod
+    def frombytes(data):
+        base, flags, nr_codes, nr_moves = _COMPACT_HEADER.unpack_from(data)
+        offset = _COMPACT_HEADER.size
+        codes = array('i')
+        codes.frombytes(data[offset:offset + 4 * nr_codes])
+        values = array('i')
+        values.frombytes(data[offset + 4 * nr_codes:offset + 4 * nr_codes + 20 * nr_moves])
+        moves = []
+        for m in range(nr_moves):
+            kind = CompactRoute.move_kinds[values[5 * m]]
+            arguments = values[5 * m + 1:5 * m + 5]
+            if kind == 'repair':
+                moves.append((kind,))
+            elif kind in ('swap', 'two_opt'):
+                moves.append((kind, arguments[0], arguments[1]))
+            elif kind == 'or_opt':
+                moves.append((kind, arguments[0], arguments[1], arguments[2], bool(arguments[3])))
+            else:
+                moves.append((kind,) + tuple(arguments))
+        return CompactRoute(codes if flags & _HAS_CODES else None, moves if flags & _HAS_MOVES else None,
+                            int.from_bytes(base, 'little') if flags & _HAS_BASE else None)
+
+    def __reduce__(self):
+        # pickles as the bytes of tobytes
+        return CompactRoute.frombytes, (self.tobytes(),)
+
+    def __eq__(self, other):
+        return isinstance(other, CompactRoute) and self.codes == other.codes and self.moves == other.moves and \
+            self.base_hash == other.base_hash
+
+    def __hash__(self):
+        return hash((bytes(self.codes) if self.codes is not None else None, self.base_hash))
+
+
+class ProblemContext:
+    """"
+    Everything of one problem that does not change while it is solved: the jobs, stores and deliverers, their
+    ProblemIndex, the distances and the nodes by id. A context is immutable and holds no global state, so the problems
+    of many drivers can be solved side by side in one process or a thread pool, see algorithms.batch.
+
+    For many drivers over the same stores, compute the distances between the stores once, a DistancesMatrix of the
+    stores, and pass it as store_distances: every context then only computes the rows and columns of its own jobs and
+    driver, see for_drivers.
+    """
+    def __init__(self, jobs, stores, deliverers, distances_matrix=None, provider=None, store_distances=None):
+        """"
+        :param: distances_matrix: locations.DistancesMatrix of the jobs, stores and deliverers, computed when not given
+        :param: provider: distances.DistanceProvider of a computed matrix
+        :param: store_distances: locations.DistancesMatrix optional shared distances between the stores
+        """
+        jobs = tuple(jobs)
+        stores = tuple(stores)
+        deliverers = tuple(deliverers)
+        if distances_matrix is None:
+            distances_matrix = DistancesMatrix(list(jobs + stores + deliverers), provider, shared=store_distances)
+        nodes = {}
+        for node in jobs + stores + deliverers:
+            nodes.setdefault(node.id, node)
+        object.__setattr__(self, 'jobs', jobs)
+        object.__setattr__(self, 'stores', stores)
+        object.__setattr__(self, 'deliverers', deliverers)
+        object.__setattr__(self, 'distances_matrix', distances_matrix)
+        object.__setattr__(self, 'index', ProblemIndex(jobs, stores))
+        object.__setattr__(self, 'nodes_by_id', MappingProxyType(nodes))
+
+    def __setattr__(self, name, value):
+        raise TypeError('A ProblemContext can not be changed')
+
+    def get_node_by_id(self, id):
+        return self.nodes_by_id[id]
+
+    def route(self, evaluator):
+        """"
+        Returns a new, empty route of this problem, see Route.generate_initial_route
+        """
+        return Route(self.jobs, self.stores, self.deliverers, self.distances_matrix, evaluator, index=self.index)
+
+    def codec(self, evaluator):
+        return Codec(self.jobs, self.stores, self.deliverers, self.distances_matrix, evaluator)
+
+    @staticmethod
+    def for_drivers(assignments, stores, store_distances=None, provider=None):
+        """"
+        Returns a context per driver: assignments is a list of (deliverer, jobs), the context of a driver has the
+        stores of its jobs. The store to store distances are computed once, or taken from store_distances.
+        """
+        if store_distances is None:
+            store_distances = DistancesMatrix(list(stores), provider)
+        store_by_id = {}
+        for store in stores:
+            store_by_id.setdefault(store.id, store)
+        contexts = []
+        for deliverer, jobs in assignments:
+            own_stores = []
+            for job in jobs:
+                store = store_by_id[job.store['id']]
+                if store not in own_stores:
+                    own_stores.append(store)
+            contexts.append(ProblemContext(jobs, own_stores, [deliverer], store_distances=store_distances))
+        return contexts
+
+
+class TimeWindowIndex:
+    """"
+    The locations of a route sorted by the start of their time window, the start of a store copy is the start of its
+    job. The locations that start before a location, or in a horizon before it, are a slice of the sorted locations
+    with binary searchable bounds. Pairs of locations are generated from these slices, so pairs in the wrong order or
+    with the same start are never created.
+    """
+    def __init__(self, locations):
+        self.locations = sorted(locations, key=TimeWindowIndex.time_start)
+        self.starts = [TimeWindowIndex.time_start(location) for location in self.locations]
+
+    def earlier(self, location, time_horizon=None):
+        """"
+        Returns the locations that start before location, at most time_horizon seconds before when it is given
+        """
+        start = TimeWindowIndex.time_start(location)
+        high = bisect.bisect_left(self.starts, start)
+        low = 0 if time_horizon is None else bisect.bisect_left(self.starts, start - time_horizon)
+        return self.locations[low:high]
+
+    def pairs(self, time_horizon=None):
+        """"
+        Returns all pairs (location, earlier location) whose starts differ, by at most time_horizon seconds when it is
+        given. These are the pairs _solve_with_time_windows of the HillClimbing tries, in O(pairs).
+        """
+        pairs = []
+        low = 0
+        high = 0
+        for j in range(len(self.locations)):
+            start = self.starts[j]
+            while self.starts[high] < start:
+                high += 1
+            if time_horizon is not None:
+                while self.starts[low] < start - time_horizon:
+                    low += 1
+            later = self.locations[j]
+            pairs.extend((later, earlier) for earlier in self.locations[low:high])
+        return pairs
+
+    @staticmethod
+    def time_start(location):
+        if isinstance(location, Store):
+            return location.get_job().get_time_start()
+        return location.get_time_start()
+
+
 class Codec:
     def __init__(self, jobs, stores, deliverer, dist_matrix, evaluator):
         self.jobs = jobs
@@ -423,28 +1100,16 @@ class Codec:
 
 
     def _run(self):
-        matched = {}
-        decoded = {}
-        encoded = {}
-        for store in self.stores:
-            for job in self.jobs:
-                if store.id == job.store['id']:
-                    if store in matched:
-                        matched[store].append(job)
-                    else:
-                        matched[store] = [job]
-        i = 1
-        for k, v in matched.items():
-            items = {}
-            items['store'] = k
-            items['jobs'] = v
-            decoded[i] = items
-            encoded[k] = i
-            for job in v:
-                encoded[job] = i
-            i += 1
+        return ProblemIndex.of(self.jobs, self.stores).codes()
 
-        return encoded, decoded
+    def groups(self):
+        """"
+        Returns a dict of store id -> (store, list of jobs of that store)
+        """
+        groups = {}
+        for items in self._decoded.values():
+            groups[items['store'].id] = (items['store'], items['jobs'])
+        return groups
 
     def _encode_node(self, obj):
         return self._encoded[obj]
@@ -1,18 +1,24 @@
 from src.locations import Job, Store
-import logging
+from collections import OrderedDict
+import bisect
+import sys
 
 
 class DistanceEvaluator:
     """"
     This evaluator measures the total tavel distance for the pick up and delivery traveling salesman problem
 
-    It uses a penalty value of 1000 kms for infeasible routes
+    It uses a penalty value of 1000 kms for infeasible routes and for every unit of load above the capacity of the
+    driver, see LoadProfile
     """
+    presedence_order_penalty = 1000
+    capacity_penalty = 1000
+
     @staticmethod
     def evaluate_distance(route, driver_ends_at_start=True):
         deliverer = route.deliverer()
         dist_matrix = route.distances_matrix
-        presedence_order_penalty = 1000
+        presedence_order_penalty = DistanceEvaluator.presedence_order_penalty
         total_distance = 0
         presedence_violations = 0
         if driver_ends_at_start:
@@ -68,12 +74,14 @@ class DistanceEvaluator:
                     total_distance += dist_matrix.get_distance(last_location, location)
 
             score = total_distance + presedence_violations * presedence_order_penalty
+        score += DistanceEvaluator.capacity_penalty * LoadProfile.excess_of(route.tour, deliverer)
         return score
 
     @staticmethod
     def find_index_corresponding_store(job, route):
         """"
-        Returns the index of the store corresponding to the job in the given route
+        Returns the index of the store corresponding to the job in the given route. The debug record is only logged
+        when logging is already imported, which keeps its import off the evaluation path
         """
         store_id_to_find = job.store['id']
         index_to_return = None
@@ -82,51 +90,59 @@ class DistanceEvaluator:
             if isinstance(location, Store):
                 store_id = location.id
                 if store_id_to_find == store_id:
-                    logging.debug("Corresponding store for job " + str(job) + " is " + str(location))
                     index_to_return = i
         if index_to_return == None:
+            import logging
             logging.warning("Couldn't find store for job " + str(job))
+        elif 'logging' in sys.modules:
+            sys.modules['logging'].debug("Corresponding store for job " + str(job) + " is " +
+                                         str(route.tour[index_to_return]))
         return index_to_return
 
 
 class TimeEvaluator:
     """"
     A time evaluator. This evaluator measures the score as provided in the instructions for problem 2
+
+    Travel times come from the distances matrix, see DistancesMatrix.get_travel_time. Every unit of load above the
+    capacity of the driver adds capacity_penalty, see LoadProfile
     """
+    speed = 4.1 #m/s
+    time_spent_at_customer = 250 #seconds
+    presedence_violation = 1000
+    capacity_penalty = 10 ** 12
+
     @staticmethod
     def evaluate_distance(route, driver_ends_at_start=True):
         dist_matrix = route.distances_matrix
         time = route.deliverer().get_shift_start()
-        speed = 4.1 #m/s
-        time_spent_at_customer = 250 #seconds
+        speed = TimeEvaluator.speed
+        time_spent_at_customer = TimeEvaluator.time_spent_at_customer
         tour = route.tour
-        presedence_violation = 1000
+        presedence_violation = TimeEvaluator.presedence_violation
         score = 0
         for i in range(len(tour)):
-            distance = None
+            factor = 1
             node = tour[i]
             if i == 0:
+                source = route.deliverer()
                 if isinstance(node, Job):
-                    distance = dist_matrix.get_distance(route.deliverer(), node)  # km
-                    distance = distance * presedence_violation
-                else:
-                    distance = dist_matrix.get_distance(route.deliverer(), node)  # km
+                    factor = presedence_violation
 
             elif i == len(route.tour)-1:
-                distance = dist_matrix.get_distance(route.deliverer(), node)  # km
+                source = route.deliverer()
             else:
                 last_location = route.tour[i - 1]
                 if isinstance(node, Job):
+                    source = route.deliverer()
                     index_of_corr_store = TimeEvaluator.find_index_corresponding_store(node, route)
                     if index_of_corr_store > i:
-                        distance = dist_matrix.get_distance(route.deliverer(), node)  # km
-                        distance = distance * presedence_violation
-                    else:
-                        distance = dist_matrix.get_distance(route.deliverer(), node)  # km
+                        factor = presedence_violation
                 else:
-                    distance = dist_matrix.get_distance(last_location, node)
+                    source = last_location
 
-            travel_time = distance * 1000 / speed
+            # seconds, the distance driven at speed unless the distances matrix has its own travel times
+            travel_time = dist_matrix.get_travel_time(source, node, time, speed, factor)
             arrival_at_customer = time + travel_time
             if isinstance(node, Store):
                 job = node.get_job()
@@ -141,6 +157,7 @@ class TimeEvaluator:
             node_score = (arrival_at_customer - t_customer_start) ** 2
             score += node_score
 
+        score += TimeEvaluator.capacity_penalty * LoadProfile.excess_of(tour, route.deliverer())
         return score
 
     @staticmethod
@@ -155,10 +172,956 @@ class TimeEvaluator:
                 corr_job = location.get_job()
                 corr_job_id = corr_job.id
                 if corr_job.id == job.id:
-                    logging.debug("Corresponding store for job " + str(job) + " is " + str(location))
                     index_to_return = i
 
         if index_to_return == None:
+            import logging
             logging.warning("Couldn't find store for job " + str(job))
+        elif 'logging' in sys.modules:
+            sys.modules['logging'].debug("Corresponding store for job " + str(job) + " is " +
+                                         str(route.tour[index_to_return]))
+
+        return index_to_return
+
+
+class RouteCache:
+    """"
+    Shared move scoring of the incremental route caches. Moves are tuples of the form:
+
+    - ('swap', index1, index2)
+    - ('two_opt', index1, index2)
+    - ('relocate_pair', store_index, job_index, new_store_index, new_job_index)
+    - ('or_opt', start, length, new_index, reverse)
+
+    The new indices of relocate_pair and or_opt refer to the tour with the moved nodes taken out, see
+    Route.apply_move. Subclasses implement evaluate_pieces.
+    """
+    def index_of(self, node):
+        return self.position.get(id(node))
+
+    def move_score(self, move):
+        """"
+        Returns the score of the route after applying move
+        """
+        if move[0] == 'swap':
+            score = self.swap_score(move[1], move[2])
+        elif move[0] == 'two_opt':
+            score = self.two_opt_score(move[1], move[2])
+        elif move[0] == 'relocate_pair':
+            score = self.relocate_pair_score(move[1], move[2], move[3], move[4])
+        elif move[0] == 'or_opt':
+            score = self.or_opt_score(move[1], move[2], move[3], move[4])
+        else:
+            raise TypeError('Unknown move ' + str(move[0]))
+        if isinstance(score, tuple):
+            return score[0]
+        return score
+
+    def pieces_score(self, pieces):
+        """"
+        Returns only the score of evaluate_pieces
+        """
+        score = self.evaluate_pieces(pieces)
+        if isinstance(score, tuple):
+            return score[0]
+        return score
+
+    def relocate_pair_score(self, store_index, job_index, new_store_index, new_job_index):
+        """"
+        Returns the score of the route after taking out the store and job at the given indices and inserting them
+        again before new_store_index and new_job_index of the remaining tour, new_store_index <= new_job_index.
+        O(1) plus the touched nodes.
+        """
+        tour = self.route.tour
+        return self.evaluate_pieces(move_pieces(len(tour), [store_index, job_index],
+                                                [(new_store_index, tour[store_index]),
+                                                 (new_job_index, tour[job_index])]))
+
+    def or_opt_score(self, start, length, new_index, reverse=False):
+        """"
+        Returns the score of the route after moving the segment of length nodes at start, optionally reversed, before
+        new_index of the remaining tour. O(segment)
+        """
+        tour = self.route.tour
+        segment = tour[start:start + length]
+        if reverse:
+            segment = list(reversed(segment))
+        return self.evaluate_pieces(move_pieces(len(tour), list(range(start, start + length)),
+                                                [(new_index, node) for node in segment]))
+
+
+class LoadProfile:
+    """"
+    The load of the driver along a route. A store adds the capacity of the jobs that are picked up there, the job of a
+    store copy in a relaxed route or all the jobs of the store in the tour otherwise, and a job takes its capacity off
+    again. The driver starts empty, load[i] is the load after the node at position i.
+
+    Next to the prefix loads the profile keeps sparse tables of the range maxima and minima of the loads. The nodes of
+    an unchanged stretch of the route keep their loads up to a constant shift, so the largest load of a tour that is
+    built from pieces of the current tour (see RouteCache.evaluate_pieces) follows in O(1) per piece. That makes the
+    capacity check of a swap, a 2-opt and a pair relocation O(1).
+
+    A driver without a capacity is never overloaded. The profile describes the route as it was at the last call to
+    update().
+    """
+    def __init__(self, route):
+        self.route = route
+        self.update()
+
+    def update(self, route=None):
+        """"
+        (Re)builds the profile for the given route, or for the route the profile was created with. O(n log n)
+        """
+        if route is not None:
+            self.route = route
+        tour = self.route.tour
+        self.capacity = self.route.deliverer().capacity
+        self.picked_up = LoadProfile._picked_up(tour)
+        self.change = {}
+        self.load = [0] * len(tour)
+        load = 0
+        for i in range(len(tour)):
+            change = LoadProfile._change(tour[i], self.picked_up)
+            self.change[id(tour[i])] = change
+            load += change
+            self.load[i] = load
+        self.maxima = LoadProfile._sparse_table(self.load, max)
+        self.minima = LoadProfile._sparse_table(self.load, min)
+        self.max_load = max(self.load) if self.load else 0
+        self.excess = self.excess_above(self.max_load)
+        return self.excess
+
+    def excess_above(self, max_load):
+        """"
+        Returns the load above the capacity of the driver
+        """
+        if self.capacity is None:
+            return 0
+        return max(0, max_load - self.capacity)
+
+    def range_max(self, a, b):
+        """"
+        Returns the largest load of the positions a up to b, b > a. O(1)
+        """
+        return LoadProfile._query(self.maxima, a, b, max)
+
+    def range_min(self, a, b):
+        return LoadProfile._query(self.minima, a, b, min)
+
+    def load_before(self, index):
+        return self.load[index - 1] if index > 0 else 0
+
+    def swap_excess(self, index1, index2):
+        """"
+        Returns the excess load after swapping the nodes at both indices: only the loads in between shift. O(1)
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        if i == k:
+            return self.excess
+        tour = self.route.tour
+        shift = self.change[id(tour[k])] - self.change[id(tour[i])]
+        max_load = max(self.range_max(i, k) + shift, self.range_max(k, len(tour)))
+        if i > 0:
+            max_load = max(max_load, self.range_max(0, i))
+        return self.excess_above(max_load)
+
+    def two_opt_excess(self, index1, index2):
+        """"
+        Returns the excess load after reversing the nodes between both indices (inclusive). The node that ends up at
+        position p in between has load load_before(i) + load[k] - load[i + k - p - 1], so the largest of them comes
+        from the smallest load of the positions i - 1 up to k - 1. O(1)
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        before = self.load_before(i)
+        smallest = min(before, self.range_min(i, k)) if k > i else before
+        max_load = before + self.load[k] - smallest
+        if i > 0:
+            max_load = max(max_load, self.range_max(0, i))
+        if k + 1 < len(self.load):
+            max_load = max(max_load, self.range_max(k + 1, len(self.load)))
+        return self.excess_above(max_load)
+
+    def pieces_excess(self, pieces):
+        """"
+        Returns the excess load of a new tour described as a list of pieces, see RouteCache.evaluate_pieces. O(1) per
+        old piece and per new node.
+        """
+        load = 0
+        max_load = 0
+        for piece in pieces:
+            if piece[0] == 'new':
+                for node in piece[1]:
+                    change = self.change.get(id(node))
+                    load += LoadProfile._change(node, self.picked_up) if change is None else change
+                    max_load = max(max_load, load)
+            elif piece[2] > piece[1]:
+                a, b = piece[1], piece[2]
+                shift = load - self.load_before(a)
+                max_load = max(max_load, self.range_max(a, b) + shift)
+                load = self.load[b - 1] + shift
+        return self.excess_above(max_load)
+
+    @staticmethod
+    def excess_of(tour, deliverer):
+        """"
+        Returns the load above the capacity of the deliverer along the tour in O(n), for the evaluators
+        """
+        if deliverer.capacity is None:
+            return 0
+        picked_up = LoadProfile._picked_up(tour)
+        load = 0
+        max_load = 0
+        for node in tour:
+            load += LoadProfile._change(node, picked_up)
+            max_load = max(max_load, load)
+        return max(0, max_load - deliverer.capacity)
+
+    @staticmethod
+    def _picked_up(tour):
+        """"
+        The load that is picked up at every store that is visited once for all its jobs, by store id
+        """
+        picked_up = {}
+        for node in tour:
+            if isinstance(node, Job):
+                picked_up[node.store['id']] = picked_up.get(node.store['id'], 0) + _capacity(node)
+        return picked_up
+
+    @staticmethod
+    def _change(node, picked_up):
+        if isinstance(node, Job):
+            return -_capacity(node)
+        job = node.get_job()
+        if job is not None:
+            return _capacity(job)
+        return picked_up.get(node.id, 0)
+
+    @staticmethod
+    def _sparse_table(values, function):
+        table = [list(values)]
+        width = 1
+        while 2 * width <= len(values):
+            level = table[-1]
+            table.append([function(level[i], level[i + width]) for i in range(len(values) - 2 * width + 1)])
+            width *= 2
+        return table
+
+    @staticmethod
+    def _query(table, a, b, function):
+        level = (b - a).bit_length() - 1
+        return function(table[level][a], table[level][b - (1 << level)])
+
+
+class TimeWindowCache(RouteCache):
+    """"
+    Caches the prefix arrival times of a route that is scored by the TimeEvaluator, in the style of Savelsbergh's
+    forward time slack. Next to the arrival time of every node it keeps prefix sums of the deviations from the start of
+    the time windows and of their squares. A move only changes the travel time of a handful of nodes, every other node
+    just arrives a constant amount of time earlier or later. The score of such an unchanged stretch can be derived from
+    the prefix sums in O(1), which makes the score of a swap O(1) and the score of a 2-opt, relocate or insertion
+    O(segment) instead of a full TimeEvaluator run.
+
+    With time dependent travel times (see distances.SpeedProfileProvider) the shifted stretches are scored node by
+    node, so every move is O(n).
+
+    The forward time slack is the largest delay a node can get without pushing any later node past the end of its time
+    window. The TimeEvaluator has no hard time windows, but the slack is kept for screening moves in the hard sense.
+
+    The cache describes the route as it was at the last call to update(). Call update() after accepting a move.
+    """
+    def __init__(self, route):
+        self.route = route
+        self.update()
+
+    def update(self, route=None):
+        """"
+        (Re)builds the cache for the given route, or for the route the cache was created with. This is O(n).
+        """
+        if route is not None:
+            self.route = route
+        tour = self.route.tour
+        deliverer = self.route.deliverer()
+        n = len(tour)
+        self.position = {}
+        self.store_of = {}
+        for i in range(n):
+            node = tour[i]
+            self.position[id(node)] = i
+            if isinstance(node, Store) and node.get_job() is not None:
+                self.store_of[id(node.get_job())] = node
+
+        self.arrival = [0.0] * n
+        self.departure = [0.0] * n
+        self.deviation = [0.0] * n
+        self.prefix_deviation = [0.0] * (n + 1)
+        self.prefix_square = [0.0] * (n + 1)
+        self.forward_slack = [float('inf')] * (n + 1)
+
+        time = deliverer.get_shift_start()
+        score = 0
+        for i in range(n):
+            node = tour[i]
+            previous = tour[i - 1] if i > 0 else deliverer
+            travel_time = self._travel_time(node, previous, i, n - 1, self._violates(node, i, self.position), time)
+            arrival = time + travel_time
+            if isinstance(node, Store):
+                time = arrival
+            else:
+                time = arrival + TimeEvaluator.time_spent_at_customer
+            deviation = arrival - _time_window_start(node)
+            score += deviation ** 2
+            self.arrival[i] = arrival
+            self.departure[i] = time
+            self.deviation[i] = deviation
+            self.prefix_deviation[i + 1] = self.prefix_deviation[i] + deviation
+            self.prefix_square[i + 1] = self.prefix_square[i] + deviation ** 2
+
+        for i in range(n - 1, -1, -1):
+            slack = _time_window_end(tour[i]) - self.arrival[i]
+            self.forward_slack[i] = min(slack, self.forward_slack[i + 1])
+
+        self.loads = LoadProfile(self.route)
+        score += TimeEvaluator.capacity_penalty * self.loads.excess
+        self.score = score
+        return score
+
+    def delay_is_feasible(self, index, delay):
+        """"
+        Returns whether delaying the node at index (and thereby all nodes after it) by delay seconds keeps every node
+        before the end of its time window. O(1)
+        """
+        return delay <= self.forward_slack[index]
+
+    def swap_score(self, index1, index2):
+        """"
+        Returns the score of the route after swapping the nodes at both indices. O(1)
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        tour = self.route.tour
+        return self.evaluate_pieces([('old', 0, i), ('new', [tour[k]]), ('old', i + 1, k), ('new', [tour[i]]),
+                                     ('old', k + 1, len(tour))])
+
+    def two_opt_score(self, index1, index2):
+        """"
+        Returns the score of the route after reversing the nodes between both indices (inclusive). O(segment)
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        tour = self.route.tour
+        return self.evaluate_pieces([('old', 0, i), ('new', list(reversed(tour[i:k + 1]))),
+                                     ('old', k + 1, len(tour))])
+
+    def relocate_score(self, index, new_index):
+        """"
+        Returns the score of the route after moving the node at index so that it ends up at new_index. O(segment)
+        """
+        tour = self.route.tour
+        node = tour[index]
+        if new_index > index:
+            pieces = [('old', 0, index), ('old', index + 1, new_index + 1), ('new', [node]),
+                      ('old', new_index + 1, len(tour))]
+        else:
+            pieces = [('old', 0, new_index), ('new', [node]), ('old', new_index, index),
+                      ('old', index + 1, len(tour))]
+        return self.evaluate_pieces(pieces)
+
+    def insertion_score(self, store, job, store_index, job_index):
+        """"
+        Returns the score of the route after inserting store before the node at store_index and job before the node at
+        job_index, both indices refer to the current route. store_index <= job_index. O(1) plus the nodes whose
+        precedence changes.
+        """
+        n = len(self.route.tour)
+        return self.evaluate_pieces([('old', 0, store_index), ('new', [store]), ('old', store_index, job_index),
+                                     ('new', [job]), ('old', job_index, n)])
+
+    def evaluate_pieces(self, pieces):
+        """"
+        Scores a new tour that is described as a list of pieces. A piece is either ('old', a, b): the nodes of the
+        current tour from a up to b, or ('new', nodes): a list of nodes. Old pieces must appear in increasing order,
+        which holds for all the moves of this package. The nodes of old pieces whose travel time is unchanged are
+        scored in O(1) per piece.
+        """
+        tour = self.route.tour
+        deliverer = self.route.deliverer()
+        n_old = len(tour)
+
+        new_position = {}
+        old_pieces = []
+        p = 0
+        for piece in pieces:
+            if piece[0] == 'old':
+                if piece[2] > piece[1]:
+                    old_pieces.append((piece[1], piece[2], p - piece[1]))
+                    p += piece[2] - piece[1]
+            else:
+                for node in piece[1]:
+                    new_position[id(node)] = p
+                    p += 1
+        last = p - 1
+
+        def locate(node):
+            if id(node) in new_position:
+                return new_position[id(node)]
+            q = self.position.get(id(node))
+            if q is None:
+                return None
+            for a, b, offset in old_pieces:
+                if a <= q < b:
+                    return q + offset
+            return None
+
+        # jobs in the old pieces whose store moved need their precedence checked again
+        store_of = {}
+        recheck = set()
+        for piece in pieces:
+            if piece[0] == 'new':
+                for node in piece[1]:
+                    if isinstance(node, Store) and node.get_job() is not None:
+                        store_of[id(node.get_job())] = node
+                        job = node.get_job()
+                        if id(job) not in new_position and id(job) in self.position:
+                            recheck.add(self.position[id(job)])
+        recheck = sorted(recheck)
+
+        # a shifted stretch keeps its travel times only when they do not depend on the departure time
+        time_dependent = getattr(self.route.distances_matrix, 'time_dependent', False)
+        time = deliverer.get_shift_start()
+        previous = deliverer
+        score = 0
+        p = 0
+        for piece in pieces:
+            if piece[0] == 'new':
+                for node in piece[1]:
+                    violates = self._violates_at(node, p, locate, store_of)
+                    time, deviation = self._visit(node, previous, p, last, violates, time)
+                    score += deviation ** 2
+                    previous = node
+                    p += 1
+                continue
+
+            a, b = piece[1], piece[2]
+            q = a
+            while q < b:
+                if q == a or q == 0 or q == n_old - 1 or p == 0 or p == last or time_dependent or \
+                        self._in(recheck, q):
+                    node = tour[q]
+                    violates = self._violates_at(node, p, locate, store_of)
+                    time, deviation = self._visit(node, previous, p, last, violates, time)
+                    score += deviation ** 2
+                    previous = node
+                    p += 1
+                    q += 1
+                    continue
+
+                # the nodes from q up to r keep their travel times and are shifted by delta
+                r = min(b, n_old - 1, q + (last - p))
+                j = bisect.bisect_left(recheck, q)
+                if j < len(recheck):
+                    r = min(r, recheck[j])
+                delta = time - self.departure[q - 1]
+                score += self.prefix_square[r] - self.prefix_square[q] + \
+                    2 * delta * (self.prefix_deviation[r] - self.prefix_deviation[q]) + (r - q) * delta ** 2
+                time = self.departure[r - 1] + delta
+                previous = tour[r - 1]
+                p += r - q
+                q = r
+
+        return score + TimeEvaluator.capacity_penalty * self.loads.pieces_excess(pieces)
+
+    @staticmethod
+    def _in(sorted_list, value):
+        i = bisect.bisect_left(sorted_list, value)
+        return i < len(sorted_list) and sorted_list[i] == value
+
+    def _visit(self, node, previous, position, last, violates, time):
+        arrival = time + self._travel_time(node, previous, position, last, violates, time)
+        if isinstance(node, Store):
+            time = arrival
+        else:
+            time = arrival + TimeEvaluator.time_spent_at_customer
+        return time, arrival - _time_window_start(node)
+
+    def _travel_time(self, node, previous, position, last, violates, departure):
+        """"
+        The travel time to node exactly as the TimeEvaluator computes it
+        """
+        deliverer = self.route.deliverer()
+        factor = 1
+        if position == 0:
+            source = deliverer
+            if isinstance(node, Job):
+                factor = TimeEvaluator.presedence_violation
+        elif position == last:
+            source = deliverer
+        elif isinstance(node, Job):
+            source = deliverer
+            if violates:
+                factor = TimeEvaluator.presedence_violation
+        else:
+            source = previous
+        return self.route.distances_matrix.get_travel_time(source, node, departure, TimeEvaluator.speed, factor)
+
+    def _violates(self, node, position, positions):
+        if not isinstance(node, Job):
+            return False
+        store = self.store_of.get(id(node))
+        if store is None:
+            return False
+        store_position = positions.get(id(store))
+        return store_position is not None and store_position > position
+
+    def _violates_at(self, node, position, locate, store_of):
+        if not isinstance(node, Job):
+            return False
+        store = store_of.get(id(node), self.store_of.get(id(node)))
+        if store is None:
+            return False
+        store_position = locate(store)
+        return store_position is not None and store_position > position
+
+
+class DistanceCache(RouteCache):
+    """"
+    Caches the per position travel distance and precedence violations of a route that is scored by the
+    DistanceEvaluator, together with a position index of every node and store. With it the score of a swap is computed
+    in O(1) and the score of a 2-opt move in O(segment), following the rules of the DistanceEvaluator exactly. It is
+    used to screen moves before a route is copied and evaluated in full.
+
+    Like the evaluator, a job is checked against the last store with its store id. In a relaxed tour that is the last
+    of the store copies of the id, so the cache keeps the positions of all copies and a move that moves or removes a
+    copy checks all jobs of its id again.
+
+    The cache describes the route as it was at the last call to update(). Call update() after accepting a move.
+    """
+    def __init__(self, route, driver_ends_at_start=True):
+        self.route = route
+        self.driver_ends_at_start = driver_ends_at_start
+        self.update()
+
+    def update(self, route=None):
+        """"
+        (Re)builds the cache for the given route, or for the route the cache was created with. This is O(n).
+        """
+        if route is not None:
+            self.route = route
+        tour = self.route.tour
+        n = len(tour)
+        self.position = {}
+        self.store_position = {}
+        self.store_positions = {}
+        self.jobs_of_store = {}
+        for i in range(n):
+            node = tour[i]
+            self.position[id(node)] = i
+            if isinstance(node, Store):
+                self.store_position[node.id] = i
+                self.store_positions.setdefault(node.id, []).append(i)
+            else:
+                self.jobs_of_store.setdefault(node.store['id'], []).append(node)
+
+        self.cost = [0.0] * n
+        self.prefix_cost = [0.0] * (n + 1)
+        self.violates = [False] * n
+        distance = 0
+        violations = 0
+        for i in range(n):
+            self.cost[i] = self._cost(i, tour[i - 1] if i > 0 else None, tour[i], n)
+            self.prefix_cost[i + 1] = self.prefix_cost[i] + self.cost[i]
+            self.violates[i] = self._violates(i, tour[i], n, self.store_position.get)
+            distance += self.cost[i]
+            if self.violates[i]:
+                violations += 1
+
+        self.distance = distance
+        self.violations = violations
+        self.loads = LoadProfile(self.route)
+        self.score = distance + violations * DistanceEvaluator.presedence_order_penalty + \
+            DistanceEvaluator.capacity_penalty * self.loads.excess
+        return self.score
+
+    def swap_score(self, index1, index2):
+        """"
+        Returns the score and the number of precedence violations of the route after swapping the nodes at both
+        indices. O(1) plus the jobs of swapped stores.
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        tour = self.route.tour
+
+        def node_at(p):
+            if p == i:
+                return tour[k]
+            if p == k:
+                return tour[i]
+            return tour[p]
+
+        def moved(p):
+            if p == i:
+                return k
+            if p == k:
+                return i
+            return p
+
+        changed = sorted({i, i + 1, k, k + 1})
+        return self._score(changed, node_at, moved, [tour[i], tour[k]], self.loads.swap_excess(i, k))
+
+    def two_opt_score(self, index1, index2):
+        """"
+        Returns the score and the number of precedence violations of the route after reversing the nodes between both
+        indices (inclusive). O(1) for the distance of a symmetric distance matrix, O(segment) for the violations.
+        """
+        i = min(index1, index2)
+        k = max(index1, index2)
+        tour = self.route.tour
+        n = len(tour)
+
+        def node_at(p):
+            if i <= p <= k:
+                return tour[i + k - p]
+            return tour[p]
+
+        def moved(p):
+            if i <= p <= k:
+                return i + k - p
+            return p
+
+        # reversing a stretch keeps its inner edges on a symmetric matrix, only the edges at both ends change. The
+        # last position is scored against the deliverer, so a stretch that reaches it is scored in full.
+        symmetric = getattr(self.route.distances_matrix, 'symmetric', True)
+        if symmetric and not (self.driver_ends_at_start and k >= n - 2):
+            changed = [i, k + 1] if k + 1 < n else [i]
+        else:
+            changed = list(range(i, min(k + 2, n)))
+        return self._score(changed, node_at, moved, tour[i:k + 1], self.loads.two_opt_excess(i, k))
+
+    def score_tour(self, tour):
+        """"
+        Returns the score of an arbitrary tour of the same deliverer in O(n), following the rules of the
+        DistanceEvaluator. Used for candidates that differ from the cached route in too many places.
+        """
+        n = len(tour)
+        store_position = {}
+        for i in range(n):
+            if isinstance(tour[i], Store):
+                store_position[tour[i].id] = i
+        distance = 0
+        violations = 0
+        for i in range(n):
+            distance += self._cost(i, tour[i - 1] if i > 0 else None, tour[i], n)
+            if self._violates(i, tour[i], n, store_position.get):
+                violations += 1
+        return distance + violations * DistanceEvaluator.presedence_order_penalty + \
+            DistanceEvaluator.capacity_penalty * LoadProfile.excess_of(tour, self.route.deliverer())
+
+    def evaluate_pieces(self, pieces):
+        """"
+        Returns the score and the number of precedence violations of a new tour described as a list of pieces, see
+        TimeWindowCache.evaluate_pieces. Stretches of old nodes keep their distances, which are summed in O(1) per
+        piece. Only moved nodes, the jobs of moved stores and the first and last positions are checked for
+        precedence again.
+        """
+        tour = self.route.tour
+        n_old = len(tour)
+        penalty = DistanceEvaluator.presedence_order_penalty
+
+        new_nodes = {}
+        new_stores = {}
+        old_pieces = []
+        covered = []
+        p = 0
+        for piece in pieces:
+            if piece[0] == 'old':
+                if piece[2] > piece[1]:
+                    old_pieces.append((piece[1], piece[2], p - piece[1]))
+                    covered.append((piece[1], piece[2]))
+                    p += piece[2] - piece[1]
+            else:
+                for node in piece[1]:
+                    new_nodes[id(node)] = p
+                    if isinstance(node, Store):
+                        new_stores[node.id] = p
+                    p += 1
+        n = p
+        last = n - 1
+
+        def new_index(q):
+            for a, b, offset in old_pieces:
+                if a <= q < b:
+                    return q + offset
+            return None
+
+        last_store = {}
+
+        def store_position(store_id):
+            # the last of the new stores and the old stores that are kept
+            if store_id not in last_store:
+                positions = [new_index(q) for q in self.store_positions.get(store_id, [])]
+                positions = [p for p in positions if p is not None]
+                if store_id in new_stores:
+                    positions.append(new_stores[store_id])
+                last_store[store_id] = max(positions) if positions else None
+            return last_store[store_id]
+
+        # distance
+        distance = 0
+        previous = None
+        p = 0
+        for piece in pieces:
+            if piece[0] == 'new':
+                for node in piece[1]:
+                    distance += self._cost(p, previous, node, n)
+                    previous = node
+                    p += 1
+                continue
+            a, b = piece[1], piece[2]
+            q = a
+            while q < b:
+                if q == a or q == 0 or q == n_old - 1 or p == 0 or p == last:
+                    distance += self._cost(p, previous, tour[q], n)
+                    previous = tour[q]
+                    p += 1
+                    q += 1
+                    continue
+                r = min(b, n_old - 1, q + (last - p))
+                distance += self.prefix_cost[r] - self.prefix_cost[q]
+                previous = tour[r - 1]
+                p += r - q
+                q = r
+
+        # precedence: every old position that is not covered by an old piece lost its node, the jobs of a store that
+        # is taken out may be checked against another store copy
+        violations = self.violations
+        affected = {}
+        uncovered_start = 0
+        for a, b in covered + [(n_old, n_old)]:
+            for q in range(uncovered_start, a):
+                violations -= self.violates[q]
+                if isinstance(tour[q], Store):
+                    for job in self.jobs_of_store.get(tour[q].id, []):
+                        r = self.position.get(id(job))
+                        if r is not None and new_index(r) is not None:
+                            affected[r] = job
+            uncovered_start = b
+
+        for q in (0, n_old - 1):
+            if 0 <= q < n_old and new_index(q) is not None:
+                affected[q] = tour[q]
+        for a, b, offset in old_pieces:
+            for p in (0, last):
+                if a <= p - offset < b:
+                    affected[p - offset] = tour[p - offset]
+        for piece in pieces:
+            if piece[0] == 'new':
+                for node in piece[1]:
+                    if isinstance(node, Store):
+                        for job in self.jobs_of_store.get(node.id, []):
+                            q = self.position.get(id(job))
+                            if q is not None and new_index(q) is not None:
+                                affected[q] = job
+                    else:
+                        violations += self._violates(new_nodes[id(node)], node, n, store_position)
+        for q, node in affected.items():
+            violations += self._violates(new_index(q), node, n, store_position) - self.violates[q]
+
+        return distance + violations * penalty + \
+            DistanceEvaluator.capacity_penalty * self.loads.pieces_excess(pieces), violations
+
+    def _score(self, changed, node_at, moved, moved_nodes, excess):
+        tour = self.route.tour
+        n = len(tour)
+        distance = self.distance
+        for p in changed:
+            if p < n:
+                distance += self._cost(p, node_at(p - 1) if p > 0 else None, node_at(p), n) - self.cost[p]
+
+        # only moved jobs and the jobs of moved stores can change their precedence
+        affected = {}
+        for node in moved_nodes:
+            if isinstance(node, Store):
+                for job in self.jobs_of_store.get(node.id, []):
+                    affected[id(job)] = job
+            else:
+                affected[id(node)] = node
+
+        last_store = {}
+
+        def store_position(store_id):
+            if store_id not in last_store:
+                positions = self.store_positions.get(store_id)
+                last_store[store_id] = None if positions is None else max(moved(p) for p in positions)
+            return last_store[store_id]
+
+        violations = self.violations
+        for job in affected.values():
+            p = self.position[id(job)]
+            violations += self._violates(moved(p), job, n, store_position) - self.violates[p]
+
+        return distance + violations * DistanceEvaluator.presedence_order_penalty + \
+            DistanceEvaluator.capacity_penalty * excess, violations
+
+    def _cost(self, position, previous, node, n):
+        dist_matrix = self.route.distances_matrix
+        if position == 0:
+            return dist_matrix.get_distance(self.route.deliverer(), node)
+        if self.driver_ends_at_start and position == n - 1:
+            return dist_matrix.get_distance(self.route.deliverer(), node)
+        return dist_matrix.get_distance(previous, node)
+
+    def _violates(self, position, node, n, store_position):
+        if not isinstance(node, Job):
+            return False
+        if position == 0:
+            return True
+        if self.driver_ends_at_start and position == n - 1:
+            return False
+        index_of_corr_store = store_position(node.store['id'])
+        return index_of_corr_store is not None and index_of_corr_store > position
+
+
+class EvaluationCache:
+    """"
+    A bounded memo of route scores, a transposition table for the local search. Entries are keyed by the evaluator,
+    the end-at-start flag, the distances matrix and the deliverer of the route and the incremental hash of the route
+    (see Route.route_hash). The least recently used entries are evicted once the estimated memory use exceeds
+    max_bytes.
+
+    One cache is meant to be shared by all evaluator calls in a solve, see CachedEvaluator. The matrix and the deliverer
+    are keyed by identity, so the routes of other problems get their own entries. Clear a cache that outlives its
+    problem, a new matrix may get the identity of a freed one.
+    """
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        score = self.entries.get(key)
+        if score is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return score
+
+    def put(self, key, score):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.entries[key] = score
+            return
+        self.entries[key] = score
+        self.bytes += EvaluationCache._entry_size(key, score)
+        while self.bytes > self.max_bytes and self.entries:
+            old_key, old_score = self.entries.popitem(last=False)
+            self.bytes -= EvaluationCache._entry_size(old_key, old_score)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries),
+                'bytes': self.bytes, 'hit_rate': self.hit_rate()}
+
+    @staticmethod
+    def _entry_size(key, score):
+        # the key tuple, its items, the score and roughly 100 bytes for the ordered dict bookkeeping
+        return sys.getsizeof(key) + sum(sys.getsizeof(item) for item in key) + sys.getsizeof(score) + 100
+
+
+class CachedEvaluator:
+    """"
+    Wraps an evaluator so that scores are looked up in an EvaluationCache before a route is evaluated. It has the same
+    interface as the evaluators, so it can be handed to Route, Codec and HillClimbing in place of one.
+    """
+    def __init__(self, evaluator, cache):
+        self.evaluator = base_evaluator(evaluator)
+        self.cache = cache
+
+    def evaluate_distance(self, route, driver_ends_at_start=True):
+        # the hash only covers the node keys of the tour, the same tour scores differently on another matrix or driver
+        key = (self.evaluator.__name__, driver_ends_at_start, id(route.distances_matrix), id(route.deliverer()),
+               len(route.tour), route.route_hash())
+        score = self.cache.get(key)
+        if score is None:
+            score = self.evaluator.evaluate_distance(route, driver_ends_at_start)
+            self.cache.put(key, score)
+        return score
+
+
+def base_evaluator(evaluator):
+    """"
+    Returns the evaluator class that does the actual scoring, unwrapping a CachedEvaluator
+    """
+    return getattr(evaluator, 'evaluator', evaluator)
+
+
+def move_pieces(n, removed, inserts):
+    """"
+    Describes a tour of length n with the nodes at the removed positions taken out and new nodes inserted as a list
+    of pieces for RouteCache.evaluate_pieces.
+
+    :param: n: int length of the current tour
+    :param: removed: list positions of the current tour to take out
+    :param: inserts: list of (index, node) sorted on index. The node is inserted before index of the tour without the
+    removed nodes, nodes with the same index are inserted in the given order.
+    """
+    runs = []
+    start = 0
+    for r in sorted(removed):
+        if r > start:
+            runs.append((start, r))
+        start = r + 1
+    if start < n:
+        runs.append((start, n))
+
+    pieces = []
+    base_index = 0
+    j = 0
+    for a, b in runs:
+        while j < len(inserts) and inserts[j][0] < base_index + (b - a):
+            cut = a + inserts[j][0] - base_index
+            if cut > a:
+                pieces.append(('old', a, cut))
+                base_index += cut - a
+                a = cut
+            nodes = []
+            while j < len(inserts) and inserts[j][0] == base_index:
+                nodes.append(inserts[j][1])
+                j += 1
+            pieces.append(('new', nodes))
+        if b > a:
+            pieces.append(('old', a, b))
+            base_index += b - a
+    if j < len(inserts):
+        pieces.append(('new', [node for index, node in inserts[j:]]))
+    return pieces
+
+
+def _capacity(job):
+    return job.capacity or 0
+
+
+def _time_window_start(node):
+    if isinstance(node, Store):
+        return node.get_job().get_time_start()
+    return node.get_time_start()
+
 
-        return index_to_return
\ No newline at end of file
+def _time_window_end(node):
+    if isinstance(node, Store):
+        return node.get_job().get_store_closing()
+    return node.get_time_end()
@@ -0,0 +1,324 @@
+from src.locations import Job, Store, Deliverer
+from array import array
+import json
+import logging
+import re
+
+
+# the characters that open, close or quote a nested value, and the characters that end a string
+_STRUCTURE = re.compile(r'[{}\[\]"]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR = re.compile(r'[^,\]}\s]+')
+_WHITESPACE = ' \t\n\r'
+_DECODER = json.JSONDecoder()
+
+
+class ProblemLoader:
+    """"
+    Streaming loader for problem files. The jobs, stores and drivers arrays are read one record at a time from chunks
+    of the file, so the json tree of the whole file is never in memory: every record is decoded, validated and turned
+    into a Job, Store or Deliverer right away and only the fields the solver uses are kept. The coordinates and time
+    windows are also collected in compact arrays per section, see arrays.
+
+    A malformed record (invalid json, a missing or wrongly typed field, a job of an unknown store, a duplicate id) is
+    skipped and reported in errors with its section, index in the array and line and column in the file. With
+    strict=True the first error raises a ValueError instead.
+
+    Other top level values (hub, sent_at, ...) are skipped. Peak memory is the compiled instance plus one chunk plus the
+    largest record.
+    """
+    sections = ('jobs', 'stores', 'drivers')
+
+    def __init__(self, datafile_location='../data/problem.json', chunk_size=1 << 16, max_record_size=1 << 22,
+                 strict=False):
+        if datafile_location[-4:] != "json":
+            logging.warning("File being read is nog json")
+        self.datafile_location = datafile_location
+        self.chunk_size = chunk_size
+        self.max_record_size = max_record_size
+        self.strict = strict
+        self.errors = []
+        self.jobs = []
+        self.stores = []
+        self.deliverers = []
+        # lat, lon per object and (start, end) of the delivery window of a job or the shift of a driver
+        self.arrays = {'jobs': {'coordinates': array('d'), 'time_windows': array('d')},
+                       'stores': {'coordinates': array('d')},
+                       'drivers': {'coordinates': array('d'), 'time_windows': array('d')}}
+        self._store_windows = {}
+        self._positions = {}
+
+    def load(self):
+        """"
+        Reads the file and returns the jobs, stores and deliverers
+        """
+        with open(self.datafile_location, encoding='utf-8') as self._file:
+            self._buffer = ''
+            self._position = 0
+            self._line = 1
+            self._line_position = 0
+            self._line_start = 0
+            self._eof = False
+            self._parse_document()
+        self._check_references()
+        self._fill_arrays()
+        return self.jobs, self.stores, self.deliverers
+
+    def _parse_document(self):
+        self._expect('{')
+        while True:
+            if self._peek() == '}':
+                return
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError('Expected a key at line %d column %d' % self._where(self._position))
+            self._expect(':')
+            if key in self.sections and self._peek() == '[':
+                self._parse_section(key)
+            else:
+                self._value()
+            if self._peek() == ',':
+                self._position += 1
+            else:
+                self._expect('}')
+                return
+
+    def _parse_section(self, section):
+        self._expect('[')
+        if self._peek() == ']':
+            self._position += 1
+            return
+        index = 0
+        while True:
+            self._peek()
+            start = self._position
+            line, column = self._where(start)
+            try:
+                record = self._value()
+                self._add_record(section, record, index, line, column)
+            except ValueError as e:
+                self._error(section, index, line, column, str(e))
+            index += 1
+            if self._peek() == ',':
+                self._position += 1
+            else:
+                self._expect(']')
+                return
+
+    def _add_record(self, section, record, index, line, column):
+        """"
+        Validates the record and adds the object it describes, raises a ValueError for an invalid record
+        """
+        if not isinstance(record, dict):
+            raise ValueError('record is not an object')
+        location = ProblemLoader._pair(record, 'location')
+        if section == 'jobs':
+            time_window = ProblemLoader._pair(record, 'delivery_time_window')
+            store = record.get('store')
+            if not isinstance(store, dict) or 'id' not in store:
+                raise ValueError("field 'store' should be an object with an id")
+            store_window = tuple(ProblemLoader._pair(store, 'time_window'))
+            # all jobs of a store share one store dictionary
+            key = (store['id'], store_window)
+            if key not in self._store_windows:
+                self._store_windows[key] = {'id': store['id'], 'time_window': list(store_window)}
+            job = Job(ProblemLoader._field(record, 'id'), ProblemLoader._field(record, 'fulfillment_id'),
+                      record.get('label'), location, time_window, self._store_windows[key], None,
+                      record.get('capacity', 0), None, None, None, None, None, None, record.get('type'))
+            self.jobs.append(job)
+            self._positions[id(job)] = (index, line, column)
+        elif section == 'stores':
+            store = Store(record.get('label'), location, ProblemLoader._field(record, 'id'), None)
+            self.stores.append(store)
+            self._positions[id(store)] = (index, line, column)
+        else:
+            deliverer = Deliverer(ProblemLoader._field(record, 'id'), record.get('label'),
+                                  ProblemLoader._number(record, 'start_shift'),
+                                  ProblemLoader._number(record, 'end_shift'), location, None, record.get('capacity'),
+                                  None, None, None, None, None)
+            self.deliverers.append(deliverer)
+
+    def _check_references(self):
+        """"
+        Drops and reports jobs of stores that are not in the file and records with a duplicate id
+        """
+        store_ids = set()
+        stores = []
+        for store in self.stores:
+            if store.id in store_ids:
+                index, line, column = self._positions[id(store)]
+                self._error('stores', index, line, column, 'duplicate store id ' + str(store.id))
+            else:
+                store_ids.add(store.id)
+                stores.append(store)
+        self.stores = stores
+
+        job_ids = set()
+        jobs = []
+        for job in self.jobs:
+            if job.store['id'] not in store_ids:
+                index, line, column = self._positions[id(job)]
+                self._error('jobs', index, line, column, 'unknown store id ' + str(job.store['id']))
+            elif job.id in job_ids:
+                index, line, column = self._positions[id(job)]
+                self._error('jobs', index, line, column, 'duplicate job id ' + str(job.id))
+            else:
+                job_ids.add(job.id)
+                jobs.append(job)
+        self.jobs = jobs
+        self._positions = {}
+
+    def _fill_arrays(self):
+        for section, objects in zip(self.sections, (self.jobs, self.stores, self.deliverers)):
+            for obj in objects:
+                self.arrays[section]['coordinates'].extend(obj.location)
+        for job in self.jobs:
+            self.arrays['jobs']['time_windows'].extend(job.delivery_time_window)
+        for deliverer in self.deliverers:
+            self.arrays['drivers']['time_windows'].extend((deliverer.start_shift, deliverer.end_shift))
+
+    def _error(self, section, index, line, column, message):
+        error = {'section': section, 'index': index, 'line': line, 'column': column, 'message': message}
+        if self.strict:
+            raise ValueError('Invalid record in ' + self.datafile_location + ': ' + str(error))
+        logging.warning('Skipping invalid record in %s: %s', self.datafile_location, error)
+        self.errors.append(error)
+
+    def _value(self):
+        """"
+        Decodes the json value at the current position and moves past it. The value is decoded straight from the
+        buffer. Only when that fails the nesting and the strings are scanned, to tell a value that continues in the next
+        chunk from an invalid value, which is skipped and raises a ValueError.
+        """
+        while True:
+            if self._peek():
+                try:
+                    value, end = _DECODER.raw_decode(self._buffer, self._position)
+                    # a number at the end of the buffer may go on in the next chunk
+                    if end < len(self._buffer) or self._eof:
+                        self._position = end
+                        return value
+                except ValueError as e:
+                    end = self._value_end(self._position)
+                    if end is not None:
+                        line, column = self._where(min(getattr(e, 'pos', end), end))
+                        self._position = end
+                        raise ValueError('%s at line %d column %d' % (getattr(e, 'msg', e), line, column))
+            if self._eof:
+                line, column = self._where(self._position)
+                raise ValueError('Unexpected end of file in value at line ' + str(line) + ' column ' + str(column))
+            if len(self._buffer) - self._position > self.max_record_size:
+                line, column = self._where(self._position)
+                raise ValueError('Value at line ' + str(line) + ' column ' + str(column) + ' is larger than ' +
+                                 str(self.max_record_size) + ' characters')
+            self._fill()
+
+    def _value_end(self, i):
+        """"
+        Returns the end of the value starting at i in the buffer or None if the buffer ends before the value does
+        """
+        buffer = self._buffer
+        if buffer[i] not in '{["':
+            match = _SCALAR.match(buffer, i)
+            if match is None:
+                raise ValueError('Expected a value at line %d column %d' % self._where(i))
+            return match.end() if match.end() < len(buffer) or self._eof else None
+        depth = 0
+        while True:
+            match = _STRUCTURE.search(buffer, i)
+            if match is None:
+                return None
+            char = match.group()
+            i = match.end()
+            if char == '"':
+                i = ProblemLoader._string_end(buffer, i)
+                if i is None:
+                    return None
+                if depth == 0:
+                    return i
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return i
+
+    @staticmethod
+    def _string_end(buffer, i):
+        while True:
+            match = _STRING_END.search(buffer, i)
+            if match is None:
+                return None
+            if match.group() == '"':
+                return match.end()
+            i = match.end() + 1
+            if i >= len(buffer):
+                return None
+
+    def _peek(self):
+        """"
+        Skips white space and returns the next character, or '' at the end of the file
+        """
+        while True:
+            buffer = self._buffer
+            while self._position < len(buffer) and buffer[self._position] in _WHITESPACE:
+                self._position += 1
+            if self._position < len(buffer):
+                return buffer[self._position]
+            if self._eof:
+                return ''
+            self._fill()
+
+    def _expect(self, char):
+        if self._peek() != char:
+            line, column = self._where(self._position)
+            raise ValueError('Expected ' + repr(char) + ' at line ' + str(line) + ' column ' + str(column) + ' of ' +
+                             self.datafile_location)
+        self._position += 1
+
+    def _fill(self):
+        """"
+        Drops the part of the buffer that is read and appends the next chunk of the file
+        """
+        self._where(self._position)
+        self._buffer = self._buffer[self._position:]
+        self._line_position -= self._position
+        self._line_start -= self._position
+        self._position = 0
+        chunk = self._file.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+        self._buffer += chunk
+
+    def _where(self, i):
+        """"
+        Returns the line and column of position i in the buffer, i never decreases between calls
+        """
+        if i > self._line_position:
+            newlines = self._buffer.count('\n', self._line_position, i)
+            if newlines:
+                self._line += newlines
+                self._line_start = self._buffer.rfind('\n', self._line_position, i) + 1
+            self._line_position = i
+        return self._line, i - self._line_start + 1
+
+    @staticmethod
+    def _field(record, name):
+        if name not in record:
+            raise ValueError('missing field ' + repr(name))
+        return record[name]
+
+    @staticmethod
+    def _number(record, name):
+        value = ProblemLoader._field(record, name)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError('field ' + repr(name) + ' should be a number')
+        return value
+
+    @staticmethod
+    def _pair(record, name):
+        value = ProblemLoader._field(record, name)
+        if not isinstance(value, list) or len(value) != 2 or \
+                any(isinstance(v, bool) or not isinstance(v, (int, float)) for v in value):
+            raise ValueError('field ' + repr(name) + ' should be a pair of numbers')
+        return value
@@ -146,22 +146,79 @@ class Deliverer:
 
 
 class DistancesMatrix:
-    def __init__(self, all_locations):
+    def __init__(self, all_locations, provider=None, cache=None, shared=None):
+        """"
+        The distances between all locations, computed up front
+
+        :param: provider: distances.DistanceProvider of the distances and travel times, the provider of shared or the
+        haversine distance when not given
+        :param: cache: distances.MatrixCache optional store of computed matrices on disk, not used with shared
+        :param: shared: DistancesMatrix optional, e.g. of all stores of a depot. The distances between its locations
+        are taken from it and only the rows and columns of the other locations are computed, so the problems of many
+        drivers over the same stores share the store to store distances.
+        """
+        if provider is None and shared is not None:
+            provider = shared.provider
+        if provider is None:
+            from src.distances import HaversineProvider
+            provider = HaversineProvider()
         self.locations = all_locations
-        self.distances = self._generate_distances_matrix(all_locations)
+        self.provider = provider
+        self.symmetric = provider.symmetric
+        self.time_dependent = provider.time_dependent
+        if shared is not None:
+            self.distances, self.durations = self._extend_distances_matrix(all_locations, shared)
+        else:
+            self.distances, self.durations = self._generate_distances_matrix(all_locations, cache)
+        if self.symmetric is None:
+            self.symmetric = all(self.distances[loc1][loc2] == self.distances[loc2][loc1]
+                                 for loc1 in all_locations for loc2 in all_locations)
+
+    def _generate_distances_matrix(self, locations, cache=None):
+        if cache is not None:
+            distances, durations = cache.matrices(self.provider, locations)
+            n = len(locations)
+            rows = [distances[i * n:(i + 1) * n] for i in range(n)]
+            duration_rows = [durations[i * n:(i + 1) * n] for i in range(n)] if durations is not None else None
+        else:
+            rows = self.provider.distances(locations)
+            duration_rows = self.provider.durations(locations)
 
-    def _generate_distances_matrix(self, locations):
         distances = {}
-        for loc1 in locations:
-            distances[loc1] = {}
-            for loc2 in locations:
-                distance = self._calculate_distance(loc1, loc2)
-                distances[loc1][loc2] = distance
-
-        return distances
+        for loc1, row in zip(locations, rows):
+            distances[loc1] = dict(zip(locations, row))
+        if duration_rows is None:
+            return distances, None
+        durations = {}
+        for loc1, row in zip(locations, duration_rows):
+            durations[loc1] = dict(zip(locations, row))
+        return distances, durations
+
+    def _extend_distances_matrix(self, locations, shared):
+        if bool(self.provider.has_durations) != (shared.durations is not None):
+            raise ValueError('The provider and the shared distances matrix do not both have travel times')
+        known = [location for location in locations if location in shared.distances]
+        new = [location for location in locations if location not in shared.distances]
+        distances = {}
+        durations = {} if shared.durations is not None else None
+        for loc1 in known:
+            distances[loc1] = {loc2: shared.distances[loc1][loc2] for loc2 in known}
+            if durations is not None:
+                durations[loc1] = {loc2: shared.durations[loc1][loc2] for loc2 in known}
+        DistancesMatrix._fill(distances, new, locations, self.provider.distances_between(new, locations))
+        DistancesMatrix._fill(distances, known, new, self.provider.distances_between(known, new))
+        if durations is not None:
+            DistancesMatrix._fill(durations, new, locations, self.provider.durations_between(new, locations))
+            DistancesMatrix._fill(durations, known, new, self.provider.durations_between(known, new))
+        return distances, durations
+
+    @staticmethod
+    def _fill(matrix, sources, targets, rows):
+        for loc1, row in zip(sources, rows):
+            matrix.setdefault(loc1, {}).update(zip(targets, row))
 
     def _calculate_distance(self, loc1, loc2):
-        return self._haversine(loc1.get_longitude(), loc1.get_latitude(), loc2.get_longitude(), loc2.get_latitude())
+        return self.provider.distance(loc1, loc2)
 
     def _haversine(self, lon1, lat1, lon2, lat2):
         """
@@ -181,6 +238,55 @@ class DistancesMatrix:
     def get_distance(self, loc1, loc2):
         return self.distances[loc1][loc2]
 
+    def get_travel_time(self, loc1, loc2, departure, speed, factor=1):
+        """"
+        Returns the seconds from loc1 to loc2 when leaving at departure: the travel time of the provider, or the
+        distance driven at speed m/s. The distance or travel time is multiplied by factor, e.g. for a penalty.
+        """
+        if self.durations is not None:
+            return self.durations[loc1][loc2] * factor
+        if self.time_dependent:
+            return self.provider.travel_time(self.get_distance(loc1, loc2) * factor, departure, speed)
+        return self.get_distance(loc1, loc2) * factor * 1000 / speed
+
     def get_locations_sorted(self, for_, order='asc'):
         pass
         #sort on distance
+
+
+class LazyDistancesMatrix(DistancesMatrix):
+    """"
+    Distances matrix that computes a distance the first time it is looked up instead of all pairs up front. For large
+    instances, of which only a small part of the pairs is ever looked up, e.g. by the decomposition.
+    """
+    def __init__(self, all_locations, provider=None):
+        if provider is None:
+            from src.distances import HaversineProvider
+            provider = HaversineProvider()
+        self.locations = all_locations
+        self.provider = provider
+        # a lazy matrix does not know all distances, so unknown symmetry counts as asymmetric
+        self.symmetric = bool(provider.symmetric)
+        self.time_dependent = provider.time_dependent
+        self.distances = {}
+        self.durations = {} if provider.has_durations else None
+
+    def get_distance(self, loc1, loc2):
+        row = self.distances.get(loc1)
+        if row is None:
+            row = self.distances[loc1] = {}
+        distance = row.get(loc2)
+        if distance is None:
+            distance = row[loc2] = self._calculate_distance(loc1, loc2)
+        return distance
+
+    def get_travel_time(self, loc1, loc2, departure, speed, factor=1):
+        if self.durations is None:
+            return super().get_travel_time(loc1, loc2, departure, speed, factor)
+        row = self.durations.get(loc1)
+        if row is None:
+            row = self.durations[loc1] = {}
+        duration = row.get(loc2)
+        if duration is None:
+            duration = row[loc2] = self.provider.duration(loc1, loc2)
+        return duration * factor
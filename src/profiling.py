@@ -0,0 +1,283 @@
+from collections import Counter
+import fnmatch
+import os
+import sys
+import threading
+import time
+
+
+# phase of a function by its module and qualified name, e.g. 'domain:Route.copy'. A sample is attributed to the phase
+# of the innermost function on its stack that has one, the first matching pattern wins.
+default_phases = [
+    ('initial solution', ['neighbourhood:HillClimbing.generate_initial_solution', 'domain:Route.generate_initial_route',
+                          'domain:Route._generate_*_route']),
+    ('route copy', ['domain:Route.copy']),
+    ('index lookup', ['domain:Route.find_index_*', 'domain:ProblemContext.get_node_by_id']),
+    ('neighbourhood', ['domain:Route.generate_*_pairs', 'domain:TimeWindowIndex.*', 'neighbourhood:*._requests',
+                       'neighbourhood:*._candidate*']),
+    ('codec', ['domain:Codec.*', 'domain:CompactRoute.*', 'domain:ProblemIndex.encode', 'domain:ProblemIndex.decode']),
+    ('repair', ['domain:Route.fix_infeasibilities', 'domain:Route.repair_tour', 'domain:Route._reorder_store_jobs']),
+    ('evaluation cache', ['evaluators:EvaluationCache.*', 'evaluators:CachedEvaluator.*']),
+    ('incremental scoring', ['evaluators:*Cache.*', 'evaluators:LoadProfile.*', 'evaluators:move_pieces']),
+    ('evaluation', ['evaluators:*Evaluator.*', 'domain:Route.evaluate', 'domain:Route.get_total_distance']),
+    ('moves', ['domain:Route.*_move*', 'domain:Route.swap_*', 'domain:Route.relocate_pair', 'domain:Route.apply_move',
+               'domain:Route.two_opt_by_index', 'domain:Route._record']),
+    ('distances', ['locations:*DistancesMatrix.*', 'distances:*']),
+    ('window optimization', ['dp:*']),
+    ('checkpoint', ['checkpoint:*', 'solutions:*']),
+    ('progress', ['progress:*']),
+]
+
+
+class Profiler:
+    """"
+    Profiles a run of the solvers, e.g. of HillClimbing.solve or the loop in tsp.main:
+
+        with Profiler() as profiler:
+            hc.solve(...)
+        profiler.write('../solutions/profile')
+
+    writes profile.folded, the collapsed stacks ('frame;frame;frame count' per line) for flamegraph.pl, speedscope and
+    the like, and profile.txt, the time per solver phase (see default_phases) and the functions with the most time.
+
+    Modes:
+    'sample' a thread takes the stack of the profiled thread every interval seconds. The solver runs at full speed
+    apart from the short stops of the sampler, the numbers are estimates by the number of samples.
+    'cprofile' cProfile is enabled for the run, so the call counts and times are exact, at a few times the run time.
+    cProfile has no stacks, the collapsed file has the phase and the function per line, weighted by the own time in
+    microseconds.
+
+    Only the thread that starts the profiler is profiled, not the worker processes of the parallel modes.
+    """
+    modes = ('sample', 'cprofile')
+
+    def __init__(self, mode='sample', interval=0.01, phases=None, max_depth=128):
+        """"
+        :param: mode: str 'sample' or 'cprofile'
+        :param: interval: float seconds between two samples
+        :param: phases: list of (phase, list of patterns), default_phases when not given
+        :param: max_depth: int number of innermost frames kept of a sample
+        """
+        if mode not in Profiler.modes:
+            raise ValueError('Unknown profiler mode ' + str(mode))
+        self.mode = mode
+        self.interval = interval
+        self.phases = default_phases if phases is None else phases
+        self.max_depth = max_depth
+        # stack of code objects, outermost first -> number of samples
+        self.samples = Counter()
+        self.seconds = 0.0
+        self._profile = None
+        self._thread = None
+        self._stop = None
+        self._started = None
+        self._phase_of = {}
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.mode == 'cprofile':
+            # cProfile and pstats are only imported when profiling, they take longer to import than the solvers
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._started is None:
+            return
+        if self.mode == 'cprofile':
+            self._profile.disable()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.seconds += time.perf_counter() - self._started
+        self._started = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _sample(self, thread_id):
+        own_frame = sys._getframe()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                if frame is not own_frame:
+                    stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.samples[tuple(stack)] += 1
+
+    def functions(self):
+        """"
+        Returns a list of dicts per function: name, phase, own and total seconds and, in 'cprofile' mode, calls. The
+        functions with the most own time come first.
+        """
+        rows = []
+        if self.mode == 'cprofile':
+            import pstats
+            stats = pstats.Stats(self._profile).stats
+            names = _qualified_names({key[0] for key in stats})
+            for key, (primitive_calls, calls, own, total, callers) in stats.items():
+                name = names.get((key[0], key[1]), _module(key[0]) + ':' + key[2])
+                rows.append({'function': name, 'phase': self.phase(name), 'calls': calls, 'own_seconds': own,
+                             'total_seconds': total})
+        else:
+            own = Counter()
+            total = Counter()
+            for stack, count in self.samples.items():
+                own[stack[-1]] += count
+                for code in set(stack):
+                    total[code] += count
+            seconds = self._seconds_per_sample()
+            for code, count in total.items():
+                name = _name(code)
+                rows.append({'function': name, 'phase': self.phase(name), 'calls': None,
+                             'own_seconds': own[code] * seconds, 'total_seconds': count * seconds})
+        rows.sort(key=lambda row: -row['own_seconds'])
+        return rows
+
+    def phase_times(self):
+        """"
+        Returns a dict phase -> seconds. A sample counts for the innermost function of its stack with a phase, the
+        other samples count as 'other'. cProfile has no stacks: the own time of a function without a phase, e.g. a
+        builtin, counts for the phases of its direct callers, by the time spent per caller.
+        """
+        times = Counter()
+        if self.mode == 'cprofile':
+            import pstats
+            stats = pstats.Stats(self._profile).stats
+            names = _qualified_names({key[0] for key in stats})
+
+            def phase_of(key):
+                return self.phase(names.get((key[0], key[1]), _module(key[0]) + ':' + key[2]))
+
+            for key, (primitive_calls, calls, own, total, callers) in stats.items():
+                phase = phase_of(key)
+                if phase is not None or not callers:
+                    times[phase or 'other'] += own
+                    continue
+                caller_own = sum(values[2] for values in callers.values()) or 1.0
+                for caller, values in callers.items():
+                    times[phase_of(caller) or 'other'] += own * values[2] / caller_own
+            return dict(times)
+        seconds = self._seconds_per_sample()
+        for stack, count in self.samples.items():
+            phase = None
+            for code in reversed(stack):
+                phase = self.phase(_name(code))
+                if phase is not None:
+                    break
+            times[phase or 'other'] += count * seconds
+        return dict(times)
+
+    def phase(self, name):
+        if name not in self._phase_of:
+            self._phase_of[name] = None
+            for phase, patterns in self.phases:
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                    self._phase_of[name] = phase
+                    break
+        return self._phase_of[name]
+
+    def collapsed(self):
+        """"
+        Returns the lines of the collapsed stack file
+        """
+        lines = []
+        if self.mode == 'cprofile':
+            for row in self.functions():
+                micro_seconds = int(round(row['own_seconds'] * 1e6))
+                if micro_seconds > 0:
+                    lines.append((row['phase'] or 'other') + ';' + row['function'] + ' ' + str(micro_seconds))
+        else:
+            for stack, count in self.samples.items():
+                lines.append(';'.join(_name(code) for code in stack) + ' ' + str(count))
+        lines.sort()
+        return lines
+
+    def summary(self, top=30):
+        """"
+        Returns the summary table as text
+        """
+        lines = ['profile of %.3f seconds, mode %s' % (self.seconds, self.mode)]
+        if self.mode == 'sample':
+            lines[0] += ', %d samples' % sum(self.samples.values())
+        lines.append('')
+        lines.append('%-24s %10s %7s' % ('phase', 'seconds', '%'))
+        times = self.phase_times()
+        measured = sum(times.values()) or 1.0
+        for phase, seconds in sorted(times.items(), key=lambda item: -item[1]):
+            lines.append('%-24s %10.3f %7.1f' % (phase, seconds, 100.0 * seconds / measured))
+        lines.append('')
+        lines.append('%-60s %-20s %10s %10s %10s' % ('function', 'phase', 'calls', 'own', 'total'))
+        for row in self.functions()[:top]:
+            lines.append('%-60s %-20s %10s %10.3f %10.3f' % (row['function'][-60:], row['phase'] or '',
+                                                               '' if row['calls'] is None else row['calls'],
+                                                               row['own_seconds'], row['total_seconds']))
+        return '\n'.join(lines)
+
+    def write(self, file_prefix, top=30):
+        """"
+        Writes file_prefix.folded and file_prefix.txt
+        """
+        directory = os.path.dirname(file_prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(file_prefix + '.folded', 'w', encoding='utf-8') as outfile:
+            for line in self.collapsed():
+                outfile.write(line + '\n')
+        with open(file_prefix + '.txt', 'w', encoding='utf-8') as outfile:
+            outfile.write(self.summary(top=top) + '\n')
+
+    def _seconds_per_sample(self):
+        # the sampler does not wake up exactly every interval, spread the measured time over the samples
+        nr_samples = sum(self.samples.values())
+        return self.seconds / nr_samples if nr_samples else 0.0
+
+
+def _module(file_name):
+    if file_name.startswith('<'):
+        return file_name
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+
+def _name(code):
+    # co_qualname has the class of a method, python 3.11 and later
+    return _module(code.co_filename) + ':' + getattr(code, 'co_qualname', code.co_name)
+
+
+def _qualified_names(file_names):
+    """"
+    Returns (file name, first line) -> module:qualified name of the functions and methods of the loaded modules of the
+    given files, cProfile only knows the function name
+    """
+    names = {}
+    for module in list(sys.modules.values()):
+        file_name = getattr(module, '__file__', None)
+        if file_name is None or file_name not in file_names:
+            continue
+        todo = [vars(module)]
+        seen = set()
+        while todo:
+            for value in list(todo.pop().values()):
+                if isinstance(value, (staticmethod, classmethod)):
+                    value = value.__func__
+                elif isinstance(value, property):
+                    value = value.fget
+                code = getattr(value, '__code__', None)
+                if code is not None and code.co_filename == file_name:
+                    names[(file_name, code.co_firstlineno)] = _module(file_name) + ':' + value.__qualname__
+                elif isinstance(value, type) and value.__module__ == module.__name__ and id(value) not in seen:
+                    seen.add(id(value))
+                    todo.append(vars(value))
+    return names
@@ -0,0 +1,265 @@
+from collections import deque
+import random
+import time
+
+
+class ProgressEvent:
+    """"
+    Base class of the progress events of the solvers. Every event has a kind, the source that emitted it (e.g.
+    'hill_climbing') and the time it was created.
+    """
+    __slots__ = ('source', 'time')
+    kind = 'event'
+
+    def __init__(self, source):
+        self.source = source
+        self.time = time.time()
+
+    def as_dict(self):
+        values = {'kind': self.kind}
+        for cls in reversed(type(self).__mro__):
+            for name in getattr(cls, '__slots__', ()):
+                values[name] = getattr(self, name)
+        return values
+
+    def __repr__(self):
+        return type(self).__name__ + str(self.as_dict())
+
+
+class Incumbent(ProgressEvent):
+    """"
+    A solver found a new best solution
+    """
+    __slots__ = ('iteration', 'score')
+    kind = 'incumbent'
+
+    def __init__(self, source, iteration, score):
+        super().__init__(source)
+        self.iteration = iteration
+        self.score = score
+
+    def __str__(self):
+        return 'new best score ' + str(self.score) + ' in iteration ' + str(self.iteration)
+
+
+class SweepFinished(ProgressEvent):
+    """"
+    A solver finished an iteration over its neighbourhood
+    """
+    __slots__ = ('iteration', 'score', 'candidates', 'evaluated')
+    kind = 'sweep'
+
+    def __init__(self, source, iteration, score, candidates=None, evaluated=None):
+        super().__init__(source)
+        self.iteration = iteration
+        self.score = score
+        self.candidates = candidates
+        self.evaluated = evaluated
+
+    def __str__(self):
+        return 'best score ' + str(self.score)
+
+
+class PhaseTiming(ProgressEvent):
+    """"
+    A phase of a run finished, e.g. the initial solution, a solve, a rung of the tuner
+    """
+    __slots__ = ('phase', 'seconds')
+    kind = 'phase'
+
+    def __init__(self, source, phase, seconds):
+        super().__init__(source)
+        self.phase = phase
+        self.seconds = seconds
+
+    def __str__(self):
+        return self.source + ' ' + str(self.phase) + ' took %.3f seconds' % self.seconds
+
+
+class Statistics(ProgressEvent):
+    """"
+    Counters of a run, e.g. the pruned and evaluated moves or the tuning cost
+    """
+    __slots__ = ('name', 'values')
+    kind = 'statistics'
+
+    def __init__(self, source, name, values):
+        super().__init__(source)
+        self.name = name
+        self.values = values
+
+    def __str__(self):
+        return str(self.name) + ' ' + str(self.values)
+
+
+class Note(ProgressEvent):
+    """"
+    Anything else worth telling, e.g. that a run resumes from a checkpoint
+    """
+    __slots__ = ('text',)
+    kind = 'note'
+
+    def __init__(self, source, text):
+        super().__init__(source)
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class ProgressSink:
+    """"
+    Receives the progress events of the solvers. Emitters check enabled before they create an event, so a disabled sink
+    costs one attribute lookup per emit site.
+
+    Every sink can drop events before they are written: kinds keeps only the given event kinds, sample keeps a random
+    fraction of the events and min_interval keeps at most one event of a kind per min_interval seconds. Dropped events
+    are counted in dropped. Subclasses implement write.
+    """
+    enabled = True
+
+    def __init__(self, kinds=None, sample=1.0, min_interval=0.0, seed=0):
+        """"
+        :param: kinds: list of event kinds to keep, e.g. ['sweep', 'phase'], all kinds when not given
+        :param: sample: float fraction of the events to keep
+        :param: min_interval: float seconds between two kept events of the same kind
+        """
+        self.kinds = set(kinds) if kinds is not None else None
+        self.sample = sample
+        self.min_interval = min_interval
+        self.rand = random.Random(seed)
+        self.dropped = 0
+        self._last = {}
+
+    def emit(self, event):
+        if self.kinds is not None and event.kind not in self.kinds:
+            self.dropped += 1
+            return
+        if self.sample < 1.0 and self.rand.random() >= self.sample:
+            self.dropped += 1
+            return
+        if self.min_interval > 0:
+            last = self._last.get(event.kind)
+            if last is not None and event.time - last < self.min_interval:
+                self.dropped += 1
+                return
+            self._last[event.kind] = event.time
+        self.write(event)
+
+    def write(self, event):
+        raise NotImplementedError('Implement write of the progress sink')
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NullSink(ProgressSink):
+    """"
+    Drops all events, the default sink
+    """
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+    def write(self, event):
+        pass
+
+
+class PrintSink(ProgressSink):
+    """"
+    Prints the events as text to stdout, as the solvers used to
+    """
+    def write(self, event):
+        print(str(event))
+
+
+class RingBufferSink(ProgressSink):
+    """"
+    Keeps the last size events in memory, e.g. for a status endpoint of a service
+    """
+    def __init__(self, size=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.buffer = deque(maxlen=size)
+
+    def write(self, event):
+        self.buffer.append(event)
+
+    def events(self):
+        return list(self.buffer)
+
+
+class JsonlSink(ProgressSink):
+    """"
+    Appends the events as json lines to a file. Lines are buffered and written every buffer_size events and on close.
+    """
+    def __init__(self, file_name, buffer_size=100, **kwargs):
+        super().__init__(**kwargs)
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        self._lines = []
+
+    def write(self, event):
+        import json
+        self._lines.append(json.dumps(event.as_dict(), default=str))
+        if len(self._lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._lines:
+            return
+        with open(self.file_name, 'a', encoding='utf-8') as outfile:
+            outfile.write('\n'.join(self._lines) + '\n')
+        self._lines = []
+
+    def close(self):
+        self.flush()
+
+
+class LoggingSink(ProgressSink):
+    """"
+    Writes the events to a logger, the event itself is in the extra field 'progress' of the record
+    """
+    def __init__(self, logger=None, level=None, **kwargs):
+        """"
+        :param: logger: logging.Logger optional, the logger 'tsp.progress' when not given
+        :param: level: int optional level of the records, logging.INFO when not given
+        """
+        import logging
+        super().__init__(**kwargs)
+        self.logger = logger if logger is not None else logging.getLogger('tsp.progress')
+        self.level = logging.INFO if level is None else level
+
+    def write(self, event):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, '%s: %s', event.source, event, extra={'progress': event.as_dict()})
+
+
+_default_sink = NullSink()
+
+
+def default_sink():
+    """"
+    Returns the sink of the solvers that are not given one
+    """
+    return _default_sink
+
+
+def set_default_sink(sink):
+    """"
+    Sets the sink of the solvers that are not given one and returns the previous sink
+    """
+    global _default_sink
+    previous = _default_sink
+    _default_sink = sink if sink is not None else NullSink()
+    return previous
+
+
+def sink_or_default(sink):
+    return sink if sink is not None else _default_sink
@@ -0,0 +1,365 @@
+from src.algorithms.neighbourhood import HillClimbing, route_cache
+from src.algorithms.alns import ALNS
+from src.domain import Codec, Route
+from src.evaluators import DistanceEvaluator, TimeEvaluator
+from src.progress import ProgressSink
+from src.loader import ProblemLoader
+from src.locations import DistancesMatrix
+import csv
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+
+class TraceSink(ProgressSink):
+    """"
+    Records the incumbent scores of a run against the seconds since start, the curve of the regression harness
+    """
+    def __init__(self):
+        super().__init__(kinds=['incumbent'])
+        self.curve = []
+        self.started = time.perf_counter()
+
+    def record(self, score):
+        seconds = time.perf_counter() - self.started
+        if not self.curve or score < self.curve[-1][1]:
+            self.curve.append((seconds, score))
+
+    def write(self, event):
+        self.record(event.score)
+
+
+class RegressionHarness:
+    """"
+    Runs a fixed matrix of instances, configurations and seeds and records per run the final score and also how fast
+    the solver got there: the curve of the best score over time, the time to reach a target score and the primal
+    integral (Berthold, 2013). The target of an instance is its best known score plus target_gap, the best of all runs
+    in the results and the baseline, so the runs of both are measured against the same target.
+
+    compare flags the (instance, configuration, seed) runs that reach the target later, not at all or with a larger
+    primal integral than in the baseline, e.g. the results file of the last release. The results are appended to a csv
+    file with one row per run.
+
+    An instance is a dict with the jobs, stores, deliverers, distances_matrix and with_time_windows. A configuration is
+    a dict with the solver ('hill_climbing' or 'alns'), the route_initialization_method, the nr_initial_solutions and
+    the parameters of its solve.
+    """
+    columns = ['revision', 'instance', 'configuration', 'seed', 'parameters', 'score', 'seconds', 'time_to_target',
+               'primal_integral', 'target', 'curve']
+
+    def __init__(self, instances, configurations, seeds=(1, 2, 3), target_gap=0.01, revision=None):
+        """"
+        :param: instances: dict name to instance
+        :param: configurations: dict name to configuration
+        :param: seeds: list of int seeds of the initial solutions and the solvers
+        :param: target_gap: float relative gap to the best known score that counts as reaching the target
+        :param: revision: str label of the code that is measured, e.g. a git commit
+        """
+        self.instances = instances
+        self.configurations = configurations
+        self.seeds = list(seeds)
+        self.target_gap = target_gap
+        self.revision = revision
+
+    def run(self):
+        """"
+        Runs the matrix and returns the rows of the results
+        """
+        rows = []
+        for instance_name, instance in self.instances.items():
+            codec = Codec(instance['jobs'], instance['stores'], instance['deliverers'], instance['distances_matrix'],
+                          DistanceEvaluator)
+            for configuration_name, configuration in self.configurations.items():
+                for seed in self.seeds:
+                    rows.append(self._run(instance_name, instance, codec, configuration_name, configuration, seed))
+        RegressionHarness.measure(rows, self.target_gap)
+        return rows
+
+    def _run(self, instance_name, instance, codec, configuration_name, configuration, seed):
+        evaluator = TimeEvaluator if instance['with_time_windows'] else DistanceEvaluator
+        solver_class = ALNS if configuration.get('solver', 'hill_climbing') == 'alns' else HillClimbing
+        initialization = configuration.get('route_initialization_method',
+                                           'relaxed_random' if instance['with_time_windows'] else 'random')
+        parameters = dict(configuration.get('parameters', {}))
+        parameters['seed'] = seed
+        if solver_class is HillClimbing:
+            parameters['with_time_windows'] = instance['with_time_windows']
+
+        trace = TraceSink()
+        solver = solver_class(instance['jobs'], instance['stores'], instance['deliverers'],
+                              instance['distances_matrix'], evaluator, codec,
+                              route_initialization_method=initialization, progress=trace)
+        solver.generate_initial_solution(nr_iterations=configuration.get('nr_initial_solutions', 2000), use_seed=True,
+                                         seed=seed)
+        trace.record(solver.solution.evaluate(end_with_start_loc=solver.driver_ends_at_start))
+        score = solver.solve(**parameters)[0]
+        seconds = time.perf_counter() - trace.started
+        trace.record(score)
+        return {'revision': self.revision, 'instance': instance_name, 'configuration': configuration_name,
+                'seed': seed, 'parameters': json.dumps(parameters, sort_keys=True), 'score': score,
+                'seconds': seconds, 'curve': trace.curve}
+
+    @staticmethod
+    def measure(rows, target_gap=0.01, baseline=None):
+        """"
+        Sets the target, time_to_target and primal_integral of the rows against the best known score per instance
+        of the rows and the baseline rows
+        """
+        best = {}
+        for row in list(rows) + list(baseline or []):
+            best[row['instance']] = min(best.get(row['instance'], float('inf')), row['score'])
+        for row in rows:
+            reference = best[row['instance']]
+            row['reference'] = reference
+            row['target'] = reference + abs(reference) * target_gap
+            row['time_to_target'] = time_to_target(row['curve'], row['target'])
+            row['primal_integral'] = primal_integral(row['curve'], reference, row['seconds'])
+
+    @staticmethod
+    def compare(rows, baseline, target_gap=0.01, slowdown=0.25, min_seconds=0.05):
+        """"
+        Returns a list of (instance, configuration, seed, reason) of the runs that got slower than in the baseline.
+        Both are measured again against their common best known scores. The primal integrals of a pair of runs are
+        taken over the longest of the two, so a run that stops early with a worse score does not look better.
+
+        :param: slowdown: float relative increase of the time to target or the primal integral that is flagged
+        :param: min_seconds: float smaller increases of the time to target are noise
+        """
+        RegressionHarness.measure(baseline, target_gap, rows)
+        RegressionHarness.measure(rows, target_gap, baseline)
+        before = {(row['instance'], row['configuration'], row['seed']): row for row in baseline}
+        flags = []
+        for row in rows:
+            key = (row['instance'], row['configuration'], row['seed'])
+            old = before.get(key)
+            if old is None:
+                continue
+            horizon = max(row['seconds'], old['seconds'])
+            integral = primal_integral(row['curve'], row['reference'], horizon)
+            old_integral = primal_integral(old['curve'], old['reference'], horizon)
+            reason = None
+            if old['time_to_target'] is not None and row['time_to_target'] is None:
+                reason = 'no longer reaches the target %g' % row['target']
+            elif old['time_to_target'] is not None and \
+                    row['time_to_target'] - old['time_to_target'] > max(slowdown * old['time_to_target'], min_seconds):
+                reason = 'time to target %.3f s, was %.3f s' % (row['time_to_target'], old['time_to_target'])
+            elif integral > (1 + slowdown) * old_integral and integral - old_integral > min_seconds:
+                reason = 'primal integral %.3f, was %.3f over %.3f s' % (integral, old_integral, horizon)
+            if reason is not None:
+                logging.warning('Regression of %s %s seed %s: %s', key[0], key[1], key[2], reason)
+                flags.append(key + (reason,))
+        return flags
+
+    @staticmethod
+    def write(rows, file_name):
+        """"
+        Appends the rows to a csv file, the curve as a json list of [seconds, score]
+        """
+        new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+        with open(file_name, 'a', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=RegressionHarness.columns, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            for row in rows:
+                row = dict(row)
+                row['curve'] = json.dumps([list(point) for point in row['curve']])
+                writer.writerow(row)
+
+    @staticmethod
+    def read(file_name, revision=None):
+        """"
+        Reads the rows of a csv file, optionally only of one revision
+        """
+        rows = []
+        with open(file_name, newline='') as infile:
+            for row in csv.DictReader(infile):
+                if revision is not None and row['revision'] != revision:
+                    continue
+                row['seed'] = int(row['seed'])
+                row['score'] = float(row['score'])
+                row['seconds'] = float(row['seconds'])
+                row['curve'] = [tuple(point) for point in json.loads(row['curve'])]
+                rows.append(row)
+        return rows
+
+
+def time_to_target(curve, target):
+    """"
+    Returns the seconds until the best score of the curve is at most target, None if it never is
+    """
+    for seconds, score in curve:
+        if score <= target:
+            return seconds
+    return None
+
+
+def primal_integral(curve, reference, horizon):
+    """"
+    Returns the integral over [0, horizon] of the primal gap |score - reference| / max(|score|, |reference|) of the
+    best score so far, the gap is 1 until the first score. Lower is better, a solver that finds the reference score at
+    once has 0.
+    """
+    total = 0.0
+    previous_seconds = 0.0
+    gap = 1.0
+    for seconds, score in curve:
+        seconds = min(seconds, horizon)
+        total += gap * (seconds - previous_seconds)
+        previous_seconds = seconds
+        denominator = max(abs(score), abs(reference))
+        gap = abs(score - reference) / denominator if denominator > 0 else 0.0
+    return total + gap * max(horizon - previous_seconds, 0.0)
+
+
+def cache_mismatches(route, driver_ends_at_start=True, nr_moves=300, seed=0):
+    """"
+    Scores nr_moves random swap, 2-opt, pair relocation and or-opt moves on the route with its incremental cache (see
+    neighbourhood.route_cache) and with the evaluator on the moved route. Returns the (move, cache score, score) of
+    the moves on which both differ, none should.
+    """
+    rand = random.Random(seed)
+    cache = route_cache(route, driver_ends_at_start)
+    n = len(route.tour)
+    mismatches = []
+    for _ in range(nr_moves):
+        kind = rand.choice(['swap', 'two_opt', 'relocate_pair', 'or_opt'])
+        if kind in ('swap', 'two_opt'):
+            move = (kind,) + tuple(sorted(rand.sample(range(n), 2)))
+        elif kind == 'relocate_pair':
+            move = (kind,) + tuple(sorted(rand.sample(range(n), 2))) + \
+                tuple(sorted([rand.randrange(n - 1), rand.randrange(n - 1)]))
+        else:
+            length = rand.randint(1, min(3, n - 1))
+            move = (kind, rand.randrange(n - length + 1), length, rand.randrange(n - length + 1), rand.random() < 0.5)
+        moved = route.copy()
+        moved.apply_move(move)
+        score = moved.evaluate(end_with_start_loc=driver_ends_at_start)
+        cache_score = cache.move_score(move)
+        if abs(cache_score - score) > 1e-9 * max(1.0, abs(score)):
+            mismatches.append((move, cache_score, score))
+    return mismatches
+
+
+# modules that the solver core must not import at startup, they are loaded on first use
+heavy_modules = ('pandas', 'numpy', 'multiprocessing', 'cProfile', 'pstats', 'tempfile')
+
+# run by a fresh interpreter: the imports of the solver core and a HillClimbing on a tiny problem, ready to solve
+_startup_script = """
+import time
+started = time.perf_counter()
+from src.algorithms.neighbourhood import HillClimbing
+from src.domain import Codec
+from src.evaluators import DistanceEvaluator
+from src.locations import Job, Store, Deliverer, DistancesMatrix
+stores = [Store('store', [1.3, 103.8], 1, None)]
+jobs = [Job(str(i), None, None, [1.3 + i / 100.0, 103.8], [0, 10 ** 10], {'id': 1, 'time_window': [0, 10 ** 10]},
+            None, 1, None, None, None, None, None, None, None) for i in range(3)]
+deliverers = [Deliverer(0, None, 0, 10 ** 10, [1.35, 103.8], None, 10, None, None, None, None, None)]
+distances_matrix = DistancesMatrix(jobs + stores + deliverers)
+hc = HillClimbing(jobs, stores, deliverers, distances_matrix, DistanceEvaluator,
+                  Codec(jobs, stores, deliverers, distances_matrix, DistanceEvaluator))
+hc.generate_initial_solution(nr_iterations=1)
+ready = time.perf_counter() - started
+import json, sys
+print(json.dumps({'seconds': ready, 'modules': [name for name in %r if name in sys.modules]}))
+"""
+
+
+def startup_time(repeat=10, budget=0.05):
+    """"
+    Measures the startup of the solver core in repeat fresh interpreters: the seconds from the first import to a
+    HillClimbing with an initial solution (ready) and of the whole process, interpreter start included (process).
+    Returns a dict with the median and the minimum of both and the heavy modules that were imported. Warns when the
+    median time to a ready solver is over budget seconds or a heavy module is imported at startup.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = _startup_script % (heavy_modules,)
+    ready = []
+    process = []
+    modules = set()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=root, universal_newlines=True)
+        process.append(time.perf_counter() - started)
+        result = json.loads(output.strip().splitlines()[-1])
+        ready.append(result['seconds'])
+        modules.update(result['modules'])
+    ready.sort()
+    process.sort()
+    result = {'ready_median': ready[len(ready) // 2], 'ready_min': ready[0],
+              'process_median': process[len(process) // 2], 'process_min': process[0],
+              'heavy_modules': sorted(modules), 'budget': budget}
+    if result['ready_median'] > budget:
+        logging.warning('Startup of the solver takes %.1f ms, the budget is %.1f ms', 1000 * result['ready_median'],
+                        1000 * budget)
+    if modules:
+        logging.warning('Startup of the solver imports %s', ', '.join(sorted(modules)))
+    return result
+
+
+def revision():
+    """"
+    Returns the git commit of the working directory, None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(file_name='../solutions/regression.csv'):
+    """"
+    Runs the fixed matrix on the problem of data/problem.json and compares it with the last other revision in the
+    results file
+    """
+    jobs, stores, deliverers = ProblemLoader('../data/problem.json').load()
+    distances_matrix = DistancesMatrix(jobs + stores + deliverers)
+    instances = {
+        'problem_1': {'jobs': jobs, 'stores': stores, 'deliverers': deliverers, 'distances_matrix': distances_matrix,
+                      'with_time_windows': False},
+        'problem_2': {'jobs': jobs, 'stores': stores, 'deliverers': deliverers, 'distances_matrix': distances_matrix,
+                      'with_time_windows': True}
+    }
+    configurations = {
+        'tabu': {'parameters': {'tabu': True, 'tabu_size': 5, 'nr_iterations': 10, 'allow_infeasibilites': True}},
+        'adaptive': {'parameters': {'tabu': True, 'tabu_size': 5, 'nr_iterations': 10, 'allow_infeasibilites': True,
+                                    'adaptive_operators': True}},
+        'alns': {'solver': 'alns', 'parameters': {'nr_iterations': 300}}
+    }
+    harness = RegressionHarness(instances, configurations, revision=revision())
+    rows = harness.run()
+    baseline = []
+    if os.path.exists(file_name):
+        previous = RegressionHarness.read(file_name)
+        revisions = [row['revision'] for row in previous if row['revision'] != str(harness.revision)]
+        if revisions:
+            baseline = [row for row in previous if row['revision'] == revisions[-1]]
+    flags = RegressionHarness.compare(rows, baseline) if baseline else []
+    RegressionHarness.write(rows, file_name)
+    for row in rows:
+        print(row['instance'], row['configuration'], row['seed'], 'score', row['score'], 'seconds',
+              round(row['seconds'], 3), 'time to target', row['time_to_target'], 'primal integral',
+              round(row['primal_integral'], 3))
+    print(len(flags), 'regressions')
+    for evaluator, initialization in ((DistanceEvaluator, 'random'), (DistanceEvaluator, 'relaxed_random'),
+                                      (TimeEvaluator, 'relaxed_random')):
+        for driver_ends_at_start in (True, False):
+            route = Route(jobs, stores, deliverers, distances_matrix, evaluator)
+            route.generate_initial_route(initialization_method=initialization)
+            mismatches = cache_mismatches(route, driver_ends_at_start)
+            if mismatches:
+                logging.warning('The cache of the %s misjudges %d moves on a %s route, e.g. %s', evaluator.__name__,
+                                len(mismatches), initialization, mismatches[0])
+    startup = startup_time()
+    print('startup to a ready solver %.1f ms, process %.1f ms' % (1000 * startup['ready_median'],
+                                                                   1000 * startup['process_median']))
+    return flags
+
+
+if __name__ == "__main__":
+    main()
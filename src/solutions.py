@@ -0,0 +1,302 @@
+from src.domain import Route, ProblemIndex
+from src.locations import Job, Store
+from array import array
+import json
+import logging
+import os
+import struct
+
+
+_MAGIC = b'TSPR'
+_VERSION = 1
+# route header: name, score, flags, number of nodes, length of the driver id and of the run label
+_ROUTE_HEADER = struct.Struct('<16sdBIHH')
+_TIME_WINDOW = 1
+_HAS_SCORE = 2
+
+
+class SolutionWriter:
+    """"
+    Writes many routes (per driver, per run) to one file. Every route is stored under a stable name, see
+    Route.content_name, so equal tours get the same name and different tours do not collide.
+
+    Formats:
+    'jsonl' one json record per line: name, driver, run, score, time_window and the tour as node references, a job is
+    ["j", job id], a store ["s", store id] and the store copy of a relaxed route ["s", store id, job id].
+    'pretty' the same records in one indented json document, for reading by people.
+    'binary' a compact file: a header with the job and store ids, then per route a fixed size header and the tour as
+    int32 codes of ProblemIndex.encode. A job is its index in the jobs, a store len(jobs) + its index in the stores and
+    the store copy of a relaxed route -(index of its job + 1).
+
+    Records are encoded in memory and written in blocks of buffer_size bytes. Use the writer as a context manager or
+    call close; routes written to an existing file are appended (not for 'pretty'). A binary file is only appended to
+    when its header has the same jobs and stores as the writer, otherwise flush raises a ValueError.
+    """
+    formats = ('jsonl', 'pretty', 'binary')
+
+    def __init__(self, file_name, jobs, stores, file_format='jsonl', buffer_size=1 << 20, stops=False):
+        """"
+        :param: file_name: str the file to write to
+        :param: jobs: list of all jobs, the binary codes refer to the order of this list
+        :param: stores: list of all stores
+        :param: stops: boolean also write the stops (label, lat, lon, fulfillment_id) of every route, as Route.dump
+        """
+        if file_format not in SolutionWriter.formats:
+            raise ValueError('Unknown solution format ' + str(file_format))
+        self.file_name = file_name
+        self.file_format = file_format
+        self.buffer_size = buffer_size
+        self.stops = stops
+        self.index = ProblemIndex.of(jobs, stores)
+        self._buffer = []
+        self._buffered = 0
+        self._records = []
+        self._file = None
+        self.statistics = {'routes': 0, 'bytes': 0}
+
+    def write(self, route, score=None, run=None):
+        """"
+        Adds a route to the file and returns its name
+
+        :param: score: float optional score of the route
+        :param: run: optional label of the run or iteration the route belongs to
+        """
+        name = route.content_name()
+        time_window = any(isinstance(node, Store) and node.get_job() is not None for node in route.tour)
+        if self.file_format == 'binary':
+            data = self._encode_binary(route, name, score, run, time_window)
+        else:
+            record = {'name': name, 'driver': route.deliverer().id, 'run': run, 'score': score,
+                      'time_window': time_window, 'tour': [SolutionWriter.node_reference(node) for node in route.tour]}
+            if self.stops:
+                record['stops'] = route.stops(time_window=time_window)
+            if self.file_format == 'pretty':
+                self._records.append(record)
+                self.statistics['routes'] += 1
+                return name
+            data = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.statistics['routes'] += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+        return name
+
+    def write_all(self, routes, scores=None, run=None):
+        """"
+        Writes a list of routes and returns their names
+        """
+        names = []
+        for i in range(len(routes)):
+            names.append(self.write(routes[i], score=scores[i] if scores is not None else None, run=run))
+        return names
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            new_file = not os.path.exists(self.file_name) or os.path.getsize(self.file_name) == 0
+            if not new_file and self.file_format == 'binary':
+                self._check_binary_header()
+            self._file = open(self.file_name, 'ab')
+            if new_file and self.file_format == 'binary':
+                self._file.write(self._encode_binary_header())
+        data = b''.join(self._buffer)
+        self._file.write(data)
+        self.statistics['bytes'] += len(data)
+        self._buffer = []
+        self._buffered = 0
+
+    def close(self):
+        if self.file_format == 'pretty':
+            with open(self.file_name, 'w') as outfile:
+                json.dump({'routes': self._records}, outfile, indent=4)
+            return
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def node_reference(node):
+        if isinstance(node, Job):
+            return ['j', node.id]
+        job = node.get_job()
+        if job is not None:
+            return ['s', node.id, job.id]
+        return ['s', node.id]
+
+    def _header(self):
+        return {'version': _VERSION, 'jobs': [job.id for job in self.index.jobs],
+                'stores': [store.id for store in self.index.stores]}
+
+    def _encode_binary_header(self):
+        header = json.dumps(self._header()).encode('utf-8')
+        return _MAGIC + struct.pack('<I', len(header)) + header
+
+    def _check_binary_header(self):
+        """"
+        Raises a ValueError when the existing file is not a binary solution file of the jobs and stores of the writer,
+        its codes would refer to other nodes
+        """
+        with open(self.file_name, 'rb') as infile:
+            if infile.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('Can not append binary routes to ' + self.file_name +
+                                 ', it is not a binary solution file')
+            header = _read_binary_header(infile)
+        expected = self._header()
+        if header['jobs'] != expected['jobs'] or header['stores'] != expected['stores']:
+            raise ValueError('Can not append to ' + self.file_name + ', its routes have other jobs or stores')
+
+    def _encode_binary(self, route, name, score, run, time_window):
+        codes = self.index.encode(route.tour)
+        if codes.itemsize != 4:
+            raise TypeError('array of int is not 32 bits on this platform')
+        driver = str(route.deliverer().id).encode('utf-8')
+        run = b'' if run is None else str(run).encode('utf-8')
+        flags = (_TIME_WINDOW if time_window else 0) | (_HAS_SCORE if score is not None else 0)
+        header = _ROUTE_HEADER.pack(bytes.fromhex(name), score if score is not None else 0.0, flags, len(codes),
+                                    len(driver), len(run))
+        return header + driver + run + codes.tobytes()
+
+
+class SolutionReader:
+    """"
+    Reads the files of the SolutionWriter back into Route objects, e.g. to warm start a solver with a route of an
+    earlier run. The format is detected from the file.
+    """
+    def __init__(self, jobs, stores, deliverers, distances_matrix, evaluator):
+        self.jobs = jobs
+        self.stores = stores
+        self.deliverers = deliverers
+        self.distances_matrix = distances_matrix
+        self.evaluator = evaluator
+        self.index = ProblemIndex.of(jobs, stores)
+        self._jobs_by_id = {job.id: job for job in jobs}
+        self._deliverers_by_id = {deliverer.id: deliverer for deliverer in deliverers}
+
+    def read(self, file_name):
+        """"
+        Returns a list of (record, route), the record has the name, driver, run, score and time_window of the route
+        """
+        with open(file_name, 'rb') as infile:
+            start = infile.read(len(_MAGIC))
+            if start == _MAGIC:
+                return self._read_binary(infile)
+        with open(file_name, encoding='utf-8') as infile:
+            text = infile.read()
+        try:
+            document = json.loads(text)
+        except ValueError:
+            document = None
+        if isinstance(document, dict) and 'routes' in document:
+            records = document['routes']
+        else:
+            records = []
+            for line_number, line in enumerate(text.splitlines(), 1):
+                if line.strip():
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError as e:
+                        logging.warning('Skipping invalid route at line %d of %s: %s', line_number, file_name, e)
+        results = []
+        for record in records:
+            tour = [self._node(reference) for reference in record['tour']]
+            results.append((SolutionReader._meta(record), self._route(tour, record['driver'])))
+        return results
+
+    def best(self, file_name, driver=None):
+        """"
+        Returns the route with the lowest score in the file, optionally only of the given driver
+        """
+        best = None
+        for record, route in self.read(file_name):
+            if record['score'] is None or (driver is not None and record['driver'] != driver):
+                continue
+            if best is None or record['score'] < best[0]['score']:
+                best = (record, route)
+        return best[1] if best is not None else None
+
+    def route(self, references, driver):
+        """"
+        Builds a route of the driver from node references, see SolutionWriter.node_reference
+        """
+        return self._route([self._node(reference) for reference in references], driver)
+
+    def _read_binary(self, infile):
+        header = _read_binary_header(infile)
+        jobs = [self._jobs_by_id[job_id] for job_id in header['jobs']]
+        stores = [self.index.store_by_id[store_id] for store_id in header['stores']]
+        results = []
+        while True:
+            data = infile.read(_ROUTE_HEADER.size)
+            if len(data) < _ROUTE_HEADER.size:
+                break
+            name, score, flags, length, driver_length, run_length = _ROUTE_HEADER.unpack(data)
+            driver = infile.read(driver_length).decode('utf-8')
+            run = infile.read(run_length).decode('utf-8') if run_length else None
+            codes = array('i')
+            codes.frombytes(infile.read(4 * length))
+            tour = []
+            for code in codes:
+                if code < 0:
+                    tour.append(self._store_copy(jobs[-code - 1]))
+                elif code < len(jobs):
+                    tour.append(jobs[code])
+                else:
+                    tour.append(stores[code - len(jobs)])
+            deliverer = self._deliverer(driver)
+            record = {'name': name.hex(), 'driver': deliverer.id, 'run': run,
+                      'score': score if flags & _HAS_SCORE else None, 'time_window': bool(flags & _TIME_WINDOW)}
+            results.append((record, self._route(tour, deliverer.id)))
+        return results
+
+    def _node(self, reference):
+        if reference[0] == 'j':
+            return self._jobs_by_id[reference[1]]
+        if len(reference) > 2:
+            return self._store_copy(self._jobs_by_id[reference[2]])
+        return self.index.store_by_id[reference[1]]
+
+    def _store_copy(self, job):
+        store = self.index.store_of(job).copy()
+        store.set_job(job)
+        return store
+
+    def _deliverer(self, driver):
+        """"
+        The binary format stores the driver id and the run label as text
+        """
+        for deliverer in self.deliverers:
+            if str(deliverer.id) == driver:
+                return deliverer
+        raise KeyError('Unknown driver ' + driver)
+
+    def _route(self, tour, driver):
+        deliverer = self._deliverers_by_id[driver]
+        copies = [node for node in tour if isinstance(node, Store) and node.get_job() is not None]
+        route = Route(self.jobs, copies if copies else self.stores, [deliverer], self.distances_matrix,
+                      self.evaluator)
+        route.tour = tour
+        return route
+
+    @staticmethod
+    def _meta(record):
+        return {key: record.get(key) for key in ('name', 'driver', 'run', 'score', 'time_window')}
+
+
+def _read_binary_header(infile):
+    """"
+    Reads the header of a binary solution file after the magic bytes, raises a ValueError for an unknown version
+    """
+    header_length = struct.unpack('<I', infile.read(4))[0]
+    header = json.loads(infile.read(header_length).decode('utf-8'))
+    if header['version'] != _VERSION:
+        raise ValueError('Unknown solution file version ' + str(header['version']))
+    return header
@@ -1,10 +1,19 @@
 import json
 import logging
 from src.locations import Job, Store, Deliverer, DistancesMatrix
-from src.algorithms.neighbourhood import  HillClimbing, GridSearch
+from src.distances import MatrixCache
+from src.algorithms.neighbourhood import  HillClimbing
+from src.algorithms.tuning import SuccessiveHalving
+from src.algorithms.alns import ALNS
+from src.algorithms.dp import WindowOptimizer
+from src.algorithms.elite import EliteArchive
 from src.domain import Route, Codec
-from src.evaluators import DistanceEvaluator, TimeEvaluator
-import pandas as pd
+from src.loader import ProblemLoader
+from src.solutions import SolutionWriter, SolutionReader
+from src.checkpoint import Checkpoint
+from src.evaluators import DistanceEvaluator, TimeEvaluator, EvaluationCache, CachedEvaluator
+from src.progress import PrintSink, Statistics, default_sink, set_default_sink
+from src.profiling import Profiler
 import os
 
 
@@ -25,14 +34,14 @@ def load_data(datafile_location = '../data/problem.json'):
 
 
 def match_data(jobs, stores):
+    # hashes the jobs on their store id once instead of scanning all jobs for every store, see domain.ProblemIndex
+    jobs_by_store = {}
+    for job in jobs:
+        jobs_by_store.setdefault(job['store']['id'], []).append(job['id'])
     grouped = {}
     for store in stores:
-        for job in jobs:
-            if store['id']== job['store']['id']:
-                if store['id'] in grouped:
-                    grouped[store['id']].append(job['id'])
-                else:
-                    grouped[store['id']] = [job['id']]
+        if store['id'] in jobs_by_store and store['id'] not in grouped:
+            grouped[store['id']] = jobs_by_store[store['id']]
     return grouped
 
 def split_and_retrieve_data(data):
@@ -58,9 +67,7 @@ def split_and_retrieve_data(data):
                                 deliverer['contract_type'], deliverer['is_fulltime_driver'], deliverer['vehicle_type'])
         deliverers.append(a_deliverer)
 
-    print('number of jobs', len(jobs))
-    print('number of stores', len(stores))
-    print('number of deliverers', len(deliverers))
+    _problem_size(jobs, stores, deliverers)
 
     return jobs, stores, deliverers
 
@@ -77,6 +84,9 @@ def read_run_statistics(file_path=None, file_name=None):
     else:
         file_name = file_path + str(file_name) + '.csv'
 
+    # pandas is imported when the statistics are read, not by every process that imports this module, e.g. the
+    # worker processes that re-import the main module
+    import pandas as pd
     if os.path.exists(file_name) :
         df = pd.read_csv(file_name, index_col=False)
     else:
@@ -85,20 +95,33 @@ def read_run_statistics(file_path=None, file_name=None):
     return df
 
 
+def _problem_size(jobs, stores, deliverers):
+    progress = default_sink()
+    if progress.enabled:
+        progress.emit(Statistics('loader', 'problem size', {'jobs': len(jobs), 'stores': len(stores),
+                                                            'deliverers': len(deliverers)}))
+
+
 def main():
-    df_statistics = read_run_statistics()
-    data = load_data()
-    jobs, stores, deliverers = split_and_retrieve_data(data)
+    # the solvers report through progress events, print them as before. Use e.g. a progress.JsonlSink or a
+    # progress.LoggingSink in a service, the incumbent events are left out here as there is one per accepted move.
+    set_default_sink(PrintSink(kinds=('sweep', 'phase', 'statistics', 'note')))
+    # streams the records into the objects instead of loading the whole json tree, see load_data for the old way
+    loader = ProblemLoader('../data/problem.json')
+    jobs, stores, deliverers = loader.load()
+    _problem_size(jobs, stores, deliverers)
 
     all_locations = []
     all_locations.extend(jobs)
     all_locations.extend(stores)
     all_locations.extend(deliverers)
 
-    distances_matrix = DistancesMatrix(all_locations)
-    codec = Codec(jobs, stores, deliverers, distances_matrix, DistanceEvaluator )
-
-    Route._generate_map(jobs, stores, deliverers)
+    # the haversine distances, pass e.g. a distances.MatrixFileProvider for the distances and travel times of a
+    # routing engine. Matrices are kept on disk by the content of the locations and the provider.
+    distances_matrix = DistancesMatrix(all_locations, cache=MatrixCache('../data/distance_cache'))
+    # one cache for all evaluations: the grid search cells and the codec score many identical tours
+    evaluation_cache = EvaluationCache()
+    codec = Codec(jobs, stores, deliverers, distances_matrix, CachedEvaluator(DistanceEvaluator, evaluation_cache))
 
 
     # hc = HillClimbing(jobs, stores, deliverers, distances_matrix, TimeEvaluator, codec,
@@ -107,8 +130,19 @@ def main():
     # h = hc.solve(with_time_windows=True, tabu=True, nr_iterations=10, tabu_size=7,
     #                                                     allow_infeasibilites=True)
 
+    # for very large single driver tours, solve clusters in parallel and stitch them, see ClusterDecomposition
+    # dec = ClusterDecomposition(jobs, stores, deliverers[:1], LazyDistancesMatrix(all_locations), TimeEvaluator,
+    #                            cluster_size=40, workers=4)
+    # score, route = dec.solve(with_time_windows=True, nr_iterations=10)
+
+    # for many drivers over the same stores, one problem per driver that shares the store to store distances
+    # contexts = ProblemContext.for_drivers([(deliverer, jobs_of_deliverer), ...], stores)
+    # results = solve_all(contexts, hill_climbing(TimeEvaluator, 'relaxed_random', with_time_windows=True), workers=4)
+
     run_problem_1 = False
     run_problem_2 = True
+    use_alns = False
+    post_optimize = True
     solutions_1 = []
     solutions_2 = []
     best_sol_problem_1 = None
@@ -116,52 +150,152 @@ def main():
     best_sol_problem_2 = None
     best_score_problem_2 = float('inf')
     dump = True
-    for i in range(10):
+    # continues a run that was stopped from its last checkpoint: the iteration, the tuner rung and the solver iteration
+    resume = False
+    checkpoint = Checkpoint('../solutions/checkpoint.pkl')
+    if resume:
+        checkpoint.load()
+    checkpoint_key = repr((run_problem_1, run_problem_2, use_alns))
+    start_iteration = 0
+    progress = checkpoint.get('main', checkpoint_key)
+    if progress is not None:
+        start_iteration = progress['iteration']
+        solutions_1 = progress['solutions_1']
+        solutions_2 = progress['solutions_2']
+        best_score_problem_1 = progress['best_score_problem_1']
+        best_score_problem_2 = progress['best_score_problem_2']
+        if progress['best_sol_problem_1'] is not None:
+            best_sol_problem_1 = SolutionReader(jobs, stores, deliverers, distances_matrix, DistanceEvaluator).route(
+                *progress['best_sol_problem_1'])
+        if progress['best_sol_problem_2'] is not None:
+            best_sol_problem_2 = SolutionReader(jobs, stores, deliverers, distances_matrix, TimeEvaluator).route(
+                *progress['best_sol_problem_2'])
+        print('resuming from iteration', start_iteration)
+    # every route of the run, to compare runs or to warm start from later with solutions.SolutionReader
+    solution_writer = SolutionWriter('../solutions/routes.jsonl', jobs, stores) if dump else None
+    # the best diverse routes of all iterations and of earlier runs, the ALNS runs start from a relinking of two of them
+    elite_1 = EliteArchive(size=10, seed=1)
+    elite_2 = EliteArchive(size=10, seed=2)
+    # 'sample' or 'cprofile' writes where the solvers spend their time to ../solutions/profile.folded and .txt
+    profile = None
+    profiler = Profiler(mode=profile) if profile is not None else None
+    if profiler is not None:
+        profiler.start()
+    for i in range(start_iteration, 10):
+
+        if run_problem_1 and use_alns:
+            print('running alns for problem 1')
+            alns = ALNS(jobs, stores, deliverers, distances_matrix, DistanceEvaluator, codec,
+                        route_initialization_method='random', evaluation_cache=evaluation_cache)
+            alns.generate_initial_solution(use_seed=True, seed=i + 1)
+            _seed_from_archive(elite_1, '../solutions/elite_problem_1.pkl', alns)
+            score, route_problem1, iteration = alns.solve(nr_iterations=1000, seed=i)
+            _keep_elite(elite_1, '../solutions/elite_problem_1.pkl', route_problem1, score)
+            print('score', score)
+            solutions_1.append(score)
+            if solution_writer is not None:
+                solution_writer.write(route_problem1, score=score, run=i)
+            if score < best_score_problem_1:
+                best_sol_problem_1 = route_problem1
+                best_score_problem_1 = score
 
-        if run_problem_1:
-            print('running grid search for problem 1')
+        elif run_problem_1:
+            print('running successive halving for problem 1')
             #problem 1
             hc = HillClimbing(jobs, stores, deliverers, distances_matrix, DistanceEvaluator, codec,
-                              route_initialization_method='random')
+                              route_initialization_method='random', evaluation_cache=evaluation_cache)
 
-            gs = GridSearch(tabu=True, range_iterations_start=10, range_iterations_end=20, range_tabu_list_start=1,
-                            range_tabu_list_end=10, hc=hc, allow_infeasibilities=True)
+            # the tuner starts its runs from relinkings of the elite routes of the earlier iterations and runs
+            hc.generate_initial_solution(nr_iterations=1)
+            _load_elite(elite_1, '../solutions/elite_problem_1.pkl', hc.solution)
+            sh = SuccessiveHalving([hc], nr_configurations=16, min_iterations=5, max_iterations=20,
+                                   seeds=(3 * i + 1, 3 * i + 2), allow_infeasibilities=True, seed=i,
+                                   checkpoint=checkpoint, archive=elite_1)
 
-            score, route_problem1, tabu_list_size = gs.run()
+            score, route_problem1, configuration = sh.run()
+            _keep_elite(elite_1, '../solutions/elite_problem_1.pkl', route_problem1, score)
             print('score', score)
             solutions_1.append(score)
+            if solution_writer is not None:
+                solution_writer.write(route_problem1, score=score, run=i)
             if score < best_score_problem_1:
                 best_sol_problem_1 = route_problem1
                 best_score_problem_1 = score
             # route_problem1.dump(append_to='_best_sol_problem_1_')
 
         #problem 2
-        if run_problem_2:
+        if run_problem_2 and use_alns:
             print('iteration', i)
-            print('running grid search for problem 2')
+            print('running alns for problem 2')
+            alns = ALNS(jobs, stores, deliverers, distances_matrix, TimeEvaluator, codec,
+                        route_initialization_method='relaxed_random', evaluation_cache=evaluation_cache)
+            alns.generate_initial_solution(use_seed=True, seed=i + 1)
+            _seed_from_archive(elite_2, '../solutions/elite_problem_2.pkl', alns)
+            score, route_problem2, iteration = alns.solve(nr_iterations=1000, seed=i)
+            _keep_elite(elite_2, '../solutions/elite_problem_2.pkl', route_problem2, score)
+            print('seconds', score)
+            solutions_2.append(score)
+            if solution_writer is not None:
+                solution_writer.write(route_problem2, score=score, run=i)
+            if score < best_score_problem_2:
+                best_sol_problem_2 = route_problem2
+                best_score_problem_2 = score
+
+        elif run_problem_2:
+            print('iteration', i)
+            print('running successive halving for problem 2')
 
 
             hc = HillClimbing(jobs, stores, deliverers, distances_matrix, TimeEvaluator, codec,
-                              route_initialization_method='relaxed_random')
+                              route_initialization_method='relaxed_random', evaluation_cache=evaluation_cache)
 
             # hc.generate_initial_solution(use_seed=True)
             # score, route_problem2, iteration = hc.solve(tabu=True, with_time_windows=True,
             #                                        nr_iterations=25, tabu_size=j,
             #                                        allow_infeasibilites=True)
-            gs = GridSearch(tabu=True, range_iterations_start=20, range_iterations_end=30, range_tabu_list_start=2,
-                            range_tabu_list_end=9, hc=hc, allow_infeasibilities=True, with_time_windows=True)
-
-
-            score, route_problem2, tabu_list_size = gs.run()
+            hc.generate_initial_solution(nr_iterations=1)
+            _load_elite(elite_2, '../solutions/elite_problem_2.pkl', hc.solution)
+            sh = SuccessiveHalving([hc], nr_configurations=16, min_iterations=5, max_iterations=30,
+                                   seeds=(3 * i + 1, 3 * i + 2), allow_infeasibilities=True, with_time_windows=True,
+                                   seed=i, checkpoint=checkpoint, archive=elite_2)
+
+            score, route_problem2, configuration = sh.run()
+            _keep_elite(elite_2, '../solutions/elite_problem_2.pkl', route_problem2, score)
             print('seconds', score)
             solutions_2.append(score)
+            if solution_writer is not None:
+                solution_writer.write(route_problem2, score=score, run=i)
             if score < best_score_problem_2:
                 best_sol_problem_2 = route_problem2
                 best_score_problem_2 = score
 
             # route_problem2.dump(append_to='_best_sol_problem_2_')
 
+        if solution_writer is not None:
+            solution_writer.flush()
+        checkpoint.set('main', {
+            'iteration': i + 1,
+            'solutions_1': solutions_1,
+            'solutions_2': solutions_2,
+            'best_score_problem_1': best_score_problem_1,
+            'best_score_problem_2': best_score_problem_2,
+            'best_sol_problem_1': _route_references(best_sol_problem_1),
+            'best_sol_problem_2': _route_references(best_sol_problem_2)
+        }, key=checkpoint_key, force=True)
+
+    if post_optimize:
+        # squeezes the remaining distance/time out of the best routes by solving windows of 10 nodes exactly
+        if best_sol_problem_1 is not None:
+            best_score_problem_1, best_sol_problem_1 = WindowOptimizer(window_size=10).optimize(best_sol_problem_1)
+        if best_sol_problem_2 is not None:
+            best_score_problem_2, best_sol_problem_2 = WindowOptimizer(window_size=10).optimize(best_sol_problem_2)
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write('../solutions/profile')
+
     if dump:
+        solution_writer.close()
         if best_sol_problem_1 is not None:
             print('best_score 1', best_score_problem_1)
             best_sol_problem_1.dump(append_to='_best_sol_problem_1_')
@@ -170,12 +304,45 @@ def main():
             print('best_score 2', best_score_problem_2)
             best_sol_problem_2.dump(append_to='_best_sol_problem_2', time_window=True)
 
+        import pandas as pd
         df = pd.DataFrame(columns=['scores_problem1', 'scores_problem2'])
         df['scores_problem1'] = solutions_1
         df['scores_problem2'] = solutions_2
 
-        df_statistics = pd.concat([df_statistics, df])
+        # the statistics of earlier runs are read here, so a run without dump does not import pandas
+        df_statistics = pd.concat([read_run_statistics(), df])
         df_statistics.to_csv('../solutions/solution_statistics.csv', index=False)
+    checkpoint.remove()
+
+
+def _seed_from_archive(archive, file_name, solver):
+    """"
+    Replaces the initial solution of the solver by a relinking or crossover of two elite routes, if there are any
+    """
+    _load_elite(archive, file_name, solver.solution)
+    route = archive.seed(solver.solution)
+    if route is not None:
+        solver.solution = route
+
+
+def _load_elite(archive, file_name, template):
+    """"
+    Loads the elite routes of earlier runs into an empty archive
+    """
+    if not len(archive):
+        archive.load(file_name, template)
+
+
+def _keep_elite(archive, file_name, route, score):
+    _load_elite(archive, file_name, route)
+    if archive.add(route, score):
+        archive.save(file_name)
+
+
+def _route_references(route):
+    if route is None:
+        return None
+    return [SolutionWriter.node_reference(node) for node in route.tour], route.deliverer().id
 
 
 if __name__ == "__main__":